@@ -18,7 +18,7 @@ def std_profile(many_patch, nbins, nside, center, seenmap):
     Parameters
     ----------
     many_patch : array of shape (nreal, nsub, npixok, 3)
-        Many realisations of one patch.
+        Many realisations of one patch, or their RunningStatistics.
     nbins : int
         Number of bins.
     nside : int
@@ -45,11 +45,17 @@ def std_profile(many_patch, nbins, nside, center, seenmap):
     bin_centers = 0.5 * (bin_edges[0:nbins] + bin_edges[1:])
 
     # Std in each bin
-    nsub = np.shape(many_patch)[1]
+    if isinstance(many_patch, RunningStatistics):
+        nsub = many_patch.shape[0]
+    else:
+        nsub = np.shape(many_patch)[1]
     std_bin = np.empty((nbins, nsub, 3))
     for b in range(nbins):
         ok = (ang > bin_edges[b]) & (ang < bin_edges[b + 1])
-        std_bin[b, :, :] = np.std(many_patch[:, :, ok, :], axis=(0, 2))
+        if isinstance(many_patch, RunningStatistics):
+            std_bin[b, :, :] = many_patch.get_std_pixels(ok)
+        else:
+            std_bin[b, :, :] = np.std(many_patch[:, :, ok, :], axis=(0, 2))
 
     # Interpolation to get a profile
     fit = interpolate.interp1d(bin_centers, std_bin, axis=0, kind='linear', fill_value='extrapolate')
@@ -75,21 +81,13 @@ def get_residuals(fits_noise, fits_noiseless, residuals_way):
     -------
         residuals : array of shape (#reals, #bands, #pixels, 3)
     """
-    nreals = len(fits_noise)
-    residuals = []
+    if residuals_way not in ('noiseless', 'conv', 'mean_recon'):
+        raise ValueError('The way to compute residuals is not valid.')
 
-    if residuals_way == 'mean_recon':
-        seenmap = rmc.get_seenmap(fits_noise[0])
-        recon, conv, diff = rmc.get_patch(fits_noise[0], seenmap)
-        nbands, npix, nstk = recon.shape
-        rec = np.zeros((nreals, nbands, npix, nstk))
-        for j in range(nreals):
-            seenmap = rmc.get_seenmap(fits_noise[j])
-            rec[j], _, _ = rmc.get_patch(fits_noise[j], seenmap)
-
-    for i in range(nreals):
-        seenmap = rmc.get_seenmap(fits_noise[i])
-        recon, conv, diff = rmc.get_patch(fits_noise[i], seenmap)
+    residuals = []
+    for file in fits_noise:
+        seenmap = rmc.get_seenmap(file)
+        recon, conv, diff = rmc.get_patch(file, seenmap)
 
         if residuals_way == 'noiseless':
             recon_nl, conv_nl, diff_nl = rmc.get_patch(fits_noiseless, seenmap)
@@ -98,13 +96,15 @@ def get_residuals(fits_noise, fits_noiseless, residuals_way):
         elif residuals_way == 'conv':
             residuals.append(diff)
 
-        elif residuals_way == 'mean_recon':
-            residuals.append(recon - np.mean(rec, axis=0))
-
         else:
-            raise ValueError('The way to compute residuals is not valid.')
+            residuals.append(recon)
+
+    residuals = np.asarray(residuals)
+    if residuals_way == 'mean_recon':
+        # Each file is read once, the mean reconstruction being subtracted afterwards
+        residuals -= np.mean(residuals, axis=0)
 
-    return np.asarray(residuals)
+    return residuals
 
 
 def rms_method(name, residuals_way, zones=1):
@@ -188,6 +188,25 @@ def rms_method(name, residuals_way, zones=1):
     return rms_I, rms_Q, rms_U, setpar
 
 
+def _realization_covariance(data, ddof=1):
+    """
+    Covariance matrices over the realizations of data with shape (nreals, ..., n).
+    The returned array has the shape (..., n, n).
+
+    """
+    data = data - np.mean(data, axis=0)
+    return np.einsum('r...i,r...j->...ij', data, data, optimize=True) / (len(data) - ddof)
+
+
+def _cov2corr_stack(cov):
+    """
+    Converts a stack of covariance matrices of shape (..., n, n) in correlation matrices
+    """
+    sig = np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
+    corr = cov / (sig[..., :, None] * sig[..., None, :])
+    return np.clip(corr, -1, 1)
+
+
 def get_covcorr1pix(maps, ipix, verbose=False, stokesjoint=False):
     """
 
@@ -249,12 +268,13 @@ def get_covcorr1pix(maps, ipix, verbose=False, stokesjoint=False):
     return cov1pix, corr1pix
 
 
-def get_covcorr_patch(patch, stokesjoint=False, doplot=False):
+def get_covcorr_patch(patch, stokesjoint=False, doplot=False, chunk_size=1000):
     """
     This function computes the covariance matrix and the correlation matrix for a given patch in the sky.
-    It uses get_covcorr1pix() to compute the covariance and correlation matrix for each pixel (ipix).
+    It computes the same covariance and correlation matrices as get_covcorr1pix() for all the pixels at once,
+    by chunks of pixels.
 
-    Asumptions: patch.shape = (nreals, nbands, npix_patch, nstokes) --> to be able to use get_covcorr1pix
+    Asumptions: patch.shape = (nreals, nbands, npix_patch, nstokes)
 
     Parameters:
     -----------
@@ -269,6 +289,9 @@ def get_covcorr_patch(patch, stokesjoint=False, doplot=False):
 
     doplot: If True return a imshow plot of the matrix
 
+    chunk_size: int
+        Number of pixels processed at once, to bound the memory used. Default: 1000
+
     Returns:
     -----------
     covterm: np.array
@@ -282,18 +305,22 @@ def get_covcorr_patch(patch, stokesjoint=False, doplot=False):
     plot: Mean over the pixels of the covariance and correlation matrices
     """
 
-    nrecons = patch.shape[1]
-    npix = patch.shape[2]
-    nstokes = patch.shape[3]
+    nreals, nrecons, npix, nstokes = patch.shape
     dim = nrecons * nstokes
 
     cov = np.zeros((dim, dim, npix))
     corr = np.zeros((dim, dim, npix))
 
-    for ipix in range(npix):
-        cov1pix, corr1pix = get_covcorr1pix(patch, ipix, stokesjoint=stokesjoint)
-        cov[:, :, ipix] = cov1pix
-        corr[:, :, ipix] = corr1pix
+    for start in range(0, npix, chunk_size):
+        stop = min(start + chunk_size, npix)
+        # (nreals, npix_chunk, dim) with the ordering of get_covcorr1pix
+        if stokesjoint:
+            data = np.transpose(patch[:, :, start:stop, :], (0, 2, 3, 1))
+        else:
+            data = np.transpose(patch[:, :, start:stop, :], (0, 2, 1, 3))
+        cov_chunk = _realization_covariance(np.reshape(data, (nreals, stop - start, dim)))
+        cov[:, :, start:stop] = np.moveaxis(cov_chunk, 0, -1)
+        corr[:, :, start:stop] = np.moveaxis(_cov2corr_stack(cov_chunk), 0, -1)
 
     if doplot:
         plt.figure()
@@ -311,6 +338,116 @@ def get_covcorr_patch(patch, stokesjoint=False, doplot=False):
     return cov, corr
 
 
+class RunningStatistics(object):
+    """
+    Running mean and covariance over Monte-Carlo realizations of patches of shape (nsub, npix, nstokes).
+    The statistics are updated one realization, or one stack of realizations, at a time with the
+    Welford / Chan et al. formulae, so that the realizations never have to be stored together.
+    The statistics accumulated in different processes can be combined with merge().
+
+    Example
+    -------
+    stats = RunningStatistics()
+    for file in files:
+        recon, conv, diff = rmc.get_patch(file, seenmap)
+        stats.add(diff)
+    cov, corr = stats.get_covcorr()
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.shape = None
+        # Mean and sum of the products of the deviations to the mean, for each pixel and
+        # with I0,Q0,U0, I1,Q1,U1, ... ordering, of shapes (npix, dim) and (npix, dim, dim)
+        self._mean = None
+        self._comoment = None
+
+    def add(self, patch):
+        """
+        Add a realization of shape (nsub, npix, nstokes) or a stack of realizations
+        of shape (nreal, nsub, npix, nstokes).
+
+        """
+        patch = np.asarray(patch, dtype=float)
+        if patch.ndim == 3:
+            patch = patch[None]
+        nreal, nsub, npix, nstokes = patch.shape
+        data = np.reshape(np.transpose(patch, (0, 2, 1, 3)), (nreal, npix, nsub * nstokes))
+        mean = np.mean(data, axis=0)
+        comoment = _realization_covariance(data, ddof=0) * nreal
+        self._combine(nreal, patch.shape[1:], mean, comoment)
+        return self
+
+    def merge(self, other):
+        """
+        Combine the statistics of another RunningStatistics instance.
+
+        """
+        if other.count > 0:
+            self._combine(other.count, other.shape, other._mean, other._comoment)
+        return self
+
+    def _combine(self, count, shape, mean, comoment):
+        if self.count == 0:
+            self.count = count
+            self.shape = shape
+            self._mean = mean.copy()
+            self._comoment = comoment.copy()
+            return
+        if shape != self.shape:
+            raise ValueError('You should take maps with identical shapes.')
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean += delta * (count / total)
+        self._comoment += comoment + delta[:, :, None] * delta[:, None, :] * (self.count * count / total)
+        self.count = total
+
+    @property
+    def mean(self):
+        """
+        Mean over the realizations, of shape (nsub, npix, nstokes).
+
+        """
+        nsub, npix, nstokes = self.shape
+        return np.transpose(np.reshape(self._mean, (npix, nsub, nstokes)), (1, 0, 2))
+
+    def get_variance(self, ddof=0):
+        """
+        Variance over the realizations, of shape (nsub, npix, nstokes).
+
+        """
+        nsub, npix, nstokes = self.shape
+        var = np.diagonal(self._comoment, axis1=1, axis2=2) / (self.count - ddof)
+        return np.transpose(np.reshape(var, (npix, nsub, nstokes)), (1, 0, 2))
+
+    def get_std_pixels(self, pixels=slice(None)):
+        """
+        Std over the realizations and the given pixels, of shape (nsub, nstokes),
+        as np.std(many_patch[:, :, pixels, :], axis=(0, 2)).
+
+        """
+        mean = self.mean[:, pixels, :]
+        var = self.get_variance()[:, pixels, :]
+        return np.sqrt(np.mean(var + (mean - np.mean(mean, axis=1, keepdims=True)) ** 2, axis=1))
+
+    def get_covcorr(self, stokesjoint=False):
+        """
+        Covariance and correlation matrices for each pixel, as returned by get_covcorr_patch().
+
+        Returns
+        -------
+        cov, corr: arrays of shape (3xnfreq, 3xnfreq, npix)
+
+        """
+        nsub, npix, nstokes = self.shape
+        cov = self._comoment / (self.count - 1)
+        if stokesjoint:
+            permutation = np.arange(nsub * nstokes).reshape(nsub, nstokes).T.ravel()
+            cov = cov[:, permutation][:, :, permutation]
+        return np.moveaxis(cov, 0, -1), np.moveaxis(_cov2corr_stack(cov), 0, -1)
+
+
 def plot_hist(mat_npix, bins, title_prefix, ymax=0.5, color='b'):
     """
     Plots the histograms of each element of the matrix.
@@ -399,13 +536,8 @@ def get_covcorr_between_pix(maps, verbose=False):
         print('Number of realizations: {}'.format(nreal))
         print('Number of pixels {}'.format(npix))
 
-    cov_pix = np.empty((nsub, nstokes, npix, npix))
-    corr_pix = np.empty((nsub, nstokes, npix, npix))
-
-    for sub in range(nsub):
-        for s in range(nstokes):
-            cov_pix[sub, s, :, :] = np.cov(maps[:, sub, :, s], rowvar=False)
-            corr_pix[sub, s, :, :] = np.corrcoef(maps[:, sub, :, s], rowvar=False) - np.identity(npix)
+    cov_pix = _realization_covariance(np.transpose(maps, (0, 1, 3, 2)))
+    corr_pix = _cov2corr_stack(cov_pix) - np.identity(npix)
 
     return cov_pix, corr_pix
 
@@ -456,7 +588,7 @@ def covariance_IQU_subbands(allmaps, stokesjoint=False):
         List of maps for each number of sub-bands.
     
     stokesjoint: if True return Stokes parameter together 
-        I0,I1,..., Q0,Q1,..., U0,U1, ... . Otherwise will return
+        I0,I1,..., Q0,Q1,..., U0,U1, ... (index nsub * iqu + band). Otherwise will return
         I0,Q0,U0,  I1,Q1,U1, ... 
         Default: False
 
@@ -469,29 +601,16 @@ def covariance_IQU_subbands(allmaps, stokesjoint=False):
 
     """
     allmean, allcov = [], []
-    for isub in range(len(allmaps)):
-
-        sh = allmaps[isub].shape
-        nsub = sh[1]  # Number of subbands
-        mean = np.zeros(3 * nsub)
-        cov = np.zeros((3 * nsub, 3 * nsub))
-
-        for iqu in range(3):
-            for band in range(nsub):
-                if stokesjoint:
-                    i = 3 * iqu + band
-                else:
-                    i = 3 * band + iqu
-                map_i = allmaps[:, band, :, iqu]
-                mean[i] = np.mean(map_i)
-                for iqu2 in range(3):
-                    for band2 in range(nsub):
-                        if stokesjoint:
-                            j = 3 * iqu2 + band2
-                        else:
-                            j = 3 * band2 + iqu2
-                        map_j = allmaps[:, band2, :, iqu2]
-                        cov[i, j] = np.mean((map_i - np.mean(map_i)) * (map_j - np.mean(map_j)))
+    for maps in allmaps:
+        nreals, nsub, npix, nstokes = maps.shape
+        # (nreals, npix, 3 * nsub) ordered as the covariance matrix
+        if stokesjoint:
+            data = np.transpose(maps, (0, 2, 3, 1))
+        else:
+            data = np.transpose(maps, (0, 2, 1, 3))
+        data = np.reshape(data, (nreals * npix, nsub * nstokes))
+        mean = np.mean(data, axis=0)
+        cov = _realization_covariance(data, ddof=0)
 
         allmean.append(mean)
         allcov.append(cov)
@@ -809,7 +928,6 @@ allstdmat : list of arrays (nsub, nsub, 3)
         Std over pixels of the cov matrices freq-freq
 """
     print('\nCalculating variance map with freq-freq cov matrix for each pixel from MC')
-    seen = np.where(seenmap == 1)[0]
     npixok = np.sum(seenmap)
     variance_map = np.zeros((len(nsubvals), 3, npixok)) + hp.UNSEEN
     allmeanmat = []
@@ -818,25 +936,18 @@ allstdmat : list of arrays (nsub, nsub, 3)
     for isub in range(len(nsubvals)):
         print('for nsub = {}'.format(nsubvals[isub]))
         mapsout = allmapsout[isub]
-        covmat_freqfreq = np.zeros((nsubvals[isub], nsubvals[isub], len(seen), 3))
-        # Loop over pixels
-        for p in range(len(seen)):
-            # Loop over I Q U
-            for i in range(3):
-                mat = np.cov(mapsout[:, :, p, i].T)
-                # Normalisation
-                if np.size(mat) == 1:
-                    variance_map[isub, i, p] = mat
-                else:
-                    variance_map[isub, i, p] = 1. / np.sum(np.linalg.inv(mat))
-                covmat_freqfreq[:, :, p, i] = mat / np.mean(mat)
-                # its normalization is irrelevant for the later average
+        # freq-freq covariance matrices of all the pixels and I Q U, shape (npixok, 3, nsub, nsub)
+        mat = _realization_covariance(np.transpose(mapsout, (0, 2, 3, 1)))
+        # Normalisation
+        if nsubvals[isub] == 1:
+            variance_map[isub] = mat[:, :, 0, 0].T
+        else:
+            variance_map[isub] = 1. / np.sum(np.linalg.inv(mat), axis=(-2, -1)).T
+        # its normalization is irrelevant for the later average
+        covmat_freqfreq = mat / np.mean(mat, axis=(-2, -1), keepdims=True)
         # Average and std over pixels
-        meanmat = np.zeros((nsubvals[isub], nsubvals[isub], 3))
-        stdmat = np.zeros((nsubvals[isub], nsubvals[isub], 3))
-        for i in range(3):
-            meanmat[:, :, i] = np.mean(covmat_freqfreq[:, :, :, i], axis=2)
-            stdmat[:, :, i] = np.std(covmat_freqfreq[:, :, :, i], axis=2)
+        meanmat = np.transpose(np.mean(covmat_freqfreq, axis=0), (1, 2, 0))
+        stdmat = np.transpose(np.std(covmat_freqfreq, axis=0), (1, 2, 0))
 
         allmeanmat.append(meanmat)
         allstdmat.append(stdmat)
@@ -1,13 +1,21 @@
+import os
+
 import numpy as np
 import healpy as hp
 import pymaster as nmt
 
+from qubic.utils import _LRUCache, _get_hash, _save_atomic
+
 __all__ = ['Namaster']
 
+# workspaces shared by the Namaster instances, the least recently used are dropped
+_WORKSPACE_CACHE_SIZE = 8
+_workspaces = _LRUCache(_WORKSPACE_CACHE_SIZE)
+
 
 class Namaster(object):
 
-    def __init__(self, weight_mask, lmin, lmax, delta_ell, aposize=10.0, apotype='C1'):
+    def __init__(self, weight_mask, lmin, lmax, delta_ell, aposize=10.0, apotype='C1', workspace_cache=None):
         """
 
         Parameters
@@ -24,6 +32,9 @@ class Namaster(object):
         apotype: apodization type.
             Three methods implemented: C1, C2 and Smooth.
             'C1' by default.
+        workspace_cache: str, optional
+            Directory in which the workspaces (coupling matrices) are stored,
+            so that they are reused by later runs. None by default.
         """
 
         lmin = int(lmin)
@@ -39,6 +50,7 @@ class Namaster(object):
         self.ells, self.weights, self.bpws = self._binning()
         self.aposize = aposize
         self.apotype = apotype
+        self.workspace_cache = workspace_cache
         self.ell_binned = None
         self.fsky = None
 
@@ -174,6 +186,60 @@ class Namaster(object):
 
         return f0, f2
 
+    def get_workspaces(self, f0, f2, b, mask_apo, f0bis=None, f2bis=None, purify_e=False, purify_b=True,
+                       beam_correction=None):
+        """
+        Return the workspaces of the fields. The coupling matrices only depend on the apodized mask,
+        the nside, the binning, the purification and the beam: they are computed once and kept in a cache,
+        and stored in the workspace_cache directory if it is given.
+        Parameters
+        ----------
+        f0, f2: NmtField
+            Spin-0 and spin-2 fields.
+        b: NmtBin
+        mask_apo: array
+            Apodized mask of the fields.
+        f0bis, f2bis: NmtField, optional
+            Fields for Cross-Spectra, f0 and f2 by default.
+        purify_e, purify_b, beam_correction:
+            Same as in get_fields, they identify the workspaces.
+
+        Returns
+        -------
+        w: List containing the NmtWorkspaces [w00, w22, w02]
+
+        """
+        if f0bis is None:
+            f0bis = f0
+        if f2bis is None:
+            f2bis = f2
+        nside = hp.npix2nside(len(mask_apo))
+        key = _get_hash(mask_apo, nside, self.lmax, self.ells, self.weights, self.bpws,
+                                 purify_e, purify_b, beam_correction)
+        if key in _workspaces:
+            return list(_workspaces[key])
+
+        w = []
+        for spins, field_a, field_b in (('00', f0, f0bis), ('22', f2, f2bis), ('02', f0, f2bis)):
+            workspace = nmt.NmtWorkspace()
+            filename = None
+            if self.workspace_cache is not None:
+                filename = os.path.join(self.workspace_cache, 'nmt_workspace_{}_{}.fits'.format(key, spins))
+            if filename is not None and os.path.exists(filename):
+                workspace.read_from(filename)
+            else:
+                workspace.compute_coupling_matrix(field_a, field_b, b)
+                if filename is not None:
+                    def write(tmpname, workspace=workspace):
+                        # NaMaster does not overwrite the temporary file
+                        os.remove(tmpname)
+                        workspace.write_to(tmpname)
+                    _save_atomic(filename, write)
+            w.append(workspace)
+
+        _workspaces[key] = w
+        return list(w)
+
     def compute_master(self, field_a, field_b, workspace):
         """
         Parameters
@@ -211,7 +277,7 @@ class Namaster(object):
             Note that generally it's not a good idea to purify both,
             since you'll lose sensitivity on E
         w: list with Namaster workspace [w00, w22, w02]
-            If None the workspaces will be created.
+            If None the workspaces are obtained from get_workspaces.
         beam_correction: bool, optional
             None by default.
             If True, a correction by the Qubic beam at 150GHz is applied.
@@ -256,20 +322,13 @@ class Namaster(object):
 
         # Make workspaces
         if w is None:
-            w00 = nmt.NmtWorkspace()
-            w00.compute_coupling_matrix(f0, f0bis, b)
-
-            w22 = nmt.NmtWorkspace()
-            w22.compute_coupling_matrix(f2, f2bis, b)
-
-            w02 = nmt.NmtWorkspace()
-            w02.compute_coupling_matrix(f0, f2bis, b)
-            w = [w00, w22, w02]
+            w = self.get_workspaces(f0, f2, b, mask_apo, f0bis=f0bis, f2bis=f2bis,
+                                    purify_e=purify_e, purify_b=purify_b,
+                                    beam_correction=beam_correction)
             self.w = w
-        else:
-            w00 = w[0]
-            w22 = w[1]
-            w02 = w[2]
+        w00 = w[0]
+        w22 = w[1]
+        w02 = w[2]
 
         # Get Cls
         c00 = self.compute_master(f0, f0bis, w00)
@@ -282,14 +341,76 @@ class Namaster(object):
             print('Getting TT, EE, BB, TE spectra in that order.')
 
         if pixwin_correction is True:
-            pwb = self.get_pixwin_correction(nside)
-            spectra[:, 0] /= (pwb[0] ** 2) # TT
-            spectra[:, 1] /= (pwb[1] ** 2) # EE
-            spectra[:, 2] /= (pwb[1] ** 2) # BB
-            spectra[:, 3] /= (pwb[0] * pwb[1]) # TE
+            self._correct_pixwin(spectra, nside)
+
+        return self.ell_binned, spectra, w
+
+    def get_spectra_many(self, maps, pairs=None, mask_apo=None, purify_e=False, purify_b=True,
+                         beam_correction=None, pixwin_correction=False, verbose=True):
+        """
+        Get the spectra and cross-spectra of several IQU maps, such as the sub-band maps
+        of a realization. The fields of each map are built once and all the pairs share
+        the same workspaces.
+        Parameters
+        ----------
+        maps: array
+            IQU maps, shape (#maps, 3, #pixels)
+        pairs: sequence of (int, int), optional
+            The indices of the maps whose (cross-) spectra are computed.
+            By default, all the pairs (i, j) with i <= j.
+        mask_apo, purify_e, purify_b, beam_correction, pixwin_correction, verbose:
+            See get_spectra.
+        Returns
+        -------
+        ell_binned
+        spectra: array of shape (#pairs, #bins, 4)
+            TT, EE, BB, TE spectra of each pair, as returned by get_spectra.
+        w: List containing the NmtWorkspaces [w00, w22, w02]
+
+        """
+        nside = hp.npix2nside(len(maps[0][0]))
+        self.ell_binned, b = self.get_binning(nside)
+
+        if mask_apo is None:
+            mask_apo = self.mask_apo
+
+        if pairs is None:
+            pairs = [(i, j) for i in range(len(maps)) for j in range(i, len(maps))]
+
+        # Get fields, once per map
+        fields = [self.get_fields(m, mask_apo=mask_apo,
+                                  purify_e=purify_e,
+                                  purify_b=purify_b,
+                                  beam_correction=beam_correction) for m in maps]
+
+        w = self.get_workspaces(fields[0][0], fields[0][1], b, mask_apo,
+                                purify_e=purify_e, purify_b=purify_b,
+                                beam_correction=beam_correction)
+        self.w = w
+
+        spectra = []
+        for i, j in pairs:
+            (f0, f2), (f0bis, f2bis) = fields[i], fields[j]
+            c00 = self.compute_master(f0, f0bis, w[0])
+            c22 = self.compute_master(f2, f2bis, w[1])
+            c02 = self.compute_master(f0, f2bis, w[2])
+            spectra.append(np.array([c00[0], c22[0], c22[3], c02[0]]).T)
+        spectra = np.array(spectra)
+        if verbose:
+            print('Getting TT, EE, BB, TE spectra in that order.')
+
+        if pixwin_correction is True:
+            self._correct_pixwin(spectra, nside)
 
         return self.ell_binned, spectra, w
 
+    def _correct_pixwin(self, spectra, nside):
+        pwb = self.get_pixwin_correction(nside)
+        spectra[..., 0] /= (pwb[0] ** 2) # TT
+        spectra[..., 1] /= (pwb[1] ** 2) # EE
+        spectra[..., 2] /= (pwb[1] ** 2) # BB
+        spectra[..., 3] /= (pwb[0] * pwb[1]) # TE
+
     def get_pixwin_correction(self, nside):
         """Return the binned pixel window function multiplied by 2pi/(l(l+1))
         for temperature and polarization """
@@ -437,3 +558,4 @@ class Namaster(object):
         # covar_TB_TB = covar_02_02[:, 1, :, 1]
 
         return covar_TE_TE
+
@@ -8,14 +8,19 @@ import pysm3.units as u
 from pysm3 import utils
 from pylab import *
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
 import pickle
 
 import qubic
 from qubic import camb_interface as qc
 from qubic import fibtools as ft
-from qubic.utils import progress_bar
+from qubic.utils import _LRUCache, _save_atomic, progress_bar
 
-__all__ = ['sky', 'Qubic_sky']
+__all__ = ['sky', 'Qubic_sky', 'read_fastsim_data', 'save_fastsim_data']
+
+# FastSimulator data loaded by read_fastsim_data, the least recently used entries are dropped
+_FASTSIM_CACHE_SIZE = 32
+_fastsim_data = _LRUCache(_FASTSIM_CACHE_SIZE)
 
 
 def cov2corr(mat):
@@ -365,7 +370,7 @@ class Qubic_sky(sky):
                                        Nyears=4., FWHMdeg=None, seed=None,
                                        noise_profile=True, spatial_noise=True, nunu_correlation=True,
                                        noise_only=False, integrate_into_band=True,
-                                       verbose=False, noise_covcut=0.1):
+                                       verbose=False, noise_covcut=0.1, realization=0):
         """
         This returns maps in the same way as with get_simple_sky_map but cut according to the coverage
         and with noise added according to this coverage and the RMS in muK.sqrt(sec) given by sigma_sec
@@ -391,6 +396,7 @@ class Qubic_sky(sky):
             Integration time for observation to scale the noise, by default it is 4.
         FWHMdeg:
         seed:
+            Seed of the noise realizations, see create_noise_maps.
         noise_profile:
         spatial_noise: bool
             If True, spatial noise correlations are added. True by default.
@@ -401,6 +407,8 @@ class Qubic_sky(sky):
         integrate_into_band: bool
             If True, averaging input sub-band maps into reconstruction sub-bands. True by default.
         verbose: bool
+        realization: int
+            Index of the noise realization for a given seed, see create_noise_maps.
 
         Returns
         -------
@@ -447,23 +455,17 @@ class Qubic_sky(sky):
         ##############################################################################################################
         # Restore data for FastSimulation ############################################################################
         ##############################################################################################################
-        #### Directory for fast simulations
-        dir_fast = os.path.join(os.path.dirname(__file__), 'data', f'FastSimulator_version{version_FastSim}')
         #### Integration time assumed in FastSim files
         fastsimfile_effective_duration = 2.
 
-        with open(dir_fast + os.sep + 'DataFastSimulator_{}{}_nfsub_{}.pkl'.format(self.dictionary['config'],
-                                                                          str(self.filter_nu),
-                                                                          self.Nfout),
-                  "rb") as file:
-            DataFastSim = pickle.load(file)
-            print(file)
+        DataFastSim = read_fastsim_data(self.dictionary['config'], self.filter_nu, self.Nfout,
+                                        version_FastSim=version_FastSim)
         # Read Coverage map
         if coverage is None:
-            DataFastSimCoverage = pickle.load(open(dir_fast + os.sep + 'DataFastSimulator_{}{}_coverage.pkl'.format(
-                                                       self.dictionary['config'],
-                                                       str(self.filter_nu)), "rb"))
-            coverage = DataFastSimCoverage['coverage']
+            DataFastSimCoverage = read_fastsim_data(self.dictionary['config'], self.filter_nu,
+                                                    version_FastSim=version_FastSim)
+            # the cached coverage is read-only and the unseen pixels are set to zero below
+            coverage = np.array(DataFastSimCoverage['coverage'])
         # Read noise normalization
         if sigma_sec is None:
             #### Beware ! Initial End-To-End simulations that produced the first FastSimulator were done with
@@ -505,7 +507,7 @@ class Qubic_sky(sky):
                                            effective_variance_invcov=effective_variance_invcov,
                                            clnoise=clnoise,
                                            sub_bands_cov=sub_bands_cov,
-                                           covcut=noise_covcut)
+                                           covcut=noise_covcut, realization=realization)
         if self.Nfout == 1:
             noisemaps = np.reshape(noisemaps, (1, len(coverage), 3))
         seenpix = noisemaps[0, :, 0] != 0
@@ -521,7 +523,7 @@ class Qubic_sky(sky):
                           Nyears=4, verbose=False, seed=None,
                           effective_variance_invcov=None,
                           clnoise=None,
-                          sub_bands_cov=None):
+                          sub_bands_cov=None, realization=0):
 
         """
         This returns a realization of noise maps for I, Q and U with no correlation between them, according to a
@@ -541,8 +543,13 @@ class Qubic_sky(sky):
         coverage
         Nyears
         verbose
-        seed
+        seed: int
+            Seed of the noise realizations. If None, it is drawn from the global numpy generator, so that
+            a new realization is drawn at each call.
         effective_variance_invcov
+        realization: int
+            Index of the noise realization for a given seed. The random numbers of each sub-band are drawn
+            from a Philox generator keyed by (seed, realization, sub-band).
 
         Returns
         -------
@@ -602,35 +609,28 @@ class Qubic_sky(sky):
                     thnoiseQ[isub, seenpix] = ideal_noise_Q[seenpix] * np.sqrt(correctionQU)
                     thnoiseU[isub, seenpix] = ideal_noise_U[seenpix] * np.sqrt(correctionQU)
 
-        noise_maps = np.zeros((nsub, len(coverage), 3))
-        if seed is not None:
-            np.random.seed(seed)
-
-        ### Simulate variance 1 maps for each sub-band independently
-        for isub in range(nsub):
-            if clnoise is None:
-                ### With no sspatial correlation
-                if verbose:
-                    if isub == 0:
-                        print('Simulating noise maps with no spatial correlation')
-                IrndFull = np.random.randn(self.npix)
-                QrndFull = np.random.randn(self.npix) * np.sqrt(2)
-                UrndFull = np.random.randn(self.npix) * np.sqrt(2)
-            else:
-                ### With spatial correlations given by cl which is the Legendre transform of the targetted C(theta)
-                ### NB: here one should not expect the variance of the obtained maps to make complete sense because
-                ### of ell space truncation. They have however the correct Cl spectrum in the relevant ell range 
-                ### (up to lmax = 2*nside)
-                if verbose:
-                    if isub == 0:
-                        print('Simulating noise maps with spatial correlation')
-                IrndFull = qc.simulate_correlated_map(self.nside, 1., clin=clnoise, verbose=False)
-                QrndFull = qc.simulate_correlated_map(self.nside, 1., clin=clnoise, verbose=False) * np.sqrt(2)
-                UrndFull = qc.simulate_correlated_map(self.nside, 1., clin=clnoise, verbose=False) * np.sqrt(2)
-            ### put them into the whole sub-bandss array
-            noise_maps[isub, seenpix, 0] = IrndFull[seenpix]
-            noise_maps[isub, seenpix, 1] = QrndFull[seenpix]
-            noise_maps[isub, seenpix, 2] = UrndFull[seenpix]
+        ### Simulate variance 1 maps for each sub-band independently, each of them with its own random
+        ### stream keyed by (seed, realization, sub-band), so that the realizations can be drawn in any
+        ### order or in distinct processes and still be identical. Without seed, it is drawn from the global
+        ### generator, so that np.random.seed still makes the realization reproducible
+        if seed is None:
+            seed = np.random.randint(2**32)
+        rngs = [_get_noise_rng(seed, realization, isub) for isub in range(nsub)]
+        if clnoise is None:
+            ### With no spatial correlation, only the seen pixels are drawn
+            if verbose:
+                print('Simulating noise maps with no spatial correlation')
+            noise = np.array([rng.standard_normal((npix, 3)) for rng in rngs])
+        else:
+            ### With spatial correlations given by cl which is the Legendre transform of the targetted C(theta)
+            ### NB: here one should not expect the variance of the obtained maps to make complete sense because
+            ### of ell space truncation. They have however the correct Cl spectrum in the relevant ell range
+            ### (up to lmax = 2*nside). The I, Q, U maps of all the sub-bands are computed by a single alm2map.
+            if verbose:
+                print('Simulating noise maps with spatial correlation')
+            noise = _simulate_correlated_maps(self.nside, clnoise, rngs)[..., seenpix]
+            noise = np.moveaxis(noise, 1, 2)
+        noise[..., 1:] *= np.sqrt(2)
 
         ### If there is non-diagonal noise covariance between sub-bands (spectro-imaging case)
         if nsub > 1:
@@ -640,26 +640,16 @@ class Qubic_sky(sky):
                 ### We get the eigenvalues and eigenvectors of the sub-band covariance matrix divided by its 0,0 element
                 ### The reason for this si that the overall  noise is given by the input parameter sigma_sec which we do not
                 ### want to override
-
-                wI, vI = np.linalg.eig(sub_bands_cov[0] / sub_bands_cov[0][0, 0])
-                wQ, vQ = np.linalg.eig(sub_bands_cov[1] / sub_bands_cov[1][0, 0])
-                wU, vU = np.linalg.eig(sub_bands_cov[2] / sub_bands_cov[2][0, 0])
-
-                ### Multiply the maps by the sqrt(eigenvalues)
-                for isub in range(nsub):
-                    noise_maps[isub, seenpix, 0] *= np.sqrt(wI[isub])
-                    noise_maps[isub, seenpix, 1] *= np.sqrt(wQ[isub])
-                    noise_maps[isub, seenpix, 2] *= np.sqrt(wU[isub])
-                ### Apply the rotation to each Stokes Parameter separately
-
-                noise_maps[:, seenpix, 0] = np.dot(vI, noise_maps[:, seenpix, 0])
-                noise_maps[:, seenpix, 1] = np.dot(vQ, noise_maps[:, seenpix, 1])
-                noise_maps[:, seenpix, 2] = np.dot(vU, noise_maps[:, seenpix, 2])
+                ### The maps are multiplied by the sqrt(eigenvalues) and the rotation is applied to each Stokes
+                ### parameter separately
+                for istokes in range(3):
+                    w, v = np.linalg.eig(sub_bands_cov[istokes] / sub_bands_cov[istokes][0, 0])
+                    noise[..., istokes] = np.dot(v, np.sqrt(w)[:, None] * noise[..., istokes]).real
 
         # Now normalize the maps with the coverage behaviour and the sqrt(2) for Q and U
-        noise_maps[:, seenpix, 0] *= thnoiseI[:, seenpix]
-        noise_maps[:, seenpix, 1] *= thnoiseQ[:, seenpix]
-        noise_maps[:, seenpix, 2] *= thnoiseU[:, seenpix]
+        noise *= np.stack([thnoiseI[:, seenpix], thnoiseQ[:, seenpix], thnoiseU[:, seenpix]], axis=-1)
+        noise_maps = np.zeros((nsub, len(coverage), 3))
+        noise_maps[:, seenpix, :] = noise
 
         if nsub == 1:
             return noise_maps[0, :, :]
@@ -709,6 +699,136 @@ class Qubic_sky(sky):
         return Sigpix
 
 
+
+def read_fastsim_data(config, filter_nu, nfsub=None, version_FastSim='01', mmap_mode='r'):
+    """
+    Return the FastSimulator data of a configuration: the noise model for nfsub reconstructed
+    sub-bands, or the coverage map if nfsub is None. The data are read once and kept in a cache
+    shared by all the Qubic_sky instances. If a directory of .npy files exists next to the .pkl file
+    (see save_fastsim_data), its arrays are memory-mapped, so that they are shared between processes.
+    Otherwise the .pkl file is read. The cached arrays are read-only.
+
+    Parameters
+    ----------
+    config: str
+        Instrument configuration, 'FI' or 'TD'.
+    filter_nu: int
+        Central frequency in GHz.
+    nfsub: int
+        Number of reconstructed sub-bands. If None, the coverage data are returned.
+    version_FastSim: str
+        Version of the FastSimulator files.
+    mmap_mode: str
+        Memory-map mode of the arrays in the .npy files. If None, the arrays are read in memory.
+
+    Returns
+    -------
+    data: dict
+
+    """
+    key = config, int(filter_nu), nfsub, version_FastSim, mmap_mode
+    try:
+        data = _fastsim_data[key]
+    except KeyError:
+        dir_fast = os.path.join(os.path.dirname(__file__), 'data', f'FastSimulator_version{version_FastSim}')
+        if nfsub is None:
+            name = 'DataFastSimulator_{}{}_coverage'.format(config, int(filter_nu))
+        else:
+            name = 'DataFastSimulator_{}{}_nfsub_{}'.format(config, int(filter_nu), nfsub)
+        filename = os.path.join(dir_fast, name)
+        if os.path.isdir(filename):
+            data = _load_npy_directory(filename, mmap_mode=mmap_mode)
+        else:
+            with open(filename + '.pkl', 'rb') as file:
+                data = pickle.load(file)
+            for value in data.values():
+                if isinstance(value, np.ndarray):
+                    value.flags.writeable = False
+        _fastsim_data[key] = data
+    return data
+
+
+def save_fastsim_data(data, dirname):
+    """
+    Save FastSimulator data, as stored in the .pkl files, in a directory with one .npy file per
+    entry, whose arrays can be memory-mapped by read_fastsim_data. Each file is written through
+    a temporary file, so that an interrupted run does not leave truncated files.
+
+    Parameters
+    ----------
+    data: dict
+        Arrays and scalars, the lists of arrays are saved as arrays and restored as lists.
+    dirname: str
+        Name of the directory, which is the name of the .pkl file without its extension.
+
+    """
+    lists = [k for k, v in data.items() if isinstance(v, list)]
+    arrays = [('_lists', np.array(lists, dtype=str))] + [(k, np.asarray(v)) for k, v in data.items()]
+    for k, v in arrays:
+        _save_atomic(os.path.join(dirname, k + '.npy'), lambda tmpname: np.save(tmpname, v))
+
+
+def _load_npy_directory(dirname, mmap_mode=None):
+    """
+    Read the .npy files of a directory written by save_fastsim_data. The arrays are
+    memory-mapped if mmap_mode is not None.
+    """
+    data = {}
+    for filename in os.listdir(dirname):
+        if not filename.endswith('.npy'):
+            continue
+        path = os.path.join(dirname, filename)
+        try:
+            data[filename[:-4]] = np.load(path, mmap_mode=mmap_mode)
+        except ValueError:
+            # the arrays of Python objects cannot be memory-mapped
+            data[filename[:-4]] = np.load(path, allow_pickle=True)
+    lists = data.pop('_lists', ())
+    for name in list(data):
+        if data[name].ndim == 0:
+            data[name] = data[name].item()
+            continue
+        data[name].flags.writeable = False
+        if name in lists:
+            data[name] = list(data[name])
+    return data
+
+
+def _get_noise_rng(seed, realization, band):
+    """
+    Return the counter-based random generator of a noise realization in a sub-band.
+    """
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence([seed, realization, band])))
+
+
+def _simulate_correlated_maps(nside, clin, rngs, lmax_nside=2.):
+    """
+    Return I, Q, U maps of unit variance with the spatial correlations given by clin, as
+    camb_interface.simulate_correlated_map, for each of the random generators. The alms are
+    drawn as by hp.synalm and all the maps are computed by a single alm2map call.
+
+    Returns
+    -------
+    maps: array of shape (len(rngs), 3, npix)
+    """
+    lmax = int(lmax_nside * nside)
+    npix = 12 * nside ** 2
+    clth = clin[0:lmax + 1] / clin[0]
+    ell, m = hp.Alm.getlm(lmax)
+    alm_size = len(ell)
+    # the real and imaginary parts have a variance of cl / 2, except for m = 0
+    rms = np.sqrt(clth[ell] / 2)
+    rms[m == 0] *= np.sqrt(2)
+    alms = np.empty((len(rngs), 3, alm_size), complex)
+    for rng, alm in zip(rngs, alms):
+        rnd = rng.standard_normal((3, 2, alm_size))
+        rnd[:, 1, m == 0] = 0
+        alm.real = rnd[:, 0] * rms
+        alm.imag = rnd[:, 1] * rms
+    maps = hp.alm2map(alms.reshape(-1, alm_size), nside, lmax=lmax, pol=False)
+    return np.reshape(maps, (len(rngs), 3, npix)) * np.sqrt(4 * np.pi / npix)
+
+
 def random_string(nchars):
     lst = [rd.choice(string.ascii_letters + string.digits) for n in range(nchars)]
     str = "".join(lst)
@@ -878,43 +998,18 @@ def flatten_noise(maps, coverage, nbins=20, doplot=False, normalize_all=False, Q
         return out_maps, all_fitcov, all_norm_noise
 
 
-def map_corr_neighbtheta(themap_in, ipok_in, thetamin, thetamax, nbins, degrade=None, verbose=True):
+def _degrade_seen_map(themap_in, ipok_in, degrade):
     if degrade is None:
-        themap = themap_in.copy()
-        ipok = ipok_in.copy()
-    else:
-        themap = hp.ud_grade(themap_in, degrade)
-        mapbool = themap_in < -1e30
-        mapbool[ipok_in] = True
-        mapbool = hp.ud_grade(mapbool, degrade)
-        ip = np.arange(12 * degrade ** 2)
-        ipok = ip[mapbool]
-    rthmin = np.radians(thetamin)
-    rthmax = np.radians(thetamax)
-    thvals = np.linspace(rthmin, rthmax, nbins + 1)
-    ns = hp.npix2nside(len(themap))
-    thesum = np.zeros(nbins)
-    thesum2 = np.zeros(nbins)
-    thecount = np.zeros(nbins)
-    if verbose: bar = progress_bar(len(ipok), 'Pixels')
-    for i in range(len(ipok)):
-        if verbose: bar.update()
-        valthis = themap[ipok[i]]
-        v = hp.pix2vec(ns, ipok[i])
-        # ipneighb_inner = []
-        ipneighb_inner = list(hp.query_disc(ns, v, np.radians(thetamin)))
-        for k in range(nbins):
-            thmin = thvals[k]
-            thmax = thvals[k + 1]
-            ipneighb_outer = list(hp.query_disc(ns, v, thmax))
-            ipneighb = ipneighb_outer.copy()
-            for l in ipneighb_inner: ipneighb.remove(l)
-            valneighb = themap[ipneighb]
-            thesum[k] += np.sum(valthis * valneighb)
-            thesum2[k] += np.sum((valthis * valneighb) ** 2)
-            thecount[k] += len(valneighb)
-            ipneighb_inner = ipneighb_outer.copy()
+        return themap_in.copy(), ipok_in.copy()
+    themap = hp.ud_grade(themap_in, degrade)
+    mapbool = themap_in < -1e30
+    mapbool[ipok_in] = True
+    mapbool = hp.ud_grade(mapbool, degrade)
+    ip = np.arange(12 * degrade ** 2)
+    return themap, ip[mapbool]
+
 
+def _corr_from_pair_sums(thesum, thesum2, thecount, thvals):
     mm = thesum / thecount
     mm2 = thesum2 / thecount
     errs = np.sqrt(mm2 - mm ** 2) / np.sqrt(np.sqrt(thecount))
@@ -923,6 +1018,89 @@ def map_corr_neighbtheta(themap_in, ipok_in, thetamin, thetamax, nbins, degrade=
     return mythetas, corrfct, errs
 
 
+def map_corr_neighbtheta(themap_in, ipok_in, thetamin, thetamax, nbins, degrade=None, verbose=True):
+    """
+    Angular correlation function of a map, averaged over the pairs made of one pixel in ipok and any
+    pixel of the map whose centers are separated by an angle in each of the nbins bins between thetamin
+    and thetamax (in degrees). The weighted pair counts are computed by a KD-tree over the pixel unit
+    vectors.
+
+    Returns
+    -------
+    thetas, ctheta, errors
+
+    """
+    themap, ipok = _degrade_seen_map(themap_in, ipok_in, degrade)
+    rthmin = np.radians(thetamin)
+    rthmax = np.radians(thetamax)
+    thvals = np.linspace(rthmin, rthmax, nbins + 1)
+    ns = hp.npix2nside(len(themap))
+    if verbose:
+        print('Counting pairs of {} pixels at nside={}'.format(len(ipok), ns))
+    vecs = np.array(hp.pix2vec(ns, np.arange(len(themap)))).T
+    tree_all = cKDTree(vecs)
+    tree_ok = cKDTree(vecs[ipok])
+    # pixel centers within an angle theta are within a chord 2 sin(theta/2)
+    chords = 2 * np.sin(thvals / 2)
+    sums = []
+    for weights in themap, themap ** 2, np.ones(len(themap)):
+        counts = tree_ok.count_neighbors(tree_all, chords, weights=(weights[ipok], weights), cumulative=True)
+        if thvals[0] == 0:
+            # the pixels themselves belong to the first bin
+            counts[0] = 0
+        sums.append(np.diff(counts))
+    return _corr_from_pair_sums(sums[0], sums[1], sums[2], thvals)
+
+
+def map_corr_harmonic(themap_in, ipok_in, thetamin, thetamax, nbins, degrade=None, lmax=None):
+    """
+    Same as map_corr_neighbtheta, but the sums over the pairs of pixels are computed in harmonic space
+    from the cross-spectra of the masked and full maps (and of their squares), integrated over the bins
+    of Legendre polynomials. It is an approximation of the exact pair counts: the pixels are treated as
+    points and the spectra are truncated at lmax, so that the pairs near the bin edges are not shared
+    exactly as in map_corr_neighbtheta. The error on C(theta) is of the order of 10% of C(0) for bins
+    one pixel wide, a few percents for two pixels and below 1% for bins wider than about four pixels.
+    It is meant for fast estimates on maps with many pixels, with bins much wider than the pixels.
+
+    Parameters
+    ----------
+    lmax: int
+        Maximum multipole of the spectra, by default 3 * nside.
+
+    Returns
+    -------
+    thetas, ctheta, errors
+
+    """
+    themap, ipok = _degrade_seen_map(themap_in, ipok_in, degrade)
+    thvals = np.radians(np.linspace(thetamin, thetamax, nbins + 1))
+    npix = len(themap)
+    if lmax is None:
+        lmax = 3 * hp.npix2nside(npix) - 1
+    mask = np.zeros(npix)
+    mask[ipok] = 1
+    alms = hp.map2alm(np.array([themap * mask, themap ** 2 * mask, mask, themap, themap ** 2, np.ones(npix)]),
+                      lmax=lmax, iter=0, pol=False)
+    cls = np.array([hp.alm2cl(alms[k], alms[k + 3]) for k in range(3)])
+
+    # Integrals of the Legendre polynomials between the bin edges
+    mu = np.cos(thvals)
+    pl = np.zeros((lmax + 2, len(mu)))
+    pl[0] = 1
+    pl[1] = mu
+    for l in range(1, lmax + 1):
+        pl[l + 1] = ((2 * l + 1) * mu * pl[l] - l * pl[l - 1]) / (l + 1)
+    ell = np.arange(lmax + 1)
+    primitive = np.empty((lmax + 1, len(mu)))
+    primitive[0] = mu
+    primitive[1:] = (pl[2:] - pl[:-2]) / (2 * ell[1:, None] + 1)
+    binned_pl = 2 * np.pi * (primitive[:, :-1] - primitive[:, 1:])
+
+    # The alms of the pixel values are those of a sum of Dirac at the pixel centers times 4pi/npix
+    sums = (npix / (4 * np.pi)) ** 2 * np.dot(cls * (2 * ell + 1), binned_pl)
+    return _corr_from_pair_sums(sums[0], sums[1], sums[2], thvals)
+
+
 def get_angles(ip0, ips, ns):
     v = np.array(hp.pix2vec(ns, ip0))
     vecs = np.array(hp.pix2vec(ns, ips))
@@ -931,7 +1109,21 @@ def get_angles(ip0, ips, ns):
 
 
 def ctheta_parts(themap, ipok, thetamin, thetamax, nbinstot, nsplit=4, degrade_init=None,
-                 verbose=True):
+                 verbose=True, method='pairs', lmax=None):
+    """
+    Angular correlation function of a map between thetamin and thetamax (in degrees) in nbinstot bins.
+
+    With method='pairs' (default), the pairs of pixels are counted exactly by map_corr_neighbtheta, the
+    bins being split into nsplit parts computed at nside degraded by a factor 2 for each part. With
+    method='harmonic', all the bins are computed at once with map_corr_harmonic at nside degrade_init
+    (the nside of the map by default) and nsplit is not used. This is much faster, but approximate:
+    the bins must be a few pixels wide, see map_corr_harmonic.
+
+    Returns
+    -------
+    thetas, ctheta, errors
+
+    """
     allthetalims = np.linspace(thetamin, thetamax, nbinstot + 1)
     thmin = allthetalims[:-1]
     thmax = allthetalims[1:]
@@ -944,20 +1136,29 @@ def ctheta_parts(themap, ipok, thetamin, thetamax, nbinstot, nsplit=4, degrade_i
     thall = np.zeros(nbinstot)
     cthall = np.zeros(nbinstot)
     errcthall = np.zeros(nbinstot)
-    for k in range(nsplit):
-        thispart = idx == k
-        mythmin = np.min(thmin[thispart])
-        mythmax = np.max(thmax[thispart])
-        mynbins = nbinstot // nsplit
-        mynside = nside_init // (2 ** k)
+    if method == 'harmonic':
         if verbose: print(
-            'Doing {0:3.0f} bins between {1:5.2f} and {2:5.2f} deg at nside={3:4.0f}'.format(mynbins, mythmin, mythmax,
-                                                                                             mynside))
-        myth, mycth, errs = map_corr_neighbtheta(themap, ipok, mythmin, mythmax, mynbins, degrade=mynside,
-                                                 verbose=verbose)
-        cthall[thispart] = mycth
-        errcthall[thispart] = errs
-        thall[thispart] = myth
+            'Doing {0:3.0f} bins between {1:5.2f} and {2:5.2f} deg at nside={3:4.0f}'.format(nbinstot, thetamin,
+                                                                                             thetamax, nside_init))
+        _, cthall, errcthall = map_corr_harmonic(themap, ipok, thetamin, thetamax, nbinstot,
+                                                 degrade=degrade_init, lmax=lmax)
+    elif method == 'pairs':
+        for k in range(nsplit):
+            thispart = idx == k
+            mythmin = np.min(thmin[thispart])
+            mythmax = np.max(thmax[thispart])
+            mynbins = nbinstot // nsplit
+            mynside = nside_init // (2 ** k)
+            if verbose: print(
+                'Doing {0:3.0f} bins between {1:5.2f} and {2:5.2f} deg at nside={3:4.0f}'.format(mynbins, mythmin,
+                                                                                                 mythmax, mynside))
+            myth, mycth, errs = map_corr_neighbtheta(themap, ipok, mythmin, mythmax, mynbins, degrade=mynside,
+                                                     verbose=verbose)
+            cthall[thispart] = mycth
+            errcthall[thispart] = errs
+            thall[thispart] = myth
+    else:
+        raise ValueError("Invalid method '{}'. Expected values are 'pairs' or 'harmonic'.".format(method))
 
         ### One could also calculate the average of the distribution of pixels within the ring instead of the simplistic thetas
     dtheta = allthetalims[1] - allthetalims[0]
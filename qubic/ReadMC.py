@@ -5,6 +5,7 @@ import healpy as hp
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
+from pyoperators.utils import pool_threading
 
 
 # =============== Save a simulation ==================
@@ -120,16 +121,18 @@ def get_patch(file, seenmap):
 
         """
 
-    maps_recon, maps_convo, diff = get_maps(file)
+    # Only the seen pixels are read from the memory-mapped file
+    with fits.open(file, memmap=True) as simu:
+        maps_recon_cut = np.array(simu['MAPS_RECON'].data[:, seenmap, :])
+        maps_convo_cut = np.array(simu['MAPS_CONVOLVED'].data[:, seenmap, :])
 
-    maps_recon_cut = maps_recon[:, seenmap, :]
-    maps_convo_cut = maps_convo[:, seenmap, :]
-    diff_cut = diff[:, seenmap, :]
+    diff_cut = maps_recon_cut - maps_convo_cut
 
     return maps_recon_cut, maps_convo_cut, diff_cut
 
 
-def get_patch_many_files(rep_simu, name, badval=-1.6375e+30, rtol=1e-05, atol=1e-08, verbose=True):
+def get_patch_many_files(rep_simu, name, badval=-1.6375e+30, rtol=1e-05, atol=1e-08, verbose=True,
+                         nthreads=1):
     """
     Get all the patches you want to analyze from many fits files.
     Parameters
@@ -145,6 +148,8 @@ def get_patch_many_files(rep_simu, name, badval=-1.6375e+30, rtol=1e-05, atol=1e
     atol : float
         Absolute tolerance for badval
     verbose: bool
+    nthreads : int
+        Number of files read in parallel.
     Returns
     -------
     A list with the names of all the files you took.
@@ -163,8 +168,8 @@ def get_patch_many_files(rep_simu, name, badval=-1.6375e+30, rtol=1e-05, atol=1e
     all_patch_convo = []
     all_patch_diff = []
 
-    for i, fits in enumerate(all_fits):
-        patch_recon, patch_convo, patch_diff = get_patch(fits, seenmap)
+    for i, (_, patch_recon, patch_convo, patch_diff) in enumerate(
+            iter_patch_many_files(all_fits, seenmap, nthreads=nthreads)):
         if i == 0:
             right_shape = patch_recon.shape
         else:
@@ -178,6 +183,96 @@ def get_patch_many_files(rep_simu, name, badval=-1.6375e+30, rtol=1e-05, atol=1e
            np.asarray(all_patch_convo), np.asarray(all_patch_diff)
 
 
+def iter_patch_many_files(all_fits, seenmap, nthreads=1):
+    """
+    Iterate over the patches of many fits files, reading only the seen pixels.
+    Only nthreads files are held in memory at a time.
+    Parameters
+    ----------
+    all_fits : list
+        Names of the fits files.
+    seenmap : array
+        Array of booleans of shape #pixels,
+        True inside the patch and False outside.
+    nthreads : int
+        Number of files read in parallel.
+
+    Yields
+    -------
+    The name of the file, the reconstructed patch, the convolved patch
+    and the difference between both, all with a shape (#subbands, #pixels_seen, 3).
+
+    """
+    def read(file):
+        return (file,) + get_patch(file, seenmap)
+
+    if nthreads == 1:
+        for file in all_fits:
+            yield read(file)
+        return
+
+    with pool_threading(nthreads) as pool:
+        for start in range(0, len(all_fits), nthreads):
+            for out in pool.map(read, all_fits[start:start + nthreads]):
+                yield out
+
+
+def save_patch_many_files(rep_simu, name, filename, badval=-1.6375e+30, rtol=1e-05, atol=1e-08,
+                          nthreads=1, verbose=True):
+    """
+    Same as get_patch_many_files, but the patches are written in a .npy file
+    as they are read, so that the memory used does not depend on the number of files.
+    The returned array is memory-mapped: the AnalysisMC functions can be applied
+    to its elements, get_covcorr_patch reading it by chunks of pixels.
+    Parameters
+    ----------
+    rep_simu : str
+        Repository where the fits files are.
+    name : str
+        Name of the files you are interested in.
+    filename : str
+        Name of the .npy file.
+    badval : float
+        The value of the pixel considered as UNSEEN
+    rtol : float
+        Relative tolerance for badval
+    atol : float
+        Absolute tolerance for badval
+    nthreads : int
+        Number of files read in parallel.
+    verbose: bool
+    Returns
+    -------
+    A list with the names of all the files you took.
+    A read-only memory-mapped array of shape (3, #files, #subbands, #pixels_seen, 3)
+    containing the reconstructed patches, the convolved patches and the difference between both.
+
+    """
+    all_fits = glob.glob(rep_simu + name)
+    nfiles = len(all_fits)
+    if verbose:
+        print('{} files have been found.'.format(nfiles))
+
+    seenmap = get_seenmap(all_fits[0], badval=badval, rtol=rtol, atol=atol)
+
+    store = None
+    for i, (file, patch_recon, patch_convo, patch_diff) in enumerate(
+            iter_patch_many_files(all_fits, seenmap, nthreads=nthreads)):
+        if store is None:
+            right_shape = patch_recon.shape
+            store = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+                                              shape=(3, nfiles) + right_shape)
+        elif patch_recon.shape != right_shape:
+            raise ValueError('You should take maps with identical shapes.')
+        store[0, i] = patch_recon
+        store[1, i] = patch_convo
+        store[2, i] = patch_diff
+    store.flush()
+    del store
+
+    return all_fits, np.load(filename, mmap_mode='r')
+
+
 def get_maps_many_files(rep_simu, name, verbose=True):
     """
     Get all the maps you want to analyze from many fits files.
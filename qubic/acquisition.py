@@ -3,23 +3,36 @@ from __future__ import division, print_function
 
 import healpy as hp
 import numpy as np
+import operator
+import os
+import pickle
 from pyoperators import (
     BlockColumnOperator, BlockDiagonalOperator, BlockRowOperator,
     CompositionOperator, DiagonalOperator, I, IdentityOperator,
-    MPIDistributionIdentityOperator, MPI, proxy_group, ReshapeOperator,
-    rule_manager, pcg)
+    MPIDistributionIdentityOperator, MPI, Operator, ReshapeOperator,
+    SymmetricBandToeplitzOperator, rule_manager, pcg)
+from pyoperators.flags import linear, real
 from pyoperators.utils.mpi import as_mpi
 from pysimulators import Acquisition, FitsArray
+from pysimulators.noises import (
+    _fold_psd, _gaussian_psd_1f, _logloginterp_psd, _psd2invntt, _unfold_psd)
 from pysimulators.interfaces.healpy import (
     HealpixConvolutionGaussianOperator)
 from .data import PATH
 from .calibration import QubicCalibration
 from .samplings import create_random_pointings
+from .utils import _LRUCache, _get_hash, _save_atomic
 
 __all__ = ['PlanckAcquisition',
            'QubicAcquisition',
-           'QubicPlanckAcquisition']
+           'QubicPlanckAcquisition',
+           'SinglePrecisionOperator']
 
+# inverse noise covariance operators already built in this process, with
+# their FFTW plans, the least recently used being discarded first
+_INVNTT_CACHE_SIZE = 8
+_invntt_operators = _LRUCache(_INVNTT_CACHE_SIZE)
+_fftw_wisdom_loaded = set()
 
 
 class QubicAcquisition(Acquisition):
@@ -51,7 +64,8 @@ class QubicAcquisition(Acquisition):
                 If true, the photon noise contribution is included.
             max_nbytes : int or None, optional
                 Maximum number of bytes to be allocated for the acquisition's
-                operator.
+                operator. If it is exceeded, the samplings are split into
+                blocks whose pointing matrices are computed on the fly.
             nprocs_instrument : int, optional
                 For a given sampling slice, number of procs dedicated to
                 the instrument.
@@ -73,6 +87,10 @@ class QubicAcquisition(Acquisition):
                 frequencies) or two-sided (positive and negative frequencies).
             sigma : float
                 Standard deviation of the white noise component.
+            invntt_cache : string, optional
+                Directory in which the band coefficients of the inverse noise
+                covariance matrix and the FFTW wisdom are stored, so that
+                they are reused by later runs.
         """
         block = d['block']
         effective_duration = d['effective_duration']
@@ -97,6 +115,7 @@ class QubicAcquisition(Acquisition):
         self.twosided = twosided
         self.sigma = sigma
         self.forced_sigma = None
+        self.invntt_cache = d.get('invntt_cache')
 
     def get_coverage(self):
         """
@@ -109,8 +128,8 @@ class QubicAcquisition(Acquisition):
         out = H.T(np.ones((len(self.instrument), len(self.sampling))))
         if self.scene.kind != 'I':
             out = out[..., 0].copy()  # to avoid keeping QU in memory
-        ndetectors = self.comm.allreduce(len(self.instrument))
-        nsamplings = self.comm.allreduce(len(self.sampling))
+        ndetectors = self.instrument.detector.comm.allreduce(len(self.instrument))
+        nsamplings = self.sampling.comm.allreduce(len(self.sampling))
         out *= ndetectors * nsamplings * self.sampling.period / np.sum(out)
         return out
 
@@ -132,7 +151,7 @@ class QubicAcquisition(Acquisition):
         out = self.instrument.get_noise(
             self.sampling, self.scene, photon_noise=self.photon_noise, out=out)
         if self.effective_duration is not None:
-            nsamplings = self.comm.allreduce(len(self.sampling))
+            nsamplings = self.sampling.comm.allreduce(len(self.sampling))
             out *= np.sqrt(nsamplings * self.sampling.period /
                            (self.effective_duration * 31557600))
         return out
@@ -156,13 +175,13 @@ class QubicAcquisition(Acquisition):
         """
         return self.instrument.get_convolution_peak_operator(**keywords)
 
-    def get_detector_integration_operator(self):
+    def get_detector_integration_operator(self, dtype=None):
         """
         Integrate flux density in detector solid angles.
         Convert W / sr into W.
 
         """
-        return self.instrument.get_detector_integration_operator()
+        return self.instrument.get_detector_integration_operator(dtype=dtype)
 
     def get_detector_response_operator(self):
         """
@@ -188,13 +207,14 @@ class QubicAcquisition(Acquisition):
         """
         return self.instrument.get_filter_operator()
 
-    def get_hwp_operator(self):
+    def get_hwp_operator(self, dtype=None):
         """
         Return the operator for the bolometer responses.
 
         """
         return BlockDiagonalOperator(
-            [self.instrument.get_hwp_operator(self.sampling[b], self.scene)
+            [self.instrument.get_hwp_operator(self.sampling[b], self.scene,
+                                              dtype=dtype)
              for b in self.block], axisin=1)
 
     def get_diag_invntt_operator(self):
@@ -210,7 +230,7 @@ class QubicAcquisition(Acquisition):
         out = DiagonalOperator(1 / (sigma_detector ** 2 + sigma_photon ** 2), broadcast='rightward',
                                shapein=(len(self.instrument), len(self.sampling)))
         if self.effective_duration is not None:
-            nsamplings = self.comm.allreduce(len(self.sampling))
+            nsamplings = self.sampling.comm.allreduce(len(self.sampling))
             out /= (nsamplings * self.sampling.period / (self.effective_duration * 31557600))
         return out
 
@@ -294,7 +314,7 @@ class QubicAcquisition(Acquisition):
             print(out)
 
             if self.effective_duration is not None:
-                nsamplings = self.comm.allreduce(len(self.sampling))
+                nsamplings = self.sampling.comm.allreduce(len(self.sampling))
                 out /= (nsamplings * self.sampling.period / (self.effective_duration * 31557600))
             return out
 
@@ -305,24 +325,53 @@ class QubicAcquisition(Acquisition):
         while fftsize < nsamples_max:
             fftsize *= 2
 
-        new_bandwidth = sampling_frequency / fftsize
-        if self.bandwidth is not None and self.psd is not None:
-            if self.twosided:
-                self.psd = _fold_psd(self.psd)
-            f = np.arange(fftsize // 2 + 1, dtype=float) * new_bandwidth
-            p = _unfold_psd(_logloginterp_psd(f, self.bandwidth, self.psd))
+        if self.effective_duration is not None:
+            nsamplings = self.sampling.comm.allreduce(len(self.sampling))
+            factor = nsamplings * self.sampling.period / (self.effective_duration * 31557600)
         else:
-            p = _gaussian_psd_1f(fftsize, sampling_frequency, self.sigma, self.instrument.detector.fknee,
-                                 self.instrument.detector.fslope, twosided=True)
-        p[..., 0] = p[..., 1]
-        invntt = _psd2invntt(p, new_bandwidth, self.instrument.detector.ncorr, fftw_flag=fftw_flag)
+            factor = 1
+
+        # the operator only depends on the noise model, not on the pointing
+        key = _get_hash(
+            shapein, fftsize, sampling_frequency, self.sigma,
+            self.instrument.detector.fknee, self.instrument.detector.fslope,
+            self.instrument.detector.ncorr, self.psd, self.bandwidth,
+            self.twosided, factor, fftw_flag)
+        if key in _invntt_operators:
+            return _invntt_operators[key]
+
+        cache = self.invntt_cache
+        filename = None
+        invntt = None
+        if cache is not None:
+            _load_fftw_wisdom(cache)
+            filename = os.path.join(cache, 'invntt_' + key + '.npy')
+            if os.path.exists(filename):
+                invntt = np.load(filename)
+
+        if invntt is None:
+            new_bandwidth = sampling_frequency / fftsize
+            if self.bandwidth is not None and self.psd is not None:
+                if self.twosided:
+                    self.psd = _fold_psd(self.psd)
+                f = np.arange(fftsize // 2 + 1, dtype=float) * new_bandwidth
+                p = _unfold_psd(_logloginterp_psd(f, self.bandwidth, self.psd))
+            else:
+                p = _gaussian_psd_1f(fftsize, sampling_frequency, self.sigma, self.instrument.detector.fknee,
+                                     self.instrument.detector.fslope, twosided=True)
+            p[..., 0] = p[..., 1]
+            invntt = _psd2invntt(p, new_bandwidth, self.instrument.detector.ncorr, fftw_flag=fftw_flag)
+            invntt /= factor
+            if filename is not None:
+                _save_atomic(filename, lambda f: np.save(f, invntt))
 
         print('non diagonal case')
-        if self.effective_duration is not None:
-            nsamplings = self.comm.allreduce(len(self.sampling))
-            invntt /= (nsamplings * self.sampling.period / (self.effective_duration * 31557600))
+        out = SymmetricBandToeplitzOperator(shapein, invntt, fftw_flag=fftw_flag, nthreads=nthreads)
+        if cache is not None:
+            _save_fftw_wisdom(cache)
 
-        return SymmetricBandToeplitzOperator(shapein, invntt, fftw_flag=fftw_flag, nthreads=nthreads)
+        _invntt_operators[key] = out
+        return out
 
     get_invntt_operator.__doc__ = Acquisition.get_invntt_operator.__doc__
 
@@ -341,40 +390,148 @@ class QubicAcquisition(Acquisition):
         nu = self.instrument.filter.nu
         return self.scene.get_unit_conversion_operator(nu)
 
-    def get_operator(self):
+    def get_operator(self, projection=None):
         """
         Return the operator of the acquisition. Note that the operator is only
         linear if the scene temperature is differential (absolute=False).
 
+        Parameters
+        ----------
+        projection : Operator, optional
+            The projection operator, if it has already been computed.
+
+        """
+        response = self.get_detector_response_operator()
+        with rule_manager(inplace=True):
+            H = CompositionOperator([response,
+                                     self._get_power_operator(projection)])
+        if self.scene == 'QU':
+            H = self.get_subtract_grid_operator()(H)
+        return H
+
+    def _get_power_operator(self, projection=None):
+        """
+        Return the operator of the acquisition up to the bolometer responses,
+        i.e. from the scene to the power absorbed by the detectors.
+
+        """
+        if projection is None:
+            projection = self.get_projection_operator()
+        with rule_manager(inplace=True):
+            return CompositionOperator([
+                self._get_detector_operator(), projection,
+                self._get_sky_operator()])
+
+    def _get_detector_operator(self, dtype=None):
+        """
+        Return the operator from the sampled peaks to the power absorbed by
+        the detectors, the bolometer responses excepted. If dtype is
+        specified, the operator parameters are of this type.
+
+        """
+        with rule_manager(inplace=True):
+            return CompositionOperator([
+                self._get_detector_transmission_operator(dtype=dtype),
+                self._get_polarization_operator(dtype=dtype)])
+
+    def _get_detector_transmission_operator(self, dtype=None):
+        """
+        Return the diagonal operator of the instrumental transmission and of
+        the integration in the detector solid angles.
+
+        """
+        integ = self.get_detector_integration_operator(dtype=dtype)
+        trans_inst = self.instrument.get_transmission_operator(dtype=dtype)
+        with rule_manager(inplace=True):
+            return CompositionOperator([trans_inst, integ])
+
+    def _get_polarization_operator(self, dtype=None):
+        """
+        Return the operator of the half-wave plate and of the polarizer grid.
+
+        """
+        polarizer = self.get_polarizer_operator(dtype=dtype)
+        if self.scene.kind == 'I':
+            # the half-wave plate is the identity. It is not composed with the
+            # polarizer, whose homothety would otherwise be upcast to float64
+            return polarizer
+        hwp = self.get_hwp_operator(dtype=dtype)
+        with rule_manager(inplace=True):
+            # the half-wave plate is first combined with the polarizer, since
+            # the rotation operators cannot absorb homotheties
+            return polarizer * hwp
+
+    def _get_sky_operator(self):
+        """
+        Return the operator from the scene to the sky flux density per unit
+        of solid angle, integrated in the filter bandwidth and telescope
+        aperture.
+
         """
         distribution = self.get_distribution_operator()
         temp = self.get_unit_conversion_operator()
         aperture = self.get_aperture_integration_operator()
         filter = self.get_filter_operator()
-        projection = self.get_projection_operator()
-        hwp = self.get_hwp_operator()
-        polarizer = self.get_polarizer_operator()
-        integ = self.get_detector_integration_operator()
-        trans_inst = self.instrument.get_transmission_operator()
         trans_atm = self.scene.atmosphere.transmission
-        response = self.get_detector_response_operator()
-
         with rule_manager(inplace=True):
-            H = CompositionOperator([
-                response, trans_inst, integ, polarizer, hwp * projection,
+            return CompositionOperator([
                 filter, aperture, trans_atm, temp, distribution])
-        if self.scene == 'QU':
-            H = self.get_subtract_grid_operator()(H)
-        return H
 
-    def get_polarizer_operator(self):
+    def get_normal_operator(self, invntt=None, precision='double',
+                            projection=None):
+        """
+        Return the operator H^T N^-1 H of the map-making equations.
+
+        Parameters
+        ----------
+        invntt : Operator, optional
+            The inverse time-time noise correlation matrix N^-1. By default,
+            the one returned by get_invntt_operator is used.
+        precision : 'double' or 'single', optional
+            In single precision, the pointing, half-wave plate and polarizer
+            products are performed on float32 time-ordered data, while the
+            bolometer responses and the noise weighting are kept in double
+            precision. In both cases, the operator maps float64 maps onto
+            float64 maps, so that the solver's vectors, residuals and dot
+            products remain in double precision.
+        projection : Operator, optional
+            The projection operator, if it has already been computed.
+
+        """
+        if precision not in ('double', 'single'):
+            raise ValueError(
+                "Invalid precision '{}'. Expected values are 'double' or 'sin"
+                "gle'.".format(precision))
+        if precision == 'single' and self.scene.kind == 'QU':
+            raise NotImplementedError(
+                'The single precision is not implemented for QU scenes.')
+        if invntt is None:
+            invntt = self.get_invntt_operator()
+        if projection is None:
+            projection = self.get_projection_operator()
+        if precision == 'double':
+            H = self.get_operator(projection=projection)
+            return H.T * invntt * H
+        # the sky operator acts on the maps, it is kept in double precision
+        with rule_manager(inplace=True):
+            P = CompositionOperator([
+                SinglePrecisionOperator(CompositionOperator([
+                    self._get_detector_operator(dtype=np.float32),
+                    projection])),
+                self._get_sky_operator()])
+        response = self.get_detector_response_operator()
+        return P.T * (response.T * invntt * response) * P
+
+    def get_polarizer_operator(self, dtype=None):
         """
         Return operator for the polarizer grid.
 
         """
-        return BlockDiagonalOperator(
-            [self.instrument.get_polarizer_operator(
-                self.sampling[b], self.scene) for b in self.block], axisin=1)
+        # the polarizer does not depend on the samplings, so it is not split
+        # into blocks (the non-contiguous block views would not be handled by
+        # its reshape)
+        return self.instrument.get_polarizer_operator(self.sampling, self.scene,
+                                                      dtype=dtype)
 
     def get_projection_operator(self, verbose=True):
         """
@@ -392,16 +549,8 @@ class QubicAcquisition(Acquisition):
             return BlockColumnOperator(
                 [f(self.sampling[b], self.scene, verbose=verbose)
                  for b in self.block], axisout=1)
-
-        # XXX HACK
-        def callback(i):
-            p = f(self.sampling[self.block[i]], self.scene, verbose=False)
-            return p
-
-        shapeouts = [(len(self.instrument), s.stop - s.start) +
-                     self.scene.shape[1:] for s in self.block]
-        proxies = proxy_group(len(self.block), callback, shapeouts=shapeouts)
-        return BlockColumnOperator(proxies, axisout=1)
+        return ProjectionOnTheFlyOperator(
+            self.instrument, self.sampling, self.scene, self.block)
 
     def get_add_grids_operator(self):
         """ Return operator to add signal from detector pairs. """
@@ -464,11 +613,14 @@ class QubicAcquisition(Acquisition):
         tol = d['tol']
         maxiter = d['maxiter']
         verbose = d['verbose']
+        precision = d.get('precision') or 'double'
 
-        H = self.get_operator()
+        projection = self.get_projection_operator()
+        H = self.get_operator(projection=projection)
         invntt = self.get_invntt_operator()
 
-        A = H.T * invntt * H
+        A = self.get_normal_operator(invntt=invntt, precision=precision,
+                                     projection=projection)
         b = H.T * invntt * tod
 
         preconditioner = self.get_preconditioner(cov)
@@ -485,6 +637,132 @@ class QubicAcquisition(Acquisition):
         return preconditioner
 
 
+@real
+@linear
+class ProjectionOnTheFlyOperator(Operator):
+    """
+    Peak sampling operator whose sparse matrix is computed on the fly for
+    each block of samplings and discarded after use, in the direct and
+    transpose applications. The memory footprint is then set by the largest
+    block instead of by the length of the acquisition.
+
+    """
+    def __init__(self, instrument, sampling, scene, block, **keywords):
+        """
+        Parameters
+        ----------
+        instrument : QubicInstrument
+            The QubicInstrument instance.
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        block : tuple of slices
+            Partition of the samplings.
+
+        """
+        shapein = (len(scene),) + scene.shape[1:]
+        shapeout = (len(instrument), len(sampling)) + scene.shape[1:]
+        Operator.__init__(self, shapein=shapein, shapeout=shapeout,
+                          dtype=instrument.synthbeam.dtype, **keywords)
+        self.instrument = instrument
+        self.sampling = sampling
+        self.scene = scene
+        self.block = block
+
+    def get_block_operator(self, b):
+        """
+        Return the projection operator of the block of samplings b.
+
+        """
+        return self.instrument.get_projection_operator(
+            self.sampling[b], self.scene, verbose=False)
+
+    def direct(self, input, output):
+        for b in self.block:
+            output[:, b] = self.get_block_operator(b)(input)
+
+    def transpose(self, input, output):
+        output[...] = 0
+        for b in self.block:
+            P = self.get_block_operator(b)
+            P.T(np.ascontiguousarray(input[:, b]), output,
+                operation=operator.iadd)
+
+
+@real
+@linear
+class SinglePrecisionOperator(Operator):
+    """
+    Operator applying in single precision an operator on double precision
+    inputs. The inputs are cast into float32 and the outputs are returned in
+    float64, so that the memory traffic inside the operator is halved. The
+    operator should be of dtype float32, for its intermediate values to be
+    computed in single precision. Since the operator is linear, the inputs
+    are normalized before the cast, to avoid float32 overflows and
+    underflows.
+
+    """
+    def __init__(self, operator, **keywords):
+        """
+        Parameters
+        ----------
+        operator : Operator
+            The linear operator to be applied in single precision.
+
+        """
+        Operator.__init__(self, shapein=operator.shapein,
+                          shapeout=operator.shapeout, dtype=np.float64,
+                          **keywords)
+        self.operator = operator
+
+    def direct(self, input, output):
+        _apply_single_precision(self.operator, input, output)
+
+    def transpose(self, input, output):
+        _apply_single_precision(self.operator.T, input, output)
+
+
+def _apply_single_precision(operator, input, output):
+    norm = np.max(np.abs(input))
+    if norm == 0:
+        output[...] = 0
+        return
+    input_ = np.divide(input, norm, out=np.empty(input.shape, np.float32))
+    output[...] = operator(input_)
+    output *= norm
+
+
+def _load_fftw_wisdom(cache):
+    """
+    Import the FFTW wisdom stored in the cache directory, once per process.
+
+    """
+    if cache in _fftw_wisdom_loaded:
+        return
+    _fftw_wisdom_loaded.add(cache)
+    filename = os.path.join(cache, 'fftw_wisdom.pickle')
+    if not os.path.exists(filename):
+        return
+    import pyfftw
+    with open(filename, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+
+
+def _save_fftw_wisdom(cache):
+    """
+    Store the FFTW wisdom accumulated by this process in the cache directory.
+
+    """
+    import pyfftw
+    wisdom = pyfftw.export_wisdom()
+
+    def write(filename):
+        with open(filename, 'wb') as f:
+            pickle.dump(wisdom, f)
+    _save_atomic(os.path.join(cache, 'fftw_wisdom.pickle'), write)
+
+
 class PlanckAcquisition(object):
     def __init__(self, band, scene, true_sky=None, factor=1, fwhm=0, mask=None, convolution_operator=None):
         """
@@ -3,6 +3,7 @@ import qubic.plotters as p
 import qubic.lin_lib as ll
 import qubic.sb_fitting as sbfit
 import qubic
+from pyoperators.utils import pool_threading, split
 from pysimulators import FitsArray
 from qubic.utils import progress_bar
 from qubic import mcmc
@@ -387,12 +388,15 @@ def return_fit_period(period, indata, others=None, verbose=False, template=None)
 #     return timereturn, demodulated, demodulated*0+1
 
 def demodulate_JC(period, indata, indata_src, others=None, verbose=False, template=None, quadrature=False,
-                  remove_noise=False, doplot=False):
+                  remove_noise=False, doplot=False, nthreads=1):
     """
     Proper demodulation with quadrature method as an option: http://web.mit.edu/6.02/www/s2012/handouts/14.pdf
     In the case of quadrature demodulation, the HF noise RMS/sqrt(2) adds to the demodulated.
     The option remove_noise=True
     estimates the HF noise in the TODs and removes it from the estimate in order to attempt to debias.
+    All the detectors are demodulated at once, the low-pass filter over a period being a moving
+    average computed with cumulative sums. With nthreads > 1, blocks of detectors are processed
+    by a pool of threads.
     """
     time = indata[0]
     data = indata[1]
@@ -405,24 +409,23 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
     if quadrature:
         # ## Shift src data by 1/2 period
         data_src_shift = np.interp(time_src - period / 2, time_src, data_src, period=period)
+    else:
+        data_src_shift = None
 
     # ## Now smooth over a period
-    import scipy.signal as scsig
     FREQ_SAMPLING = 1. / (time[1] - time[0])
     size_period = int(FREQ_SAMPLING * period) + 1
-    filter_period = np.ones((size_period,)) / size_period
     demodulated = np.zeros_like(data)
     sh = np.shape(data)
-    # bar=progress_bar(sh[0], 'Filtering Detectors: ')
-    for i in range(sh[0]):
-        # bar.update()
-        if quadrature:
-            demodulated[i, :] = scsig.fftconvolve(
-                (np.sqrt((data[i, :] * data_src) ** 2 + (data[i, :] * data_src_shift) ** 2)) / np.sqrt(2),
-                filter_period, mode='same')
-        else:
-            demodulated[i, :] = scsig.fftconvolve(data[i, :] * data_src,
-                                                  filter_period, mode='same')
+
+    def func(block):
+        demodulated[block] = _demodulate_block(data[block], data_src, data_src_shift, size_period)
+
+    if nthreads == 1:
+        func(slice(None))
+    else:
+        with pool_threading(nthreads) as pool:
+            pool.map(func, list(split(sh[0], nthreads)))
 
     # Remove First and last periods
     nper = 4.
@@ -432,9 +435,7 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
 
     if remove_noise:
         hf_noise = hf_noise_estimate(time, data) / np.sqrt(2)
-        var_diff = np.zeros((sh[0], len(timereturn)))
-        for k in range(sh[0]):
-            var_diff[k, :] = demodulated[k, :] ** 2 - hf_noise[k] ** 2
+        var_diff = demodulated ** 2 - hf_noise[:, None] ** 2
         demodulated = np.sqrt(np.abs(var_diff)) * np.sign(var_diff)
 
     if doplot:
@@ -466,8 +467,45 @@ def demodulate_JC(period, indata, indata_src, others=None, verbose=False, templa
     return timereturn, demodulated, demodulated * 0 + 1
 
 
+def _demodulate_block(data, data_src, data_src_shift, size_period):
+    """
+    Multiply the detector timelines by the source reference, or by its
+    quadrature components, and average them over a period.
+    """
+    if data_src_shift is None:
+        demod = data * data_src
+    else:
+        demod = np.sqrt((data * data_src) ** 2 + (data * data_src_shift) ** 2) / np.sqrt(2)
+    return moving_average(demod, size_period)
+
+
+def moving_average(data, size):
+    """
+    Return the average of the data over a window of size samples along the
+    last axis, with the same output as
+        scsig.fftconvolve(data, np.ones(size) / size, mode='same')
+    i.e. the data being padded with zeros, but computed with cumulative sums.
+    """
+    data = np.asarray(data)
+    n = data.shape[-1]
+    cumsum = np.empty(data.shape[:-1] + (n + 1,))
+    cumsum[..., 0] = 0
+    np.cumsum(data, axis=-1, out=cumsum[..., 1:])
+    # the window of the j-th output sample is [j + half + 1 - size, j + half]
+    half = (size - 1) // 2
+    nfull = max(n - half, 0)
+    out = np.empty(data.shape)
+    out[..., :nfull] = cumsum[..., half + 1:]
+    out[..., nfull:] = cumsum[..., n:]
+    start = size - half - 1
+    if start < n:
+        out[..., start:] -= cumsum[..., :n - start]
+    out /= size
+    return out
+
+
 def demodulate_methods(data_in, fmod, fourier_cuts=None, verbose=False, src_data_in=None, method='demod',
-                       others=None, template=None, remove_noise=False):
+                       others=None, template=None, remove_noise=False, nthreads=1):
     """
     Various demodulation methods
     Others is a list of other vectors (with similar time sampling as the data to demodulate)
@@ -479,6 +517,7 @@ def demodulate_methods(data_in, fmod, fourier_cuts=None, verbose=False, src_data
     If highcut is given but lowcut = None, a lowpass filter at f_cut = highcut is applied.
     If none of them is given, no cut frequency filter is applied.
     In any case notch filter can still be used. If notch = None, notch filter is not applied.
+    With the demod methods, nthreads is the number of threads over which the detectors are split.
     """
     if fourier_cuts is None:
         # Duplicate the input data
@@ -511,10 +550,11 @@ def demodulate_methods(data_in, fmod, fourier_cuts=None, verbose=False, src_data
     elif method == 'fit':
         return return_fit_period(period, data, others=others, verbose=verbose, template=template)
     elif method == 'demod':
-        return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None)
+        return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None,
+                             nthreads=nthreads)
     elif method == 'demod_quad':
         return demodulate_JC(period, data, src_data, others=others, verbose=verbose, template=None,
-                             quadrature=True, remove_noise=remove_noise)
+                             quadrature=True, remove_noise=remove_noise, nthreads=nthreads)
     elif method == 'absolute_value':
         return np.abs(data)
 
@@ -175,6 +175,30 @@ class MyChi2_nocov:
                 
 
 
+class MyChi2_diag:
+        """
+        Class defining the minimizer and the data with uncorrelated error bars.
+        If the model has a jacobian(x, pars) method returning the model and its derivatives
+        with respect to the parameters (npars, ndata), the gradient of the chi2 is provided
+        to Minuit through grad().
+        """
+
+        def __init__(self, xin, yin, errin, functname):
+                self.x = xin
+                self.y = yin
+                self.invvar = 1. / np.asarray(errin) ** 2
+                self.functname = functname
+                self.has_grad = hasattr(functname, 'jacobian')
+
+        def __call__(self, *pars):
+                val = self.functname(self.x, pars)
+                return np.sum((self.y - val) ** 2 * self.invvar)
+
+        def grad(self, *pars):
+                val, jac = self.functname.jacobian(self.x, pars)
+                return -2 * np.dot(jac, (self.y - val) * self.invvar)
+
+
 # ## Call Minuit
 def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=None, rangepars=None, nohesse=False,
                           force_chi2_ndf=False, verbose=True, minos=True, extra_args=None, print_level=0, force_diag=False,
@@ -182,7 +206,10 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
 
         # check if covariance or error bars were given
         covar = covarin.copy()
-        if np.size(np.shape(covarin)) == 1:
+        if isinstance(chi2, MyChi2_diag):
+                # Uncorrelated error bars: no need for a covariance matrix
+                pass
+        elif np.size(np.shape(covarin)) == 1:
                 if force_diag:
                         covar = covarin.copy()
                 else:
@@ -192,6 +219,8 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
         # instantiate minimizer
         if chi2 is None:
                 chi2 = MyChi2(x, y, covar, functname, extra_args=extra_args)
+        elif isinstance(chi2, MyChi2_diag):
+                pass
         else:
                 chi2 = Chi2Implement(functname, x, y, covar, extra_args=extra_args)
 
@@ -246,6 +275,12 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
                 m = iminuit.Minuit(chi2, name=parnames, errordef=0.1, print_level=print_level, **theargs)
                 m.migrad(ncall=ncallmax * nsplit, nsplit=nsplit, precision=precision)
 
+        elif isinstance(chi2, MyChi2_diag):
+                grad = chi2.grad if chi2.has_grad else None
+                m = iminuit.Minuit(chi2, grad=grad, name=parnames, errordef=0.1, print_level=print_level,
+                                   **theargs)
+                m.migrad(ncall=ncallmax * nsplit, nsplit=nsplit, precision=precision)
+
         elif isinstance(chi2, Chi2Implement):
                 #if verbose:
                 #       print("Minimizer object: ", chi2.__dict__)
@@ -292,7 +327,7 @@ def do_minuit(x, y, covarin, guess, functname=thepolynomial, fixpars=None, chi2=
                         for j in range(ndimfit):
                                 covariance[i, j] = m.covariance[(parnamesfit[i], parnamesfit[j])]
 
-        if isinstance(chi2, MyChi2):
+        if isinstance(chi2, (MyChi2, MyChi2_diag)):
                 chisq = chi2(*parfit)
         elif isinstance(chi2, Chi2Implement):
                 ChiEvaluate = Chi2Minimizer(functname, x, y, covar) 
@@ -336,42 +371,32 @@ def profile(xin, yin, rng=None, nbins=10, fmt=None, plot=True, dispersion=True,
                 xx = np.logspace(np.log10(mini), np.log10(maxi), nbins + 1)
         xmin = xx[0:nbins]
         xmax = xx[1:]
-        yval = np.zeros(nbins)
-        xc = np.zeros(nbins)
-        dy = np.zeros(nbins)
-        dx = np.zeros(nbins)
-        nn = np.zeros(nbins)
+        xc = (xmax + xmin) / 2
+        index = _bin_index(x, xx)
+        nn, yval, dx, dy, count = _binned_statistics(index, y, nbins, x=x, median=median, clip=clip)
+        if mode and not median:
+                for i in np.arange(nbins):
+                        newy = y[index == i]
+                        mm, ss = meancut(newy, 3)
+                        hh = np.histogram(newy, bins=int(np.min([len(newy) / 30, 100])), range=[mm - 5 * ss, mm + 5 * ss])
+                        idmax = np.argmax(hh[0])
+                        yval[i] = 0.5 * (hh[1][idmax + 1] + hh[1][idmax])
         if rebin_as_well is not None:
                 nother = len(rebin_as_well)
                 others = np.zeros((nbins, nother))
+                # as with np.mean, the non-finite values are not ignored
+                inside = index >= 0
+                nsamples = np.bincount(index[inside], minlength=nbins)
+                for o in range(nother):
+                        values = np.asarray(rebin_as_well[o], dtype=float)[inside]
+                        with np.errstate(invalid='ignore', divide='ignore'):
+                                others[:, o] = np.bincount(index[inside], weights=values, minlength=nbins) / nsamples
         else:
                 others = None
-        for i in np.arange(nbins):
-                ok = (x > xmin[i]) & (x < xmax[i])
-                newy = y[ok]
-                if clip is not None:
-                        for k in np.arange(3):
-                                newy, mini, maxi = scipy.stats.sigmaclip(newy, low=clip, high=clip)
-                nn[i] = len(newy)
-                if median:
-                        yval[i] = np.median(y[ok])
-                elif mode:
-                        mm, ss = meancut(y[ok], 3)
-                        hh = np.histogram(y[ok], bins=int(np.min([len(y[ok]) / 30, 100])), range=[mm - 5 * ss, mm + 5 * ss])
-                        idmax = np.argmax(hh[0])
-                        yval[i] = 0.5 * (hh[1][idmax + 1] + hh[1][idmax])
-                else:
-                        yval[i] = np.mean(y[ok])
-                xc[i] = (xmax[i] + xmin[i]) / 2
-                if rebin_as_well is not None:
-                        for o in range(nother):
-                                others[i, o] = np.mean(rebin_as_well[o][ok])
-                if dispersion:
-                        fact = 1
-                else:
-                        fact = np.sqrt(len(y[ok]))
-                dy[i] = np.std(y[ok]) / fact
-                dx[i] = np.std(x[ok]) / fact
+        if not dispersion:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                        dy /= np.sqrt(count)
+                        dx /= np.sqrt(count)
         if plot:
                 if fmt is None:
                         fmt = 'ro'
@@ -388,6 +413,113 @@ def profile(xin, yin, rng=None, nbins=10, fmt=None, plot=True, dispersion=True,
                 return xc, yval, dx, dy, others
 
 
+def _bin_index(x, edges):
+        """
+        Return the index of the bin containing each value of x, or -1 for the
+        values outside the bins or on their edges, which are excluded.
+
+        """
+        nbins = len(edges) - 1
+        index = np.searchsorted(edges, x, side='right') - 1
+        inside = (index >= 0) & (index < nbins)
+        inside[inside] = x[inside] != edges[index[inside]]
+        index[~inside] = -1
+        return index
+
+
+def _binned_statistics(index, y, nbins, x=None, median=False, clip=None):
+        """
+        Return the statistics of y in bins, computed at once for all the rows
+        of y (the detectors) with bincount reductions.
+
+        Parameters
+        ----------
+        index : array
+                The bin index of each sample, or -1 for the samples to be
+                ignored, as returned by _bin_index. It is broadcast against y.
+        y : array
+                The binned data, of shape (..., nsamples). Non-finite values
+                are ignored.
+        nbins : int
+                The number of bins.
+        x : array, optional
+                If specified, the dispersion of x in the bins is returned.
+        median : bool
+                If True, return the median and not the mean.
+        clip : float, optional
+                If specified, the number of samples in the bins is counted
+                once they are sigma-clipped with this factor.
+
+        Returns
+        -------
+        nn, yval, dx, dy, count : arrays of shape (..., nbins)
+                The number of (sigma-clipped) samples, the mean or median of
+                y, the dispersions of x and y, and the number of samples.
+
+        """
+        shape = y.shape[:-1] + (nbins,)
+        common = np.ndim(index) == 1
+        index = np.broadcast_to(index, y.shape)
+        finite = np.isfinite(y)
+        valid = (index >= 0) & finite
+        rows = np.arange(int(np.prod(y.shape[:-1]))).reshape(y.shape[:-1] + (1,))
+        flat = (rows * nbins + index)[valid]
+        size = rows.size * nbins
+        yv = y[valid]
+
+        count = np.bincount(flat, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+                yval, dy = _binned_mean_std(flat, yv, size, count)
+                if x is not None:
+                        dx = _binned_mean_std(flat, np.broadcast_to(x, y.shape)[valid], size, count)[1]
+                else:
+                        dx = np.full(size, np.nan)
+                nn = count
+                if clip is not None:
+                        keep = np.ones(len(yv), bool)
+                        while True:
+                                nn = np.bincount(flat[keep], minlength=size)
+                                m, s = _binned_mean_std(flat[keep], yv[keep], size, nn)
+                                new = keep & (yv >= m[flat] - clip * s[flat]) & (yv <= m[flat] + clip * s[flat])
+                                if np.count_nonzero(new) == np.count_nonzero(keep):
+                                        break
+                                keep = new
+                if median and common:
+                        # the samples are sorted by bin once for all the rows
+                        index0 = index[(0,) * (y.ndim - 1)]
+                        order = np.argsort(index0, kind='stable')
+                        bounds = np.searchsorted(index0[order], np.arange(nbins + 1))
+                        ys = y[..., order]
+                        func = np.median
+                        if not np.all(finite):
+                                ys = np.where(finite[..., order], ys, np.nan)
+                                func = np.nanmedian
+                        yval = np.full(shape, np.nan)
+                        for i in range(nbins):
+                                if bounds[i + 1] > bounds[i]:
+                                        yval[..., i] = func(ys[..., bounds[i]:bounds[i + 1]], axis=-1)
+                        yval = yval.ravel()
+                elif median:
+                        yval = _binned_median(flat, yv, count)
+        return tuple(a.reshape(shape) for a in (nn, yval, dx, dy, count))
+
+
+def _binned_mean_std(flat, values, size, count):
+        mean = np.bincount(flat, weights=values, minlength=size) / count
+        var = np.bincount(flat, weights=(values - mean[flat]) ** 2, minlength=size) / count
+        return mean, np.sqrt(var)
+
+
+def _binned_median(flat, values, count):
+        order = np.lexsort((values, flat))
+        values = values[order]
+        start = np.cumsum(count) - count
+        ok = count > 0
+        out = np.full(len(count), np.nan)
+        out[ok] = 0.5 * (values[(start + (count - 1) // 2)[ok]] + values[(start + count // 2)[ok]])
+        return out
+
+
 def exponential_filter1d(input, sigma, axis=-1, output=None, mode="reflect", cval=0.0, truncate=10.0, power=1):
         """
         One-dimensional Exponential filter.
@@ -836,28 +968,46 @@ def fold_data(time, dd, period, nbins, lowcut=None, highcut=None,
                         fmax[i] = 1. / period * (i + 2) * (1 - margin / (i + 1))
                         fnoise[i] = 0.5 * (fmin[i] + fmax[i])
 
-        folded = np.zeros((ndet, nbins))
-        folded_nonorm = np.zeros((ndet, nbins))
-        dfolded = np.zeros((ndet, nbins))
-        dfolded_nonorm = np.zeros((ndet, nbins))
-        newdata = np.zeros((ndet, len(time)))
-        if not silent:
-                bar = progress_bar(ndet, 'Detectors ')
-        for THEPIX in range(ndet):
+        # all the detectors are filtered and folded at once, the bins being
+        # those of profile(tfold, ..., cutbad=False)
+        newdata = filter_data(time, dd, lowcut=lowcut, highcut=highcut, notch=notch, rebin=rebin, verbose=verbose)
+        newdata = np.array(newdata, dtype=float, ndmin=2)
+        xx = np.linspace(np.min(tfold), np.max(tfold), nbins + 1)
+        t = (xx[:-1] + xx[1:]) / 2
+        index = _bin_index(tfold, xx)
+        nn, yy, dx, dy, count = _binned_statistics(index, newdata, nbins, median=median, clip=clip)
+        with np.errstate(invalid='ignore', divide='ignore'):
+                dy /= np.sqrt(count)
+        yy[nn == 0] = 0
+        dy[nn == 0] = 0
+
+        # the bins of the detectors with invalid samples depend on their
+        # valid ones, and the mode is not vectorized
+        if mode and not median:
+                slow = np.arange(ndet)
+        else:
+                slow = np.where(~np.all(np.isfinite(newdata), axis=1))[0]
+        for THEPIX in slow:
+                t_, yy[THEPIX], dx, dy[THEPIX], others = profile(tfold, newdata[THEPIX], nbins=nbins,
+                                                                 dispersion=False, plot=False, cutbad=False,
+                                                                 median=median, mode=mode, clip=clip)
+                # the bin centers are those of the last detector
+                if THEPIX == ndet - 1:
+                        t = t_
+        mean = np.mean(yy, axis=1)[:, None]
+        std = np.std(yy, axis=1)[:, None]
+        folded = (yy - mean) / std
+        folded_nonorm = yy - mean
+        dfolded = dy / std
+        dfolded_nonorm = dy
+
+        if return_noise_harmonics is not None:
                 if not silent:
-                        bar.update()
-                data = dd[THEPIX, :]
-                newdd = filter_data(time, data, lowcut=lowcut, highcut=highcut, notch=notch, rebin=rebin, verbose=verbose)
-                newdata[THEPIX,:] = newdd
-                t, yy, dx, dy, others = profile(tfold, newdd, nbins=nbins, dispersion=False, plot=False,
-                                                cutbad=False, median=median, mode=mode, clip=clip)
-                folded[THEPIX, :] = (yy - np.mean(yy)) / np.std(yy)
-                folded_nonorm[THEPIX, :] = (yy - np.mean(yy))
-                dfolded[THEPIX, :] = dy / np.std(yy)
-                dfolded_nonorm[THEPIX, :] = dy
-                
-                if return_noise_harmonics is not None:
-                        spectrum, freq = power_spectrum(time, newdd, rebin=True)
+                        bar = progress_bar(ndet, 'Detectors ')
+                for THEPIX in range(ndet):
+                        if not silent:
+                                bar.update()
+                        spectrum, freq = power_spectrum(time, newdata[THEPIX], rebin=True)
                         for i in range(nharm):
                                 ok = (freq >= fmin[i]) & (freq < fmax[i])
                                 noise[THEPIX, i] = np.sqrt(np.mean(spectrum[ok]))
@@ -947,11 +1097,21 @@ def filter_data(time_in, data_in, lowcut = None, highcut = None, rebin=True, ver
 
 
 def vec_interp(x, xin, yin):
-        sh = np.shape(yin)
-        nvec = sh[0]
-        yout = np.zeros_like(yin)
-        for i in range(nvec):
-                yout[i, :] = np.interp(x, xin, yin[i, :])
+        """
+        Interpolate the rows of yin as np.interp does, the interpolation
+        weights being computed once for all the rows.
+        """
+        x = np.asarray(x)
+        xin = np.asarray(xin)
+        yin = np.asarray(yin)
+        if len(xin) == 1:
+                return np.zeros(yin.shape[:-1] + x.shape, yin.dtype) + yin[..., :1]
+        index = np.clip(np.searchsorted(xin, x, side='right') - 1, 0, len(xin) - 2)
+        dx = xin[index + 1] - xin[index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.clip(np.where(dx != 0, (x - xin[index]) / dx, 0), 0, 1)
+        yout = np.zeros(yin.shape[:-1] + x.shape, yin.dtype)
+        yout[...] = yin[..., index] + (yin[..., index + 1] - yin[..., index]) * weight
         return yout
 
 
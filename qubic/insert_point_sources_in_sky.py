@@ -105,6 +105,7 @@ def insert_source(
     units="uK_CMB",
     input_map=None,
     frequency=None,
+    angular_distance=False,
 ):
     """
     This function smooth a source with a given flux with a gaussian and returns a map 
@@ -121,6 +122,9 @@ def insert_source(
                                        is input_map = None, which means that the map will be initialized
                                        at the desired NSIDE
     frequency              - FLOAT   - the frequency at which we want the conversion to take place
+    angular_distance       - BOOL    - whether the gaussian is a function of the angular distance from the
+                                       source instead of its longitude and latitude offsets, see
+                                       source_beam_pixels. Default is False
         
     Output
     return_map             - NDARRAY - The HEALPix map
@@ -139,61 +143,11 @@ def insert_source(
             )
             return -1
 
-    if nside < 1024:
-        internal_nside = 1024  # The Nside at which the smoothing is done
-    else:
-        internal_nside = 2 * nside
+    # Beam values of the source averaged in the output map pixels
+    pixels, beam_values = source_beam_pixels(source_center_deg, fwhm_deg, nside,
+                                              angular_distance=angular_distance)
 
-    internal_npixels = 12 * internal_nside ** 2  # The corresponding number of pixels
-    degrade_map = True  # If to degrade the map at the end
-
-    # Here we check if we require a higher Nside than the internal. In general this should
-    # not happen. In case the required Nside is larger than the internal, then all the computation
-    # is run at the required Nside and there is no degradation at the end
-    if internal_nside <= nside:
-        internal_nside = nside
-        degrade_map = False
-
-    # Generate 2D gaussian array
-    source_center_rad = np.pi * np.array(source_center_deg) / 180.0
-    fwhm_rad = np.pi * fwhm_deg / 180.0
-
-    theta_deg, phi_deg = gaussian2D_grid(source_center_deg, fwhm_deg)
-
-    # Find correct pixels removing duplicates
-    pixels = [
-        h.ang2pix(internal_nside, th, ph, lonlat=True)
-        for th in theta_deg
-        for ph in phi_deg
-    ]
-    pixels = list(set(pixels))
-
-    # Find now the angles corresponding to pixels
-    angles_deg = [h.pix2ang(internal_nside, px, lonlat=True) for px in pixels]
-
-    # Shift the angles in the [-180,180] and [-90,90] ranges for gaussian computation
-    angles_deg = [center_ang(a) for a in angles_deg]
-
-    # Convert to radians
-    newtheta_rad = np.pi / 180 * np.array([ang[0] for ang in angles_deg])
-    newphi_rad = np.pi / 180 * np.array([ang[1] for ang in angles_deg])
-
-    # Now calculate gaussian values
-    gaussian_values = np.array(
-        [
-            gaussian2D(th, source_center_rad[0], ph, source_center_rad[1], fwhm_rad)
-            for th, ph in zip(newtheta_rad, newphi_rad)
-        ]
-    )
-
-    # Multiply beam values by flux normalized to beam solid angle
-    sigma = 1.0 / (2 * np.sqrt(2.0 * np.log(2.0))) * fwhm_rad
-    beam_solid_angle = 2 * np.pi * sigma ** 2
-    factor = flux_Jy / beam_solid_angle
-
-    # Pixel solid angle
-    output_map = np.zeros(internal_npixels)
-    output_map[pixels] = gaussian_values * factor
+    output_map = np.bincount(pixels, weights=beam_values * flux_Jy, minlength=12 * nside ** 2)
 
     # Perform the conversion to K_CMB if required
     if units == "K_CMB" or units == "uK_CMB":
@@ -210,12 +164,7 @@ def insert_source(
             Jysr2K_CMB = Jansky_invsr_to_K_CMB(frequency)
             output_map = output_map * Jysr2K_CMB * output_factor[units]
 
-    # Final degradation
-    #     degrade_map = False
-    if degrade_map:
-        return_map = h.ud_grade(output_map, nside)
-    else:
-        return_map = output_map
+    return_map = output_map
 
     if input_map is not None:
         return_map = return_map + input_map
@@ -223,6 +172,70 @@ def insert_source(
     return return_map
 
 
+# ### Beam of a source in the pixels of a map
+
+def source_beam_pixels(source_center_deg, fwhm_deg, nside, angular_distance=False):
+    """
+    This function computes the gaussian beam of a source of unit flux in the pixels
+    of a map. The beam is evaluated at the centers of the pixels of an internal map with
+    a higher resolution (Nside = 1024 or 2 * nside), and then averaged in the pixels of
+    the map, as h.ud_grade would do.
+
+    By default, as in gaussian2D, the gaussian is a function of the longitude and latitude
+    offsets from the source, in the internal pixels hit by the grid of gaussian2D_grid. If
+    angular_distance is True, it is a function of the angular distance from the source, in
+    the internal pixels overlapping the disc of radius 2 fwhm around it, so that the beam is
+    not squeezed along the longitude away from the equator.
+
+    Input
+    source_center_deg      - TUPLE   - the LonLat coordinates of the source in degrees
+    fwhm_deg               - FLOAT   - fwhm of the gaussian in degrees
+    nside                  - INT     - output map NSIDE
+    angular_distance       - BOOL    - whether the gaussian is a function of the angular distance
+                                       instead of the longitude and latitude offsets. Default is False
+
+    Output
+    pixels                 - NDARRAY - The pixels of the map (RING ordering), with repetitions
+    beam_values            - NDARRAY - The corresponding beam values in 1/sr, to be summed in the pixels
+    """
+    import healpy as h
+    import numpy as np
+
+    # The Nside at which the beam is evaluated
+    if nside < 1024:
+        internal_nside = 1024
+    else:
+        internal_nside = 2 * nside
+
+    fwhm_rad = np.radians(fwhm_deg)
+    sigma = 1.0 / (2 * np.sqrt(2.0 * np.log(2.0))) * fwhm_rad
+    beam_solid_angle = 2 * np.pi * sigma ** 2
+
+    if angular_distance:
+        # The disc is inclusive, so that the pixel of the source is kept for narrow beams
+        center = h.ang2vec(source_center_deg[0], source_center_deg[1], lonlat=True)
+        internal_pixels = h.query_disc(internal_nside, center, 2 * fwhm_rad, inclusive=True, nest=True)
+        vectors = np.array(h.pix2vec(internal_nside, internal_pixels, nest=True))
+        theta2 = np.arccos(np.clip(np.dot(center, vectors), -1, 1)) ** 2
+    else:
+        theta_deg, phi_deg = gaussian2D_grid(source_center_deg, fwhm_deg)
+        internal_pixels = np.unique(
+            h.ang2pix(internal_nside, theta_deg[:, None], phi_deg[None, :], nest=True, lonlat=True)
+        )
+        lon, lat = h.pix2ang(internal_nside, internal_pixels, nest=True, lonlat=True)
+        # The angles are centered as in gaussian2D, the longitudes being in [0, 360)
+        lon = np.where(lon > 180, lon - 360, lon)
+        lon0, lat0 = center_ang(np.radians(source_center_deg), degree=False)
+        theta2 = (np.radians(lon) - lon0) ** 2 + (np.radians(lat) - lat0) ** 2
+    beam_values = np.exp(-theta2 / (2 * sigma ** 2)) / beam_solid_angle
+
+    # In the NESTED ordering, the sub-pixels of a pixel have consecutive indices
+    nsubpix = (internal_nside // nside) ** 2
+    pixels = h.nest2ring(nside, internal_pixels // nsubpix)
+
+    return pixels, beam_values / nsubpix
+
+
 # ### Center angles in the [-180,180] and [-90,90] ranges
 
 # In[8]:
@@ -321,6 +334,7 @@ def add_sources_to_sky_map(
     fwhm_deg=("Auto", 1),
     catalog_file="Auto",
     reference_frequency="143",
+    angular_distance=False,
 ):
     """
     This function takes a PySM map array and adds point sources with a frequency behaviour
@@ -347,6 +361,9 @@ def add_sources_to_sky_map(
                                          coordinates. It defaults to 143 GHz. Can be left to this value also
                                          for 220 GHz, as the source location is weakly dependent on the 
                                          frequency
+    angular_distance    - BOOL         - whether the gaussian is a function of the angular distance from the
+                                         source instead of its longitude and latitude offsets, see
+                                         source_beam_pixels. Default is False
     
     Output
     output_map       - NDARRAY         - An array shaped (nfreq, npix, 3) containing sky + point 
@@ -401,7 +418,17 @@ def add_sources_to_sky_map(
     with open(catalog_file, "rb") as handle:
         catalog = pickle.load(handle)
 
-    for source in sources:
+    # Conversion from Jy/sr to uK_CMB at each frequency
+    Jysr2uK_CMB = np.array([Jansky_invsr_to_K_CMB(fq) for fq in frequencies]) * 1e6
+
+    # The beams of all the sources, and their I, Q, U amplitudes at each frequency, are gathered
+    # and added to the maps at once
+    all_pixels = []
+    all_beam_values = []
+    all_sources = []
+    all_amplitudes = []
+
+    for isource, source in enumerate(sources):
         
         # Check if source is in catalog with the reference frequency otherwise shift to the previous
         # frequency
@@ -420,7 +447,7 @@ def add_sources_to_sky_map(
             	            
         print(
             "Processing source %s (%i/%i)"
-            % (source, list(sources).index(source) + 1, len(sources))
+            % (source, isource + 1, len(sources))
         )
         source_center_deg = (
             catalog[reference_frequency][source]["GLON"],
@@ -432,42 +459,38 @@ def add_sources_to_sky_map(
         fi = np.poly1d(sed[source]["i_fit"])
         fp = np.poly1d(sed[source]["p_fit"])
 
-        # Loop over frequencies, for each frequency get the corresponding flux in I and P
-        for fq in frequencies:
-            fq_index = list(frequencies).index(fq)
-            print("Processing frequency # %i of %i" % (fq_index + 1, len(frequencies)))
-            i_flux = fi(fq / 1e9) / 1e3  # Conversion from mJy -> Jy
-            p_flux = fp(fq / 1e9) / 1e3  # Conversion from mJy -> Jy
+        # The flux in I and P at each frequency
+        i_flux = fi(np.asarray(frequencies) / 1e9) / 1e3  # Conversion from mJy -> Jy
+        p_flux = fp(np.asarray(frequencies) / 1e9) / 1e3  # Conversion from mJy -> Jy
+        p_flux = np.where(p_flux > 0.0, p_flux, 0.0)
 
-            polarization_angle = (
-                catalog[reference_frequency][source]["ANGLE_P"] * np.pi / 180.0
-            )
-            if p_flux > 0.0:
-                q_flux = p_flux * np.cos(2.0 * polarization_angle)
-                u_flux = p_flux * np.sin(2.0 * polarization_angle)
-            else:
-                q_flux = 0
-                u_flux = 0
-
-            flux = [i_flux, q_flux, u_flux]
-
-            for index in [0, 1, 2]:
-                outmap = insert_source(
-                    source_center_deg,
-                    fwhm,
-                    flux[index],
-                    nside,
-                    units="uK_CMB",
-                    input_map=input_map[fq_index, :, index],
-                    frequency=fq,
-                )
-
-                output_map[fq_index, :, index] = outmap
-
-        input_map = output_map.copy()
+        polarization_angle = (
+            catalog[reference_frequency][source]["ANGLE_P"] * np.pi / 180.0
+        )
+        q_flux = p_flux * np.cos(2.0 * polarization_angle)
+        u_flux = p_flux * np.sin(2.0 * polarization_angle)
+
+        pixels, beam_values = source_beam_pixels(source_center_deg, fwhm, nside,
+                                                  angular_distance=angular_distance)
+        all_pixels.append(pixels)
+        all_beam_values.append(beam_values)
+        all_sources.append(np.full(len(pixels), isource, dtype=int))
+        all_amplitudes.append(np.array([i_flux, q_flux, u_flux]).T)
 
         print("")
 
+    if len(all_pixels) > 0:
+        all_pixels = np.concatenate(all_pixels)
+        all_beam_values = np.concatenate(all_beam_values)
+        all_sources = np.concatenate(all_sources)
+        # Shape (nfreq, nsources, 3), converted to uK_CMB / (Jy/sr)
+        all_amplitudes = np.array(all_amplitudes).transpose(1, 0, 2) * Jysr2uK_CMB[:, None, None]
+        np.add.at(
+            output_map,
+            (slice(None), all_pixels),
+            all_amplitudes[:, all_sources] * all_beam_values[:, None],
+        )
+
     return output_map
 
 
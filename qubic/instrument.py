@@ -5,12 +5,13 @@ import healpy as hp
 import numexpr as ne
 import numpy as np
 import copy
+import os
 from pyoperators import (
     Cartesian2SphericalOperator, DenseBlockDiagonalOperator, DiagonalOperator,
     IdentityOperator, HomothetyOperator, ReshapeOperator, Rotation2dOperator,
     Rotation3dOperator, Spherical2CartesianOperator)
 from pyoperators.utils import (
-    operation_assignment, pool_threading, product, split)
+    omp_num_threads, operation_assignment, pool_threading, product, split)
 from pyoperators.utils.ufuncs import abs2
 from pysimulators import (
     ConvolutionTruncatedExponentialOperator, Instrument, Layout,
@@ -24,7 +25,7 @@ from scipy.constants import c, h, k, sigma
 from scipy.integrate import quad
 from . import _flib as flib
 from qubic.calibration import QubicCalibration
-from qubic.utils import _compress_mask
+from qubic.utils import _compress_mask, _get_hash, _save_atomic
 from qubic.ripples import ConvolutionRippledGaussianOperator, BeamGaussianRippled
 from qubic.beams import (BeamGaussian, BeamFitted, MultiFreqBeam)
 from qubic.polyacquisition import compute_freq
@@ -105,6 +106,10 @@ class QubicInstrument(Instrument):
         beam_shape: dictionary entry, string
             the shape of the primary and secondary beams:
             'gaussian', 'fitted_beam' or 'multi_freq'
+        projection_cache: string, optional
+            Directory in which the sparse projection matrices are stored,
+            keyed by a hash of the pointing, scene and instrument. If None
+            (default), the projection matrices are not cached.
 
         """
         self.debug = d['debug']  # if True allows debuging prints
@@ -185,6 +190,7 @@ class QubicInstrument(Instrument):
         self._init_synthbeam(synthbeam_dtype, synthbeam_peak150_fwhm)
         self.synthbeam.fraction = synthbeam_fraction
         self.synthbeam.kmax = synthbeam_kmax
+        self.projection_cache = d.get('projection_cache')
 
         layout = self._get_detector_layout(detector_ngrids, detector_nep,
                                            detector_fknee, detector_fslope,
@@ -669,17 +675,19 @@ class QubicInstrument(Instrument):
             del keywords['ripples']
         return HealpixConvolutionGaussianOperator(fwhm=fwhm, **keywords)
 
-    def get_detector_integration_operator(self):
+    def get_detector_integration_operator(self, dtype=None):
         """
         Integrate flux density in detector solid angles and take into account
         the secondary beam transmission.
 
         """
         return QubicInstrument._get_detector_integration_operator(
-            self.detector.center, self.detector.area, self.secondary_beam)
+            self.detector.center, self.detector.area, self.secondary_beam,
+            dtype=dtype)
 
     @staticmethod
-    def _get_detector_integration_operator(position, area, secondary_beam):
+    def _get_detector_integration_operator(position, area, secondary_beam,
+                                           dtype=None):
         """
         Integrate flux density in detector solid angles and take into account
         the secondary beam transmission.
@@ -691,7 +699,8 @@ class QubicInstrument(Instrument):
         sr_det = -area / position[..., 2] ** 2 * np.cos(theta) ** 3
         sr_beam = secondary_beam.solid_angle
         sec = secondary_beam(theta, phi)
-        return DiagonalOperator(sr_det / sr_beam * sec, broadcast='rightward')
+        return DiagonalOperator(np.asarray(sr_det / sr_beam * sec, dtype),
+                                broadcast='rightward')
 
     def get_detector_response_operator(self, sampling, tau=None):
         """
@@ -717,7 +726,7 @@ class QubicInstrument(Instrument):
             return IdentityOperator()
         return HomothetyOperator(self.filter.bandwidth)
 
-    def get_hwp_operator(self, sampling, scene):
+    def get_hwp_operator(self, sampling, scene, dtype=None):
         """
         Return the rotation matrix for the half-wave plate.
 
@@ -726,10 +735,10 @@ class QubicInstrument(Instrument):
         if scene.kind == 'I':
             return IdentityOperator(shapein=shape)
         if scene.kind == 'QU':
-            return Rotation2dOperator(-4 * sampling.angle_hwp,
-                                      degrees=True, shapein=shape + (2,))
-        return Rotation3dOperator('X', -4 * sampling.angle_hwp,
-                                  degrees=True, shapein=shape + (3,))
+            return Rotation2dOperator(-4 * sampling.angle_hwp, degrees=True,
+                                      shapein=shape + (2,), dtype=dtype)
+        return Rotation3dOperator('X', -4 * sampling.angle_hwp, degrees=True,
+                                  shapein=shape + (3,), dtype=dtype)
 
     def get_invntt_operator(self, sampling):
         """
@@ -741,7 +750,7 @@ class QubicInstrument(Instrument):
             fslope=self.detector.fslope, ncorr=self.detector.ncorr,
             nep=self.detector.nep)
 
-    def get_polarizer_operator(self, sampling, scene):
+    def get_polarizer_operator(self, sampling, scene, dtype=None):
         """
         Return operator for the polarizer grid.
         When the polarizer is not present a transmission of 1 is assumed
@@ -755,17 +764,17 @@ class QubicInstrument(Instrument):
 
         if scene.kind == 'I':
             if self.optics.polarizer:
-                return HomothetyOperator(1 / 2)
+                return HomothetyOperator(np.asarray(1 / 2, dtype))
             # 1 for the first detector grid and 0 for the second one
-            return DiagonalOperator(1 - grid, shapein=(nd, nt),
-                                    broadcast='rightward')
+            return DiagonalOperator(np.asarray(1 - grid, dtype),
+                                    shapein=(nd, nt), broadcast='rightward')
 
         if not self.optics.polarizer:
             raise NotImplementedError(
                 'Polarized input is not handled without the polarizer grid.')
 
         z = np.zeros(nd)
-        data = np.array([z + 0.5, 0.5 - grid, z]).T[:, None, None, :]
+        data = np.array([z + 0.5, 0.5 - grid, z], dtype).T[:, None, None, :]
         return ReshapeOperator((nd, nt, 1), (nd, nt)) * \
                DenseBlockDiagonalOperator(data, shapein=(nd, nt, 3))
 
@@ -786,28 +795,89 @@ class QubicInstrument(Instrument):
         """
         horn = getattr(self, 'horn', None)
         primary_beam = getattr(self, 'primary_beam', None)
+        cache = getattr(self, 'projection_cache', None)
 
-        if sampling.fix_az:
-            rotation = sampling.cartesian_horizontal2instrument
-        else:
-            rotation = sampling.cartesian_galactic2instrument
+        if cache is not None:
+            return QubicInstrument._get_projection_operator_cached(
+                cache, sampling, scene, self.filter.nu, self.detector.center,
+                self.synthbeam, horn, primary_beam, verbose=verbose)
 
+        rotation = _get_rotation(sampling)
         return QubicInstrument._get_projection_operator(
             rotation, scene, self.filter.nu, self.detector.center,
             self.synthbeam, horn, primary_beam, verbose=verbose)
 
+    @staticmethod
+    def _get_projection_operator_cached(
+            cache, sampling, scene, nu, position, synthbeam, horn,
+            primary_beam, verbose=True):
+        """
+        Return the peak sampling operator, whose sparse matrix is stored in
+        the directory cache. The file name is a hash of the pointing, the
+        scene and of the synthetic beam peaks (which depend on the detector
+        positions, the frequency, the horn array and the primary beam).
+        The matrix is loaded as a copy-on-write memory map, so that it is
+        shared between the processes reading it.
+
+        """
+        peaks = QubicInstrument._peak_angles(
+            scene, nu, position, synthbeam, horn, primary_beam)
+        key = _get_projection_key(sampling, scene, synthbeam.dtype, *peaks)
+        filename = os.path.join(cache, 'projection_' + key + '.npy')
+        if os.path.exists(filename):
+            if verbose:
+                print('Loading projection matrix from {}.'.format(filename))
+            data = np.load(filename, mmap_mode='c')
+            ndetectors = position.shape[0]
+            ntimes = len(sampling)
+            cls, ndims, shapeout = _get_projection_layout(
+                scene, ndetectors, ntimes)
+            s = cls((ndetectors * ntimes * ndims, len(scene) * ndims),
+                    data=data)
+            return ProjectionOperator(s, shapeout=shapeout)
+
+        P = QubicInstrument._get_projection_operators(
+            _get_rotation(sampling), scene, [nu], position, [synthbeam],
+            [horn], [primary_beam], verbose=verbose, peaks=[peaks])[0]
+        _save_atomic(filename,
+                     lambda f: np.save(f, P.matrix.data.view(np.ndarray)))
+        return P
+
     @staticmethod
     def _get_projection_operator(
             rotation, scene, nu, position, synthbeam, horn, primary_beam,
             verbose=True):
+        return QubicInstrument._get_projection_operators(
+            rotation, scene, [nu], position, [synthbeam], [horn],
+            [primary_beam], verbose=verbose)[0]
+
+    @staticmethod
+    def _get_projection_operators(
+            rotation, scene, nus, position, synthbeams, horns, primary_beams,
+            verbose=True, peaks=None):
+        """
+        Return the peak sampling operators of several frequencies observed
+        by the same detectors with the same pointing. The peak directions of
+        all the frequencies are rotated together, once per detector, and the
+        indices of all the sparse matrices are filled in the same pass.
+        The peaks (theta, phi, val) of each frequency can be given if they
+        have already been computed.
+
+        """
         ndetectors = position.shape[0]
         ntimes = rotation.data.shape[0]
         nside = scene.nside
 
-        thetas, phis, vals = QubicInstrument._peak_angles(
-            scene, nu, position, synthbeam, horn, primary_beam)
-        ncolmax = thetas.shape[-1]
-        thetaphi = _pack_vector(thetas, phis)  # (ndetectors, ncolmax, 2)
+        if peaks is None:
+            peaks = [QubicInstrument._peak_angles(
+                scene, nu, position, synthbeam, horn, primary_beam)
+                for nu, synthbeam, horn, primary_beam in
+                zip(nus, synthbeams, horns, primary_beams)]
+        ncolmaxs = [thetas.shape[-1] for thetas, phis, vals in peaks]
+        offsets = np.cumsum([0] + ncolmaxs)
+        thetaphi = _pack_vector(  # (ndetectors, sum(ncolmaxs), 2)
+            np.concatenate([thetas for thetas, phis, vals in peaks], axis=-1),
+            np.concatenate([phis for thetas, phis, vals in peaks], axis=-1))
         direction = Spherical2CartesianOperator('zenith,azimuth')(thetaphi)
         e_nf = direction[:, None, :, :]
         if nside > 8192:
@@ -815,39 +885,42 @@ class QubicInstrument(Instrument):
         else:
             dtype_index = np.dtype(np.int32)
 
-        cls = {'I': FSRMatrix,
-               'QU': FSRRotation2dMatrix,
-               'IQU': FSRRotation3dMatrix}[scene.kind]
-        ndims = len(scene.kind)
+        cls, ndims, shapeout = _get_projection_layout(
+            scene, ndetectors, ntimes)
         nscene = len(scene)
         nscenetot = product(scene.shape[:scene.ndim])
-        s = cls((ndetectors * ntimes * ndims, nscene * ndims), ncolmax=ncolmax,
-                dtype=synthbeam.dtype, dtype_index=dtype_index,
-                verbose=verbose)
+        matrices = [cls((ndetectors * ntimes * ndims, nscene * ndims),
+                        ncolmax=ncolmax, dtype=synthbeam.dtype,
+                        dtype_index=dtype_index, verbose=verbose)
+                    for ncolmax, synthbeam in zip(ncolmaxs, synthbeams)]
 
-        index = s.data.index.reshape((ndetectors, ntimes, ncolmax))
+        indices = [s.data.index.reshape((ndetectors, ntimes, ncolmax))
+                   for s, ncolmax in zip(matrices, ncolmaxs)]
         c2h = Cartesian2HealpixOperator(nside)
         if nscene != nscenetot:
             table = np.full(nscenetot, -1, dtype_index)
             table[scene.index] = np.arange(len(scene), dtype=dtype_index)
 
         def func_thread(i):
-            # e_nf[i] shape: (1, ncolmax, 3)
-            # e_ni shape: (ntimes, ncolmax, 3)
+            # e_nf[i] shape: (1, sum(ncolmaxs), 3)
+            # e_ni shape: (ntimes, sum(ncolmaxs), 3)
             e_ni = rotation.T(e_nf[i].swapaxes(0, 1)).swapaxes(0, 1)
+            ipix = c2h(e_ni)
             if nscene != nscenetot:
-                np.take(table, c2h(e_ni).astype(int), out=index[i])
-            else:
-                index[i] = c2h(e_ni)
+                ipix = np.take(table, ipix.astype(int))
+            for index, start, stop in zip(indices, offsets[:-1], offsets[1:]):
+                index[i] = ipix[:, start:stop]
 
         with pool_threading() as pool:
             pool.map(func_thread, range(ndetectors))
 
-        if scene.kind == 'I':
-            value = s.data.value.reshape(ndetectors, ntimes, ncolmax)
-            value[...] = vals[:, None, :]
-            shapeout = (ndetectors, ntimes)
-        else:
+        for s, (thetas, phis, vals), ncolmax, synthbeam, start, stop in zip(
+                matrices, peaks, ncolmaxs, synthbeams, offsets[:-1],
+                offsets[1:]):
+            if scene.kind == 'I':
+                value = s.data.value.reshape(ndetectors, ntimes, ncolmax)
+                value[...] = vals[:, None, :]
+                continue
             if str(dtype_index) not in ('int32', 'int64') or \
                     str(synthbeam.dtype) not in ('float32', 'float64'):
                 raise TypeError(
@@ -856,23 +929,18 @@ class QubicInstrument(Instrument):
             func = 'matrix_rot{0}d_i{1}_r{2}'.format(
                 ndims, dtype_index.itemsize, synthbeam.dtype.itemsize)
             getattr(flib.polarization, func)(
-                rotation.data.T, direction.T, s.data.ravel().view(np.int8),
-                vals.T)
-
-            if scene.kind == 'QU':
-                shapeout = (ndetectors, ntimes, 2)
-            else:
-                shapeout = (ndetectors, ntimes, 3)
-        return ProjectionOperator(s, shapeout=shapeout)
+                rotation.data.T, direction[:, start:stop].T,
+                s.data.ravel().view(np.int8), vals.T)
+        return [ProjectionOperator(s, shapeout=shapeout) for s in matrices]
 
-    def get_transmission_operator(self):
+    def get_transmission_operator(self, dtype=None):
         """
         Return the operator that multiplies by the cumulative instrumental
         transmission.
         """
-        return DiagonalOperator(
+        return DiagonalOperator(np.asarray(
             np.product(self.optics.components['transmission']) *
-            self.detector.efficiency, broadcast='rightward')
+            self.detector.efficiency, dtype), broadcast='rightward')
 
     @staticmethod
     def _peak_angles(scene, nu, position, synthbeam, horn, primary_beam):
@@ -1098,7 +1166,9 @@ class QubicInstrument(Instrument):
     @staticmethod
     def _get_synthbeam(scene, position, area, nu, bandwidth, horn,
                        primary_beam, secondary_beam, synthbeam_dtype=np.float32,
-                       theta_max=45, external_A=None, hwp_position=0):
+                       theta_max=45, external_A=None, hwp_position=0, max_memory=1e9,
+                       nthreads=None, precision='double', primary_beam_min=None,
+                       out=None):
         """
         Return the monochromatic synthetic beam for a specified location
         on the focal plane, multiplied by a given area and bandwidth.
@@ -1139,27 +1209,81 @@ class QubicInstrument(Instrument):
             [5] : array, phase on Y with shape (n, nhorns) [rad]
         hwp_position : int
             HWP position from 0 to 7.
+        max_memory : float, optional
+            The memory budget in bytes for the temporary arrays. The pixels
+            are processed in chunks that fit in this budget.
+        nthreads : int, optional
+            The number of threads over which the chunks of pixels are
+            distributed. By default, the number of OpenMP threads.
+        precision : 'double' or 'single', optional
+            The precision of the complex arithmetic (complex128 or complex64).
+        primary_beam_min : float, optional
+            If specified, the synthetic beam is assumed to be zero where the
+            primary beam is below this fraction of its maximum.
+        out : array of shape (..., len(scene)), optional
+            Preallocated C-contiguous output array (it can be a memory-mapped
+            array) of dtype synthbeam_dtype, in which the synthetic beams are
+            directly written.
 
         """
-        MAX_MEMORY_B = 1e9
+        if precision not in ('double', 'single'):
+            raise ValueError("Invalid precision '{0}'. Expected values are 'do"
+                             "uble' or 'single'.".format(precision))
+        dtype = np.complex128 if precision == 'double' else np.complex64
+        if nthreads is None:
+            nthreads = omp_num_threads()
         theta, phi = hp.pix2ang(scene.nside, scene.index)
-        index = np.where(theta <= np.radians(theta_max))[0]
-        nhorn = int(np.sum(horn.open))
+        inside = theta <= np.radians(theta_max)
+        if primary_beam_min is not None and np.any(inside):
+            beam = primary_beam(theta[inside], phi[inside])
+            inside[inside] = beam >= primary_beam_min * np.max(beam)
+        index = np.where(inside)[0]
+
+        shape = position.shape[:-1] + (len(scene),)
+        if out is None:
+            out = np.zeros(shape, dtype=synthbeam_dtype)
+        else:
+            if out.shape != shape or out.dtype != synthbeam_dtype or \
+                    not out.flags.c_contiguous:
+                raise ValueError(
+                    'The output array must be C-contiguous, with shape {0} and'
+                    ' dtype {1}.'.format(shape, np.dtype(synthbeam_dtype)))
+            out[..., ~inside] = 0
         npix = len(index)
-        nbytes_B = npix * nhorn * 24
-        ngroup = int(np.ceil(nbytes_B / MAX_MEMORY_B))
-        out = np.zeros(position.shape[:-1] + (len(scene),),
-                       dtype=synthbeam_dtype)
-        for s in split(npix, ngroup):
+        if npix == 0:
+            return out
+
+        # The transmission from the horns to the focal plane does not depend
+        # on the sky pixels: it is computed once
+        A = QubicInstrument._get_response_A(
+            position, area, nu, horn, secondary_beam, external_A=external_A,
+            hwp_position=hwp_position)
+        nhorn = A.shape[-1]
+        A = A.reshape((-1, nhorn)).astype(dtype, copy=False)
+        out_ = out.reshape((len(A), -1))
+        contiguous = index[-1] - index[0] + 1 == npix
+
+        # Temporary memory per pixel: B and its numexpr temporaries, E
+        nbytes = npix * (nhorn * 24 + len(A) * 16)
+        ngroup = max(nthreads, int(np.ceil(nbytes * nthreads / max_memory)))
+        ngroup = min(ngroup, npix)
+
+        def func_thread(s):
             index_ = index[s]
-            sb = QubicInstrument._get_response(
-                theta[index_], phi[index_], bandwidth, position, area, nu,
-                horn, primary_beam, secondary_beam, external_A=external_A, hwp_position=hwp_position)
-            out[..., index_] = abs2(sb, dtype=synthbeam_dtype)
+            B = QubicInstrument._get_response_B(
+                theta[index_], phi[index_], bandwidth, nu, horn, primary_beam)
+            E = np.dot(A, B.astype(dtype, copy=False))
+            if contiguous:
+                index_ = slice(index_[0], index_[-1] + 1)
+            out_[:, index_] = abs2(E)
+
+        with pool_threading(nthreads) as pool:
+            pool.map(func_thread, list(split(npix, ngroup)))
         return out
 
     def get_synthbeam(self, scene, idet=None, theta_max=45, external_A=None, hwp_position=0,
-                      detector_integrate=None, detpos=None):
+                      detector_integrate=None, detpos=None, max_memory=1e9, nthreads=None,
+                      precision='double', primary_beam_min=None, out=None):
         """
         Return the detector synthetic beams, computed from the superposition
         of the electromagnetic fields.
@@ -1203,9 +1327,28 @@ class QubicInstrument(Instrument):
         detector_integrate: Optional, number of subpixels in x direction for integration over detectors
             default (None) is no integration => uses the center of the pixel
         detpos: Optional, position in the focal plane at which the Synthesized Beam is desired as np.array([x,y,z])
-        
+        max_memory : float, optional
+            The memory budget in bytes for the temporary arrays of each chunk
+            of pixels.
+        nthreads : int, optional
+            The number of threads over which the chunks of pixels are
+            distributed. By default, the number of OpenMP threads.
+        precision : 'double' or 'single', optional
+            The precision of the complex arithmetic (complex128 or complex64).
+        primary_beam_min : float, optional
+            If specified, the synthetic beam is assumed to be zero where the
+            primary beam is below this fraction of its maximum.
+        out : array, optional
+            Preallocated C-contiguous output array (e.g. memory-mapped), of
+            shape (ndetectors, len(scene)) and dtype self.synthbeam.dtype. It
+            cannot be combined with idet or detector_integrate.
 
         """
+        if out is not None and (idet is not None or detector_integrate is not None):
+            raise ValueError('The output array cannot be preallocated with idet or '
+                             'detector_integrate.')
+        options = {'max_memory': max_memory, 'nthreads': nthreads,
+                   'precision': precision, 'primary_beam_min': primary_beam_min}
         if detpos is None:
             pos = self.detector.center
         else:
@@ -1213,12 +1356,14 @@ class QubicInstrument(Instrument):
 
         if (idet is not None) and (detpos is None):
             return self[idet].get_synthbeam(scene, theta_max=theta_max, external_A=external_A,
-                                            hwp_position=hwp_position, detector_integrate=detector_integrate)[0]
+                                            hwp_position=hwp_position, detector_integrate=detector_integrate,
+                                            **options)[0]
         if detector_integrate is None:
             return QubicInstrument._get_synthbeam(
                 scene, pos, self.detector.area, self.filter.nu,
                 self.filter.bandwidth, self.horn, self.primary_beam,
-                self.secondary_beam, self.synthbeam.dtype, theta_max, external_A=external_A, hwp_position=hwp_position)
+                self.secondary_beam, self.synthbeam.dtype, theta_max, external_A=external_A, hwp_position=hwp_position,
+                out=out, **options)
         else:
             xmin = np.min(self.detector.vertex[..., 0:1])
             xmax = np.max(self.detector.vertex[..., 0:1])
@@ -1237,7 +1382,7 @@ class QubicInstrument(Instrument):
                         scene, pos, self.detector.area, self.filter.nu,
                         self.filter.bandwidth, self.horn, self.primary_beam,
                         self.secondary_beam, self.synthbeam.dtype, theta_max,
-                        external_A=external_A, hwp_position=hwp_position) / detector_integrate ** 2
+                        external_A=external_A, hwp_position=hwp_position, **options) / detector_integrate ** 2
             return sb
 
     def detector_subset(self, dets):
@@ -1252,6 +1397,52 @@ def _argsort_reverse(a, axis=-1):
     return i
 
 
+def _get_projection_layout(scene, ndetectors, ntimes):
+    """
+    Return the sparse matrix class, the number of Stokes parameters and the
+    output shape of the projection operator for a given scene.
+
+    """
+    cls = {'I': FSRMatrix,
+           'QU': FSRRotation2dMatrix,
+           'IQU': FSRRotation3dMatrix}[scene.kind]
+    ndims = len(scene.kind)
+    if scene.kind == 'I':
+        shapeout = (ndetectors, ntimes)
+    else:
+        shapeout = (ndetectors, ntimes, ndims)
+    return cls, ndims, shapeout
+
+
+def _get_projection_key(sampling, scene, dtype, *peaks):
+    """
+    Return the hash identifying a projection matrix. The half-wave plate
+    angle is not part of it, since it does not enter the projection.
+
+    """
+    pointing = [np.asarray(a, dtype=float) for a in (
+        sampling.azimuth, sampling.elevation, sampling.pitch, sampling.time)]
+    if len(scene) != 12 * scene.nside ** 2:
+        index = np.asarray(scene.index)
+    else:
+        index = None
+    return _get_hash(*(pointing + [
+        str(sampling.date_obs), float(sampling.latitude),
+        float(sampling.longitude), bool(sampling.fix_az), scene.nside,
+        scene.kind, len(scene), str(np.dtype(dtype)), index] +
+        [np.asarray(a, dtype=float) for a in peaks]))
+
+
+def _get_rotation(sampling):
+    """
+    Return the rotation from the sky coordinates to the instrument frame.
+
+    """
+    if sampling.fix_az:
+        return sampling.cartesian_horizontal2instrument
+    return sampling.cartesian_galactic2instrument
+
+
 def _pack_vector(*args):
     shape = np.broadcast(*args).shape
     out = np.empty(shape + (len(args),))
@@ -1303,10 +1494,22 @@ class QubicMultibandInstrument:
     def __len__(self):
         return len(self.subinstruments)
 
-    def get_synthbeam(self, scene, idet=None, theta_max=45, detector_integrate=None, detpos=None):
-        sb = map(lambda i: i.get_synthbeam(scene, idet, theta_max,
-                                           detector_integrate=detector_integrate, detpos=detpos),
-                 self.subinstruments)
+    def get_synthbeam(self, scene, idet=None, theta_max=45, detector_integrate=None, detpos=None,
+                      **keywords):
+        """
+        Return the synthetic beams averaged over the sub-bands, weighted by
+        their bandwidths. The extra keywords (max_memory, nthreads, precision,
+        primary_beam_min) are passed to QubicInstrument.get_synthbeam. The
+        output array cannot be preallocated, since the sub-band beams are
+        computed separately.
+
+        """
+        if 'out' in keywords:
+            raise ValueError('The output of the multiband synthetic beam cannot'
+                            ' be preallocated.')
+        sb = [i.get_synthbeam(scene, idet, theta_max, detector_integrate=detector_integrate,
+                              detpos=detpos, **keywords)
+              for i in self.subinstruments]
         sb = np.array(sb)
         bw = np.zeros(len(self))
         for i in range(len(self)):
@@ -1340,6 +1543,44 @@ class QubicMultibandInstrument:
         sb = sb.sum(axis=0)
         return sb
 
+    def get_projection_operators(self, sampling, scene, verbose=True):
+        """
+        Return the peak sampling operators of the sub-instruments.
+        The pointing rotation is computed once and shared by all the
+        frequencies.
+
+        Parameters
+        ----------
+        sampling : QubicSampling
+            The pointing information.
+        scene : QubicScene
+            The observed scene.
+        verbose : bool, optional
+            If true, display information about the memory allocation.
+
+        """
+        return QubicMultibandInstrument._get_projection_operators(
+            self.subinstruments, sampling, scene, verbose=verbose)
+
+    @staticmethod
+    def _get_projection_operators(instruments, sampling, scene, verbose=True):
+        """
+        Return the peak sampling operators of instruments which only differ by
+        their frequency. The instruments relying on a projection cache are
+        handled one by one.
+
+        """
+        q = instruments[0]
+        if getattr(q, 'projection_cache', None) is not None:
+            return [i.get_projection_operator(sampling, scene, verbose=verbose)
+                    for i in instruments]
+        return QubicInstrument._get_projection_operators(
+            _get_rotation(sampling), scene, [i.filter.nu for i in instruments],
+            q.detector.center, [i.synthbeam for i in instruments],
+            [getattr(i, 'horn', None) for i in instruments],
+            [getattr(i, 'primary_beam', None) for i in instruments],
+            verbose=verbose)
+
     def detector_subset(self, dets):
         subset_inst = copy.deepcopy(self)
         for i in range(len(subset_inst)):
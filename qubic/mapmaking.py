@@ -1,19 +1,20 @@
 from __future__ import absolute_import, division, print_function
 from collections import OrderedDict
-from pyoperators import (
-    asoperator, BlockColumnOperator, DiagonalOperator, PackOperator, pcg,
-    proxy_group)
+from copy import copy
+from pyoperators import asoperator, DiagonalOperator, PackOperator, pcg
 from pyoperators.memory import ones
-from pyoperators.utils import ndarraywrap
+from pyoperators.utils import ndarraywrap, split
 from pysimulators.interfaces.healpy import HealpixLaplacianOperator
 from .utils import progress_bar
 import healpy as hp
 import numpy as np
+import scipy.sparse
 
 __all__ = ['angular_distance_from_mask',
            'apodize_mask',
            'map2tod',
            'tod2map_all',
+           'tod2map_batch',
            'tod2map_each']
 
 
@@ -70,40 +71,23 @@ def apodize_mask(maskok, fwhm_deg):
     return 1 - np.exp(-0.5 * mapang**2 / sigma_deg**2)
 
 
-def _get_projection_restricted(acq, P, mask):
-    #XXX HACK
-    if len(acq.block) == 1:
-        return P.restrict(mask, inplace=True)
-
-    def callback(i):
-        f = acq.instrument.get_projection_operator
-        p = f(acq.sampling[acq.block[i]], acq.scene, verbose=False)
-        return p.restrict(mask, inplace=True)
-    shapeouts = [(len(acq.instrument), s.stop-s.start) +
-                 acq.scene.shape[1:] for s in acq.block]
-    proxies = proxy_group(len(acq.block), callback, shapeouts=shapeouts)
-    return BlockColumnOperator(proxies, axisout=1)
-
-#    nbytes = acq.get_projection_nbytes()
-#    if max_nbytes is None or nbytes <= max_nbytes:
-#        if acq.comm.size > 1:
-#            P = P.operands[0]
-#        if isinstance(P, BlockColumnOperator):
-#            for _ in P.operands:
-#                _.restrict(mask)
-#        else:
-#            P.restrict(mask)
-#        return P
-#    n = int(np.ceil(nbytes / max_nbytes))
-#    samplings = acq.sampling.split(n)
-#    acqs = [QubicAcquisition(acq.instrument, _, acq.scene, acq.block)
-#            for _ in samplings]
-#
-#    def callback(i):
-#        p = acqs[i].get_projection_operator(verbose=False)
-#        p.restrict(mask)
-#        return p
-#    return BlockColumnOperator(proxy_group(n, callback), axisout=1)
+def _get_acquisition_on_the_fly(acq, max_nbytes):
+    """
+    Return the acquisition whose samplings are split into blocks, such that
+    the pointing matrix of each block requires less than max_nbytes. The
+    pointing matrices of the blocks are then computed on the fly each time
+    the acquisition operator is applied.
+
+    """
+    if max_nbytes is None:
+        return acq
+    nbytes = acq.get_operator_nbytes()
+    nblocks = int(np.ceil(nbytes / max_nbytes))
+    if nblocks <= len(acq.block):
+        return acq
+    out = copy(acq)
+    out.block = tuple(split(len(acq.sampling), nblocks))
+    return out
 
 
 def map2tod(acq, map, convolution=False, max_nbytes=None):
@@ -137,6 +121,7 @@ def map2tod(acq, map, convolution=False, max_nbytes=None):
         convolution = acq.get_convolution_peak_operator()
         map = convolution(map)
 
+    acq = _get_acquisition_on_the_fly(acq, max_nbytes)
     H = acq.get_operator()
     tod = H(map)
 
@@ -146,8 +131,12 @@ def map2tod(acq, map, convolution=False, max_nbytes=None):
     return tod
 
 
-def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
-             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper):
+def _get_coverage(acq, coverage_threshold):
+    """
+    Return the normalized coverage map and the mask of the pixels whose
+    coverage is above the threshold.
+
+    """
     # coverage normalization:
     # sum coverage = #detectors x #samplings for a uniform secondary beam
     H = acq.get_operator()
@@ -178,17 +167,28 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
     header['thresrel'] = coverage_threshold, 'Relative coverage threshold'
     header['thresabs'] = threshold, 'Absolute coverage threshold'
     header['fracrej'] = rejected, 'Fraction of rejected observed pixels'
+    return coverage, mask
 
+
+def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
+             disp_pcg, maxiter, tol, criterion, full_output, save_map, hyper,
+             precision):
+    acq = _get_acquisition_on_the_fly(acq, max_nbytes)
+
+    coverage, mask = _get_coverage(acq, coverage_threshold)
     acq_restricted = acq[..., mask]
-    H = acq_restricted.get_operator()
+    projection = acq_restricted.get_projection_operator()
+    H = acq_restricted.get_operator(projection=projection)
     invNtt = acq_restricted.get_invntt_operator()
     M = (H.T * H * np.ones(H.shapein))[..., 0]
     preconditioner = DiagonalOperator(1/M, broadcast='rightward')
 #    preconditioner = DiagonalOperator(1/coverage[mask], broadcast='rightward')
-    nsamplings = acq.comm.allreduce(len(acq.sampling))
+    nsamplings = acq.sampling.comm.allreduce(len(acq.sampling))
     npixels = np.sum(mask)
 
-    A = H.T * invNtt * H / nsamplings
+    A = acq_restricted.get_normal_operator(
+        invntt=invNtt, precision=precision,
+        projection=projection) / nsamplings
     if hyper != 0:
         L = HealpixLaplacianOperator(acq.scene.nside)
         L = L.restrict(mask, inplace=True).corestrict(mask, inplace=True)
@@ -198,7 +198,9 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
         def f(x):
             Hx_y = H(x)
             Hx_y -= tod
-            out = [np.dot(Hx_y.ravel(), invNtt(Hx_y).ravel()) / nsamplings]
+            # the time-ordered data are distributed, the maps are not
+            out = [acq.comm.allreduce(
+                np.dot(Hx_y.ravel(), invNtt(Hx_y).ravel())) / nsamplings]
             if hyper != 0:
                 out += [-np.dot(x.ravel(),
                                 hyper / npixels / 4e5 * L(x).ravel())]
@@ -243,7 +245,8 @@ def _tod2map(acq, tod, coverage_threshold, max_nbytes, callback,
 
 def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
                 callback=None, disp=True, maxiter=300, tol=1e-4,
-                criterion=False, full_output=False, save_map=None, hyper=0):
+                criterion=False, full_output=False, save_map=None, hyper=0,
+                precision='double'):
     """
     Compute map using all detectors.
 
@@ -279,6 +282,10 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     criterion : boolean, optional
         If True, also display the criterion at each iteration. It slows down
         the solving process.
+    precision : 'double' or 'single', optional
+        If 'single', the products by the pointing matrix are performed in
+        float32, while the solver's vectors and dot products are kept in
+        float64 (see QubicAcquisition.get_normal_operator).
 
     Returns
     -------
@@ -289,12 +296,13 @@ def tod2map_all(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     """
     return _tod2map(acquisition, tod, coverage_threshold, max_nbytes,
                     callback, disp, maxiter, tol, criterion, full_output,
-                    save_map, hyper)
+                    save_map, hyper, precision)
 
 
 def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
                  callback=None, disp=True, maxiter=300, tol=1e-4,
-                 criterion=False, full_output=False, save_map=None, hyper=0):
+                 criterion=False, full_output=False, save_map=None, hyper=0,
+                 precision='double'):
     """
     Compute average map from each detector.
 
@@ -327,6 +335,10 @@ def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     criterion : boolean, optional
         If True, also display the criterion at each iteration. It slows down
         the solving process.
+    precision : 'double' or 'single', optional
+        If 'single', the products by the pointing matrix are performed in
+        float32, while the solver's vectors and dot products are kept in
+        float64 (see QubicAcquisition.get_normal_operator).
 
     Returns
     -------
@@ -345,7 +357,7 @@ def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
         acq = acquisition[i]
         x_, n_ = _tod2map(acq, t[None, :], coverage_threshold, max_nbytes,
                           callback, False, maxiter, tol, criterion,
-                          full_output, save_map, hyper)
+                          full_output, save_map, hyper, precision)
                           
         x += x_
         n += n_
@@ -355,3 +367,204 @@ def tod2map_each(acquisition, tod, coverage_threshold=0.01, max_nbytes=None,
     if acquisition.scene.kind == 'I':
         return np.nan_to_num(x / n), n
     return np.nan_to_num(x / n[:, None]), n
+
+
+def tod2map_batch(acquisition, tods, coverage_threshold=0.01, disp=True,
+                  maxiter=300, tol=1e-4):
+    """
+    Compute the maps of several TODs sharing the same acquisition, such as
+    the noise realizations of a Monte Carlo simulation.
+
+    maps, coverage = tod2map_batch(acquisition, tods, [coverage_threshold,
+                                   disp, maxiter, tol])
+
+    The map-making equations of all the TODs are solved together by
+    conjugate gradients run in lockstep. At each iteration, the pointing
+    matrix is traversed once for all the realizations which have not
+    converged yet, as a sparse matrix-matrix product, instead of once per
+    realization.
+
+    Parameters
+    ----------
+    acquisition : QubicAcquisition
+        The QUBIC acquisition. Its pointing matrix must not be computed on
+        the fly.
+    tods : array-like
+        The local Time-Ordered-Data of shape (nrealizations, ndetectors,
+        ntimes).
+    coverage_threshold : float, optional
+        The low-coverage sky pixels whose cumulative coverage is below a
+        fraction of the total coverage are rejected. This keyword speficies
+        this fraction (between 0 and 1]).
+    disp : boolean, optional
+        Display of solver's iterations.
+    maxiter : integer, optional
+        Maximum number of iterations.
+    tol : float, optional
+        Solver tolerance, which each realization has to reach.
+
+    Returns
+    -------
+    maps : array
+        The I, QU or IQU maps of shape (nrealizations, npix),
+        (nrealizations, npix, 2) or (nrealizations, npix, 3)
+        with npix = 12 * nside**2
+    coverage : array
+        The normalized coverage map.
+
+    """
+    tods = np.asarray(tods)
+    if tods.shape[1:] != (len(acquisition.instrument),
+                          len(acquisition.sampling)):
+        raise ValueError('The TOD has an invalid shape.')
+    if len(acquisition.block) > 1:
+        raise ValueError(
+            'The batched map-making requires the pointing matrix to be store'
+            'd in memory.')
+
+    coverage, mask = _get_coverage(acquisition, coverage_threshold)
+    acq = acquisition[..., mask]
+    nsamplings = acq.sampling.comm.allreduce(len(acq.sampling))
+
+    # H = T * P * S, where the pointing matrix P is applied to all the
+    # realizations at once. In a distributed acquisition, the local maps
+    # are summed by the transpose of the distribution operator, in S.T.
+    # Only the sparse matrices are kept, the projection operator is dropped
+    P = acq.get_projection_operator(verbose=False)
+    matrices = _get_sparse_matrices(P)
+    shapeout = P.shapeout
+    del P
+    T = acq.get_detector_response_operator() * acq._get_detector_operator()
+    S = acq._get_sky_operator()
+    invntt = acq.get_invntt_operator()
+
+    def apply(x, W):
+        # H^T W H applied to a stack of maps
+        y = np.array([S(x_) for x_ in x])
+        z = _sparse_dot(matrices, np.moveaxis(y, 0, -1))
+        for i in range(len(x)):
+            z[..., i] = W(z[..., i].reshape(shapeout)).reshape(z.shape[:-1])
+        y = _sparse_dot(matrices, z, transpose=True)
+        return np.array([S.T(y[..., i]) for i in range(len(x))])
+
+    shapein = (len(acq.scene),) + acq.scene.shape[1:]
+    M = apply(np.ones((1,) + shapein), T.T * T)[0][..., 0]
+    preconditioner = DiagonalOperator(1/M, broadcast='rightward')
+    W = T.T * invntt * T
+
+    def A(x):
+        return apply(x, W) / nsamplings
+
+    z = np.array([T.T(invntt(tod)).reshape(-1, *shapeout[2:])
+                  for tod in tods])
+    y = _sparse_dot(matrices, np.moveaxis(z, 0, -1), transpose=True)
+    b = np.array([S.T(y[..., i]) for i in range(len(tods))]) / nsamplings
+
+    x = _pcg_batch(A, b, preconditioner, disp, maxiter, tol)
+    maps = np.array([acq.scene.unpack(x_) for x_ in x])
+    return maps, coverage
+
+
+def _get_sparse_matrices(projection):
+    """
+    Return the sparse matrix of a projection operator as scipy CSR matrices:
+    a real one for the intensity and, for IQU scenes, a complex one acting
+    on Q + iU, which is how the polarization angles rotate the Stokes
+    parameters.
+
+    """
+    if not hasattr(projection, 'matrix'):
+        raise NotImplementedError(
+            'The operator {} has no sparse matrix.'.format(
+                type(projection).__name__))
+    data = projection.matrix.data
+    nrows, ncolmax = data.shape
+    ncols = projection.shapein[0]
+    index = data.index.ravel()
+    valid = index >= 0
+    indices = np.where(valid, index, 0)
+    indptr = np.arange(0, nrows * ncolmax + 1, ncolmax)
+
+    def get_matrix(value, dtype):
+        value = np.where(valid, value.ravel(), 0).astype(dtype)
+        return scipy.sparse.csr_matrix((value, indices, indptr),
+                                       shape=(nrows, ncols))
+
+    if 'value' in data.dtype.names:
+        return get_matrix(data.value, float),
+    if 'r32' in data.dtype.names:
+        return (get_matrix(data.r11, float),
+                get_matrix(data.r22 + 1j * data.r32, complex))
+    raise NotImplementedError(
+        'The sparse matrix {} is not handled.'.format(
+            type(projection.matrix).__name__))
+
+
+def _sparse_dot(matrices, x, transpose=False):
+    """
+    Multiply a stack of vectors, whose last dimension is the realization one,
+    by the matrices returned by _get_sparse_matrices or by their transpose.
+
+    """
+    if len(matrices) == 1:
+        m = matrices[0].T if transpose else matrices[0]
+        return m.dot(x)
+    m_i, m_qu = matrices
+    if transpose:
+        m_i = m_i.T
+        m_qu = m_qu.T
+        # the transpose of the Q/U rotation is the conjugate of m_qu
+        qu = np.conj(m_qu.dot(x[:, 1] - 1j * x[:, 2]))
+    else:
+        qu = m_qu.dot(x[:, 1] + 1j * x[:, 2])
+    out = np.empty((m_i.shape[0],) + x.shape[1:])
+    out[:, 0] = m_i.dot(x[:, 0])
+    out[:, 1] = qu.real
+    out[:, 2] = qu.imag
+    return out
+
+
+def _pcg_batch(A, b, M, disp, maxiter, tol):
+    """
+    Solve the systems A x = b for a stack of right-hand sides b with the
+    preconditioned conjugate gradient method. The realizations are iterated
+    in lockstep, and the operator A is only applied to those which have not
+    converged yet.
+
+    """
+    def dot(x, y):
+        return np.sum((x * y).reshape(len(x), -1), axis=-1)
+
+    def precondition(r):
+        return np.array([M(r_) for r_ in r])
+
+    def expand(a):
+        return a.reshape((-1,) + (b.ndim - 1) * (1,))
+
+    x = np.zeros_like(b)
+    r = b.copy()
+    b_norm = dot(b, b)
+    error = np.zeros(len(b))
+    active = b_norm > 0
+    d = precondition(r)
+    delta = dot(r, d)
+    niterations = 0
+    while np.any(active) and niterations < maxiter:
+        i = np.flatnonzero(active)
+        q = A(d[i])
+        alpha = delta[i] / dot(d[i], q)
+        x[i] += expand(alpha) * d[i]
+        r[i] -= expand(alpha) * q
+        error[i] = np.sqrt(dot(r[i], r[i]) / b_norm[i])
+        niterations += 1
+        if disp:
+            print('{:4}: {}'.format(niterations, np.max(error[i])))
+        active[i] = error[i] >= tol
+        i = np.flatnonzero(active)
+        if len(i) == 0:
+            break
+        s = precondition(r[i])
+        delta_old = delta[i]
+        delta[i] = dot(r[i], s)
+        d[i] = expand(delta[i] / delta_old) * d[i] + s
+    return x
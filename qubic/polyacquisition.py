@@ -10,7 +10,7 @@ from pyoperators import (
     MPIDistributionIdentityOperator, MPI, proxy_group, ReshapeOperator,
     rule_manager, pcg)
 from pyoperators.utils.mpi import as_mpi
-from pysimulators import Acquisition, FitsArray
+from pysimulators import Acquisition, FitsArray, ProjectionOperator
 from pysimulators.interfaces.healpy import (
     HealpixConvolutionGaussianOperator)
 import qubic
@@ -171,7 +171,7 @@ class QubicPolyAcquisition(object):
         q = qubic.QubicInstrument(d1, FRBW=self[0].instrument.FRBW)
         q.detector = self[0].instrument.detector
         s_ = self[0].sampling
-        nsamplings = self[0].comm.allreduce(len(s_))
+        nsamplings = self[0].sampling.comm.allreduce(len(s_))
 
         d1['random_pointing'] = True
         d1['sweeping_pointing'] = False
@@ -191,8 +191,25 @@ class QubicPolyAcquisition(object):
         a = self._get_average_instrument_acq()
         return a.get_noise()
 
+    def get_projection_operators(self, verbose=True):
+        """
+        Return the projection operators of the subacquisitions. The pointing
+        rotation and the peak directions of all the subfrequencies are
+        computed in a single pass, unless the samplings are split into
+        blocks, in which case each subacquisition computes its own.
+
+        """
+        a = self[0]
+        if len(a.block) != 1:
+            return [a.get_projection_operator(verbose=verbose) for a in self]
+        ops = qubic.QubicMultibandInstrument._get_projection_operators(
+            [a.instrument for a in self], a.sampling, a.scene,
+            verbose=verbose)
+        return [BlockColumnOperator([P], axisout=1) for P in ops]
+
     def _get_array_of_operators(self):
-        return [a.get_operator() * w for a, w in zip(self, self.weights)]
+        return [a.get_operator(projection=P) * w for a, P, w in
+                zip(self, self.get_projection_operators(), self.weights)]
 
     def get_operator_to_make_TOD(self):
         """
@@ -207,13 +224,52 @@ class QubicPolyAcquisition(object):
 
     def get_operator(self):
         """
-        Return an sum of operators for subacquisitions
+        Return an sum of operators for subacquisitions.
+
+        When the subfrequencies only differ by scalar sky factors and by
+        detector-wise transmissions, their weighted pointing matrices are
+        merged into a single sparse matrix, so that the operator and its
+        transpose traverse it once.
         """
         if len(self) == 1:
             return self[0].get_operator()
+        H = self._get_fused_operator()
+        if H is not None:
+            return H
         op = np.array(self._get_array_of_operators())
         return np.sum(op, axis=0)
 
+    def _get_fused_operator(self):
+        """
+        Return the sum of the subacquisition operators, as a single
+        projection operator between the operators common to the
+        subfrequencies, or None if the subacquisitions cannot be fused.
+        """
+        a = self[0]
+        if len(a.block) != 1:
+            return None
+        scales = []
+        for acq, w in zip(self, self.weights):
+            sky = acq._get_sky_operator()
+            det = acq._get_detector_transmission_operator()
+            if not _is_diagonal(sky, 'scalar') or \
+               not _is_diagonal(det, 'rightward'):
+                return None
+            scale = w * sky.data * np.broadcast_to(det.data, len(a.instrument))
+            scales.append(np.repeat(scale, len(a.sampling)))
+
+        ops = qubic.QubicMultibandInstrument._get_projection_operators(
+            [acq.instrument for acq in self], a.sampling, a.scene,
+            verbose=False)
+        matrix = _sum_projection_matrices([P.matrix for P in ops], scales)
+        P = ProjectionOperator(matrix, shapeout=ops[0].shapeout)
+        del ops
+        with rule_manager(inplace=True):
+            return CompositionOperator([
+                a.get_detector_response_operator(),
+                a._get_polarization_operator(), P,
+                a.get_distribution_operator()])
+
     def get_invntt_operator(self):
         """
         Return the inverse noise covariance matrix as operator
@@ -299,6 +355,65 @@ class QubicPolyAcquisition(object):
         return solution['x'], solution['nit'], solution['error']
 
 
+def _is_diagonal(op, broadcast):
+    """
+    Return true if the operator is diagonal and its data is broadcast as
+    specified (a scalar one is always accepted).
+    """
+    return isinstance(op, DiagonalOperator) and \
+        op.broadcast in ('scalar', broadcast)
+
+
+def _sum_projection_matrices(matrices, scales, nentries=2**22):
+    """
+    Return the sum of sparse matrices of the same shape and layout, the rows
+    of each matrix being multiplied by the corresponding scale factors. The
+    entries of a row that share the same column are merged, so that the
+    number of entries per row is that of the largest merged row. The rows
+    are merged by chunks of about nentries input entries, to bound the
+    memory of the temporary arrays.
+    """
+    data = [m.data for m in matrices]
+    nrows = data[0].shape[0]
+    chunk = max(nentries // sum(d.shape[1] for d in data), 1)
+    slices = [slice(i, min(i + chunk, nrows)) for i in range(0, nrows, chunk)]
+
+    def get_new(index):
+        # negative indices, which denote peaks outside the scene, are dropped
+        new = index >= 0
+        new[:, 1:] &= index[:, 1:] != index[:, :-1]
+        return new
+
+    # the merged rows are counted first, to allocate the output matrix
+    ncolmax = 1
+    for s in slices:
+        index = np.sort(np.hstack([d['index'][s] for d in data]), axis=1)
+        ncolmax = max(ncolmax, int(get_new(index).sum(axis=1).max()))
+
+    out = np.zeros((nrows, ncolmax), data[0].dtype).view(type(data[0]))
+    for s in slices:
+        index = np.hstack([d['index'][s] for d in data])
+        order = np.argsort(index, axis=1, kind='stable')
+        index = np.take_along_axis(index, order, axis=1)
+        valid = index >= 0
+        column = np.cumsum(get_new(index), axis=1) - 1
+        n = index.shape[0]
+        flat = (np.arange(n)[:, None] * ncolmax + column)[valid]
+        out_index = np.full(n * ncolmax, -1, index.dtype)
+        out_index[flat] = index[valid]
+        out['index'][s] = out_index.reshape(n, ncolmax)
+        for name in data[0].dtype.names:
+            if name == 'index':
+                continue
+            values = np.hstack([d[name][s] * sc[s, None] for d, sc in
+                                zip(data, scales)])
+            values = np.take_along_axis(values, order, axis=1)[valid]
+            out[name][s] = np.bincount(flat, weights=values,
+                                       minlength=n * ncolmax).reshape(
+                                           n, ncolmax)
+    return type(matrices[0])(matrices[0].shape, data=out)
+
+
 class QubicPolyPlanckAcquisition(QubicPlanckAcquisition):
     """
     The QubicPolyAcquisition class, which combines the QubicPoly and Planck
@@ -5,7 +5,7 @@ import numpy as np
 from astropy.time import Time, TimeDelta
 from numpy.random import random_sample as randomu
 from pyoperators import (
-    Cartesian2SphericalOperator, Rotation3dOperator,
+    Cartesian2SphericalOperator, MPI, Rotation3dOperator,
     Spherical2CartesianOperator, rule_manager)
 from pyoperators.utils import deprecated, isscalarlike
 from pysimulators import (
@@ -136,17 +136,25 @@ def get_pointing(d):
 
     center = (d['RA_center'], d['DEC_center'])
 
+    # the pointings are scattered by the acquisition over the processes,
+    # even with the default distribution, so that all the processes have to
+    # draw the same ones
+    seed = d['seed']
+    comm = d.get('comm') or MPI.COMM_WORLD
+    if seed is None and comm.size > 1:
+        seed = comm.bcast(np.random.randint(2**31) if comm.rank == 0 else None)
+
     if d['random_pointing'] is True:
         return create_random_pointings(center, d['npointings'], d['dtheta'], d['hwp_stepsize'],
                                        date_obs=d['date_obs'], period=d['period'],
                                        latitude=d['latitude'],
-                                       longitude=d['longitude'], seed=d['seed'])
+                                       longitude=d['longitude'], seed=seed)
 
     elif d['repeat_pointing'] is True:
         return create_repeat_pointings(center, d['npointings'], d['dtheta'], d['nhwp_angles'],
                                        date_obs=d['date_obs'], period=d['period'],
                                        latitude=d['latitude'],
-                                       longitude=d['longitude'], seed=d['seed'])
+                                       longitude=d['longitude'], seed=seed)
 
     elif d['sweeping_pointing'] is True:
         return create_sweeping_pointings(center, d['duration'], d['period'],
@@ -156,7 +164,8 @@ def get_pointing(d):
                                          date_obs=d['date_obs'],
                                          latitude=d['latitude'],
                                          longitude=d['longitude'],
-                                         fix_azimuth=d['fix_azimuth'], random_hwp=d['random_hwp'])
+                                         fix_azimuth=d['fix_azimuth'], random_hwp=d['random_hwp'],
+                                         seed=seed)
 
 
 def create_random_pointings(center, npointings, dtheta, hwp_stepsize, date_obs=None,
@@ -298,7 +307,8 @@ def create_repeat_pointings(center, npointings, dtheta, nhwp_angles, date_obs=No
 
 def create_sweeping_pointings(
         center, duration, period, angspeed, delta_az, nsweeps_per_elevation,
-        angspeed_psi, maxpsi, hwp_stepsize, date_obs=None, latitude=None, longitude=None, fix_azimuth=None, random_hwp=True):
+        angspeed_psi, maxpsi, hwp_stepsize, date_obs=None, latitude=None, longitude=None, fix_azimuth=None, random_hwp=True,
+        seed=None):
     """
     Return pointings according to the sweeping strategy:
     Sweep around the tracked FOV center azimuth at a fixed elevation, and
@@ -332,6 +342,9 @@ def create_sweeping_pointings(
     date_obs : str or astropy.time.Time, optional
         The starting date of the observation (UTC).
     random_hwp : bool
+    seed : int, optional
+        Random seed of the HWP angles. By default, NumPy's global random
+        state is used.
 
     Returns
     -------
@@ -394,7 +407,8 @@ def create_sweeping_pointings(
     out.elevation = elptg
     out.pitch = pitch
     if random_hwp:
-        out.angle_hwp = np.random.randint(0, int(90 / hwp_stepsize + 1), nsamples) * hwp_stepsize
+        r = np.random if seed is None else np.random.RandomState(seed)
+        out.angle_hwp = r.randint(0, int(90 / hwp_stepsize + 1), nsamples) * hwp_stepsize
     else:
         out.angle_hwp = np.zeros(nsamples)
         max_sweeps = np.max(isweeps)
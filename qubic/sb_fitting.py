@@ -19,6 +19,11 @@ import healpy as hp
 import time
 import numexpr as ne
 import pickle
+import copy
+import multiprocessing
+import os
+import functools
+from qubic.utils import _LRUCache
 
 
 def get_hpmap(TESNum, directory):
@@ -48,11 +53,30 @@ def show_lines(maps, nums, min=None, max=None):
     tight_layout()
 
 
+_FLAT_CACHE_SIZE = 4
+_flat_files = _LRUCache(_FLAT_CACHE_SIZE)
+
+
+def read_flat_file(filename):
+    """
+    Reads the azimuth or elevation FITS file of flat maps. The arrays read are cached
+    (read-only) since they are shared by all the TES of a directory. The cache is invalidated
+    if the file is modified.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key in _flat_files:
+        return _flat_files[key]
+    data = np.array(FitsArray(filename))
+    data.flags.writeable = False
+    _flat_files[key] = data
+    return data
+
+
 def get_flatmap(TESNum, directory, azmin=None, azmax=None, elmin=None, elmax=None, remove=None,
                 fitted_directory=None):
     themap = np.array(FitsArray(directory + '/Flat/imgflat_TESNum_{}.fits'.format(TESNum)))
-    az = np.array(FitsArray(directory + '/Flat/azimuth.fits'.format(TESNum)))
-    el = np.array(FitsArray(directory + '/Flat/elevation.fits'.format(TESNum)))
+    az = read_flat_file(directory + '/Flat/azimuth.fits')
+    el = read_flat_file(directory + '/Flat/elevation.fits')
     if azmin is None:
         azmin = np.min(az)
     if azmax is None:
@@ -179,6 +203,126 @@ def rotate_q2m(thin, phin, angs=np.radians(np.array([0., 90., 0.])), inverse=Fal
     return uv2thph(uvecout)
 
 
+### Vectorized kernels shared by the synthesized beam models
+def grid_peaks_positions(xxyy, pars, mask_zeros=True, jacobian=False):
+    """
+    Positions of the peaks of the square grid xxyy (2, npeaks) for the geometrical parameters
+    pars[0:8] = [AzCenter, ElCenter, PeakDist, Angle, XDistAmp, XDistPow, YDistAmp, YDistPow]
+    common to all the synthesized beam models. If mask_zeros is True, the distorsion of x (resp. y)
+    is only applied to the peaks whose y (resp. x) coordinate is not zero.
+    If jacobian is True, the derivatives of the positions with respect to pars[0:8] are also
+    returned as an array with shape (2, npeaks, 8).
+    """
+    xc, yc, dist, angle, distx, distpowerX, disty, distpowerY = pars[0:8]
+    # Rotate initial Grid centered on (0,0)
+    cosang = np.cos(np.radians(angle))
+    sinang = np.sin(np.radians(angle))
+    rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
+    uu = np.dot(rotmat, xxyy)
+    # Scale it wit interpeak distance
+    vv = dist * uu
+    absvv = np.abs(vv)
+    if mask_zeros:
+        # x is distorted by y and y by x, so that the mask is that of the distorting coordinate
+        ok = (vv != 0)[::-1]
+    else:
+        ok = np.ones(vv.shape, dtype=bool)
+    # Apply Distorsions: x is distorted by y and y by x
+    powers = np.array([distpowerX, distpowerY])[:, None]
+    distamps = np.array([distx, disty])[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vpow = np.where(ok, absvv[::-1] ** powers, 0.)
+    positions = vv + distamps * vpow + np.array([xc, yc])[:, None]
+
+    if not jacobian:
+        return positions
+
+    npeaks = xxyy.shape[1]
+    jac = np.zeros((2, npeaks, 8))
+    nz = ok & (absvv[::-1] != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Derivative of the distorsion term with respect to the distorting coordinate
+        dpow = np.where(nz, distamps * powers * absvv[::-1] ** (powers - 1) * np.sign(vv[::-1]), 0.)
+        logv = np.where(nz, np.log(absvv[::-1]), 0.)
+    dvv_ddist = uu
+    dvv_dangle = np.radians(1.) * dist * np.array([-uu[1], uu[0]])
+    jac[0, :, 0] = 1
+    jac[1, :, 1] = 1
+    jac[:, :, 2] = dvv_ddist + dpow * dvv_ddist[::-1]
+    jac[:, :, 3] = dvv_dangle + dpow * dvv_dangle[::-1]
+    jac[0, :, 4] = vpow[0]
+    jac[0, :, 5] = distamps[0] * vpow[0] * logv[0]
+    jac[1, :, 6] = vpow[1]
+    jac[1, :, 7] = distamps[1] * vpow[1] * logv[1]
+    return positions, jac
+
+
+def gaussian_peaks_map(x2d, y2d, x0, y0, amps, sigs, jacobian=False):
+    """
+    Sum of symmetric Gaussian peaks centered on (x0, y0) with amplitudes amps and widths sigs
+    (all with shape (npeaks,)) evaluated on the pixels (x2d, y2d) with a single broadcast
+    (npeaks, npix) computation. The map is returned flattened.
+    If jacobian is True, the derivatives of the map with respect to x0, y0, amps and sigs are
+    also returned as an array with shape (4, npeaks, npix).
+    """
+    x0 = np.asarray(x0, dtype=float)[:, None]
+    y0 = np.asarray(y0, dtype=float)[:, None]
+    amps = np.asarray(amps, dtype=float)[:, None]
+    sigs = np.asarray(sigs, dtype=float)[:, None]
+    if np.ndim(x2d) == 2 and np.all(x2d == x2d[0]) and np.all(y2d == y2d[:, :1]):
+        # Pixels on a grid as given by np.meshgrid: the gaussians are separable in x and y
+        return _gaussian_peaks_grid(x2d[0], y2d[:, 0], x0, y0, amps, sigs, jacobian=jacobian)
+
+    xx = np.ravel(x2d)[None, :]
+    yy = np.ravel(y2d)[None, :]
+    dx = ne.evaluate('xx - x0')
+    dy = ne.evaluate('yy - y0')
+    gauss = ne.evaluate('exp(-0.5 * (dx**2 + dy**2) / sigs**2)')
+    themap = np.dot(amps[:, 0], gauss)
+    if not jacobian:
+        return themap
+    agauss = ne.evaluate('amps * gauss / sigs**2')
+    jac = np.empty((4,) + gauss.shape)
+    jac[0] = ne.evaluate('agauss * dx')
+    jac[1] = ne.evaluate('agauss * dy')
+    jac[2] = gauss
+    jac[3] = ne.evaluate('agauss * (dx**2 + dy**2) / sigs')
+    return themap, jac
+
+
+def _gaussian_peaks_grid(xs, ys, x0, y0, amps, sigs, jacobian=False):
+    """
+    Same as gaussian_peaks_map for pixels on a (ys, xs) grid, with peak parameters of shape (npeaks, 1).
+    Only npeaks * (nx + ny) exponentials are computed.
+    """
+    dx = xs[None, :] - x0
+    dy = ys[None, :] - y0
+    gx = np.exp(-0.5 * dx ** 2 / sigs ** 2)
+    gy = np.exp(-0.5 * dy ** 2 / sigs ** 2)
+    themap = np.ravel(np.dot((amps * gy).T, gx))
+    if not jacobian:
+        return themap
+    npeaks = len(x0)
+    agy = amps / sigs ** 2 * gy
+    outer = lambda a, b: np.reshape(a[:, :, None] * b[:, None, :], (npeaks, -1))
+    jac = np.empty((4, npeaks, len(ys) * len(xs)))
+    jac[0] = outer(agy, gx * dx)
+    jac[1] = outer(agy * dy, gx)
+    jac[2] = outer(gy, gx)
+    jac[3] = (outer(agy, gx * dx ** 2) + outer(agy * dy ** 2, gx)) / sigs
+    return themap, jac
+
+
+def peaks_jacobian(jac_map, jac_peaks):
+    """
+    Chain rule: jacobian of the map (npars, npix) from the derivatives of the map with respect
+    to the peaks (x0, y0, amps, sigs) with shape (4, npeaks, npix) and of the peaks with respect
+    to the parameters with shape (4, npeaks, npars).
+    """
+    nq, npeaks, npix = jac_map.shape
+    return np.dot(jac_peaks.reshape(nq * npeaks, -1).T, jac_map.reshape(nq * npeaks, npix))
+
+
 #######################################################################################################################################
 # ######################################################################################################################################
 class SimpleSbModel:
@@ -243,60 +387,58 @@ class SimpleSbModel:
         ### Possible extra-arguments
         self.extra_args = extra_args
 
+    def peaks(self, pars, jacobian=False):
+        """
+        Positions, amplitudes and widths (sigma) of the peaks, and if jacobian is True
+        their derivatives with respect to the parameters with shape (4, npeaks, npars)
+        """
+        pars = np.ravel(pars)
+        # Peaks positions #########################################
+        positions = grid_peaks_positions(self.xxyy, pars, mask_zeros=False, jacobian=jacobian)
+        if jacobian:
+            positions, jac_positions = positions
+        # Peak amplitudes from the primary beam ###################
+        ampgauss, xcgauss, ycgauss, fwhmgauss = pars[9:13]
+        siggauss = fwhmgauss / 2.35
+        dxg = xcgauss - positions[0]
+        dyg = ycgauss - positions[1]
+        primary = np.exp(-0.5 * (dxg ** 2 + dyg ** 2) / siggauss ** 2)
+        amps = ampgauss * primary
+        sigs = np.zeros(self.npeaks) + pars[8] / 2.35
+        if not jacobian:
+            return positions[0], positions[1], amps, sigs
+
+        jac_peaks = np.zeros((4, self.npeaks, self.npars))
+        jac_peaks[0:2, :, 0:8] = jac_positions
+        jac_peaks[2] = (amps * dxg / siggauss ** 2)[:, None] * jac_peaks[0] + \
+                       (amps * dyg / siggauss ** 2)[:, None] * jac_peaks[1]
+        jac_peaks[2, :, 9] = primary
+        jac_peaks[2, :, 10] = -amps * dxg / siggauss ** 2
+        jac_peaks[2, :, 11] = -amps * dyg / siggauss ** 2
+        jac_peaks[2, :, 12] = amps * (dxg ** 2 + dyg ** 2) / siggauss ** 3 / 2.35
+        jac_peaks[3, :, 8] = 1. / 2.35
+        return positions[0], positions[1], amps, sigs, jac_peaks
+
     def __call__(self, x, pars, return_peaks=False):
         x2d = x[0]  # The Azimuth values of the pixels
         y2d = x[1]  # The elevation values of the pixels
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks = pars[8]
-        ampgauss = pars[9]
-        xcgauss = pars[10]
-        ycgauss = pars[11]
-        fwhmgauss = pars[12]
-
-        # Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
-        newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks):
-            newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        newxxyy[0, :] += distx * np.abs(undistxxyy[1, :]) ** distpowerX
-        newxxyy[1, :] += disty * np.abs(undistxxyy[0, :]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc
-        newxxyy[1, :] += yc
-
-        ### Peak amplitudes and resulting map #######################
-        themap = np.zeros(x2d.shape)
-        amps = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amp = ampgauss * np.exp(
-                -0.5 * ((xcgauss - newxxyy[0, i]) ** 2 + (ycgauss - newxxyy[1, i]) ** 2) / (fwhmgauss / 2.35) ** 2)
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
-        newxxyy[2, :] = amps
-        newxxyy[3, :] = fwhmpeaks
+        x0, y0, amps, sigs = self.peaks(pars)
+        themap = gaussian_peaks_map(x2d, y2d, x0, y0, amps, sigs)
 
         if return_peaks:
-            return themap, newxxyy
+            newxxyy = np.array([x0, y0, amps, sigs * 2.35])
+            return np.reshape(themap, np.shape(x2d)), newxxyy
         else:
-            return np.ravel(themap)
+            return themap
+
+    def jacobian(self, x, pars):
+        """
+        Returns the model map (flattened) and its analytic derivatives with respect to
+        the parameters with shape (npars, npix)
+        """
+        x0, y0, amps, sigs, jac_peaks = self.peaks(pars, jacobian=True)
+        themap, jac_map = gaussian_peaks_map(x[0], x[1], x0, y0, amps, sigs, jacobian=True)
+        return themap, peaks_jacobian(jac_map, jac_peaks)
 
     def print_start(self):
         print('|---------------------------------------------------------------------|')
@@ -410,69 +552,51 @@ class SbModelIndepPeaksAmpFWHM:
 
         if verbose: self.print_start()
 
+    def peaks(self, pars, jacobian=False):
+        """
+        Positions, amplitudes and widths (sigma) of the peaks, and if jacobian is True
+        their derivatives with respect to the parameters with shape (4, npeaks, npars)
+        """
+        pars = np.ravel(pars)
+        ### Peaks positions #########################################
+        positions = grid_peaks_positions(self.xxyy, pars, jacobian=jacobian)
+        if jacobian:
+            positions, jac_positions = positions
+        if not np.all(np.isfinite(positions)):
+            raise ValueError('The peak positions are not finite')
+        amps = pars[9:9 + 2 * self.npeaks:2]
+        fwhmpeaks = pars[8] + pars[10:10 + 2 * self.npeaks:2]
+        if not jacobian:
+            return positions[0], positions[1], amps, fwhmpeaks / 2.35
+
+        ipeaks = np.arange(self.npeaks)
+        jac_peaks = np.zeros((4, self.npeaks, self.npars))
+        jac_peaks[0:2, :, 0:8] = jac_positions
+        jac_peaks[2, ipeaks, 9 + 2 * ipeaks] = 1
+        jac_peaks[3, :, 8] = 1. / 2.35
+        jac_peaks[3, ipeaks, 10 + 2 * ipeaks] = 1. / 2.35
+        return positions[0], positions[1], amps, fwhmpeaks / 2.35, jac_peaks
+
     def __call__(self, x, pars, return_peaks=False):
         x2d = x[0]  # The Azimuth values of the pixels
-        xmin = np.min(x2d)
-        xmax = np.max(x2d)
         y2d = x[1]  # The elevation values of the pixels
-        ymin = np.min(y2d)
-        ymax = np.max(y2d)
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks_av = pars[8]
-        amps = np.zeros(self.npeaks)
-        fwhmpeaks = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amps[i] = pars[9 + 2 * i]
-            fwhmpeaks[i] = fwhmpeaks_av + pars[9 + 2 * i + 1]
-
-        ### Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
-        newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks): newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        yok = undistxxyy[1, :] != 0
-        newxxyy[0, yok] += distx * np.abs(undistxxyy[1, yok]) ** distpowerX
-        xok = undistxxyy[0, :] != 0
-        newxxyy[1, xok] += disty * np.abs(undistxxyy[0, xok]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc
-        newxxyy[1, :] += yc
-        if ~(np.product(np.isfinite(newxxyy)).astype(bool)):
-            stop
-
-        ### Peak amplitudes and resulting map #######################
-        # themap = np.zeros(x2d.shape)
-        # for i in range(self.npeaks):
-        # 	themap += amps[i]*np.exp(-((x2d-newxxyy[0,i])**2 +(y2d-newxxyy[1,i])**2)/(2*(fwhmpeaks[i]/2.35)**2) )
-        themap = np.zeros(x2d.shape)
-        for i in range(self.npeaks):
-            amp = amps[i]
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks[i] / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
-        newxxyy[2, :] = amps
-        newxxyy[3, :] = fwhmpeaks
+        x0, y0, amps, sigs = self.peaks(pars)
+        themap = gaussian_peaks_map(x2d, y2d, x0, y0, amps, sigs)
 
         if return_peaks:
-            return themap, newxxyy
+            newxxyy = np.array([x0, y0, amps, sigs * 2.35])
+            return np.reshape(themap, np.shape(x2d)), newxxyy
         else:
-            return np.ravel(themap)
+            return themap
+
+    def jacobian(self, x, pars):
+        """
+        Returns the model map (flattened) and its analytic derivatives with respect to
+        the parameters with shape (npars, npix)
+        """
+        x0, y0, amps, sigs, jac_peaks = self.peaks(pars, jacobian=True)
+        themap, jac_map = gaussian_peaks_map(x[0], x[1], x0, y0, amps, sigs, jacobian=True)
+        return themap, peaks_jacobian(jac_map, jac_peaks)
 
     def print_start(self):
         print('|---------------------------------------------------------------------|')
@@ -616,76 +740,58 @@ class SbModelIndepPeaks:
         if verbose:
             self.print_start()
 
-    def __call__(self, x, mypars, return_peaks=False, extra_args = None):
-        # t0 = time.time()
-        # self.ncalls += 1
-        # print('Call #{0} - {1:5.2f} ms '.format(self.ncalls, 1000*(t0-self.time)))
-        # self.time = t0
-        x2d, y2d = x  # The Azimuth and elevation values of the pixels
-        pars = np.ravel(mypars)
-        # The parameters ##########################################
-        xc = pars[0]
-        yc = pars[1]
-        dist = pars[2]
-        angle = pars[3]
-        distx = pars[4]
-        distpowerX = pars[5]
-        disty = pars[6]
-        distpowerY = pars[7]
-        fwhmpeaks_av = pars[8]
-        amps = np.zeros(self.npeaks)
-        fwhmpeaks = np.zeros(self.npeaks)
-        dx = np.zeros(self.npeaks)
-        dy = np.zeros(self.npeaks)
-        for i in range(self.npeaks):
-            amps[i] = pars[9 + 4 * i]
-            fwhmpeaks[i] = fwhmpeaks_av + pars[9 + 4 * i + 1]
-            dx[i] = pars[9 + 4 * i + 2]
-            dy[i] = pars[9 + 4 * i + 3]
-
+    def peaks(self, pars, jacobian=False):
+        """
+        Positions, amplitudes and widths (sigma) of the peaks, and if jacobian is True
+        their derivatives with respect to the parameters with shape (4, npeaks, npars)
+        """
+        pars = np.ravel(pars)
         ### Peaks positions #########################################
-        # Rotate initial Grid centered on (0,0)
-        cosang = np.cos(np.radians(angle))
-        sinang = np.sin(np.radians(angle))
-        rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
-        newxxyy = np.zeros((4, self.npeaks))
-        for i in range(self.npeaks): newxxyy[0:2, i] = np.dot(rotmat, self.xxyy[:, i])
-        # Scale it wit interpeak distance
-        newxxyy *= dist
-        # Apply Distorsions
-        undistxxyy = newxxyy.copy()
-        yok = undistxxyy[1, :] != 0
-        newxxyy[0, yok] += distx * np.abs(undistxxyy[1, yok]) ** distpowerX
-        xok = undistxxyy[0, :] != 0
-        newxxyy[1, xok] += disty * np.abs(undistxxyy[0, xok]) ** distpowerY
-        # Move to actual center
-        newxxyy[0, :] += xc + dx
-        newxxyy[1, :] += yc + dy
-        if ~(np.product(np.isfinite(newxxyy)).astype(bool)):
-            stop
+        positions = grid_peaks_positions(self.xxyy, pars, jacobian=jacobian)
+        if jacobian:
+            positions, jac_positions = positions
+        # Individual shifts of the peaks
+        positions[0] += pars[11:11 + 4 * self.npeaks:4]
+        positions[1] += pars[12:12 + 4 * self.npeaks:4]
+        if not np.all(np.isfinite(positions)):
+            raise ValueError('The peak positions are not finite')
+        amps = pars[9:9 + 4 * self.npeaks:4]
+        fwhmpeaks = pars[8] + pars[10:10 + 4 * self.npeaks:4]
+        if not jacobian:
+            return positions[0], positions[1], amps, fwhmpeaks / 2.35
+
+        ipeaks = np.arange(self.npeaks)
+        jac_peaks = np.zeros((4, self.npeaks, self.npars))
+        jac_peaks[0:2, :, 0:8] = jac_positions
+        jac_peaks[0, ipeaks, 11 + 4 * ipeaks] = 1
+        jac_peaks[1, ipeaks, 12 + 4 * ipeaks] = 1
+        jac_peaks[2, ipeaks, 9 + 4 * ipeaks] = 1
+        jac_peaks[3, :, 8] = 1. / 2.35
+        jac_peaks[3, ipeaks, 10 + 4 * ipeaks] = 1. / 2.35
+        return positions[0], positions[1], amps, fwhmpeaks / 2.35, jac_peaks
 
-        ### Peak amplitudes and resulting map #######################
-        # themap = np.zeros(np.shape(x2d))
-        # for i in range(self.npeaks):
-        # 	themap += amps[i]*np.exp(-((x2d-newxxyy[0,i])**2 +(y2d-newxxyy[1,i])**2)/(2*(fwhmpeaks[i]/2.35)**2) )
+    def __call__(self, x, mypars, return_peaks=False, extra_args = None):
+        x2d, y2d = x  # The Azimuth and elevation values of the pixels
 
         ### Peak amplitudes and resulting map #######################
-        ### Much faster version (gain ~3.5)
-        themap = np.zeros(x2d.shape)
-        for i in range(self.npeaks):
-            amp = amps[i]
-            x0 = newxxyy[0, i]
-            y0 = newxxyy[1, i]
-            sig = fwhmpeaks[i] / 2.35
-            themap += ne.evaluate("amp * exp(-0.5*((x2d-x0)**2 + (y2d-y0)**2)/sig**2)")
-
-        newxxyy[2, :] = amps
-        newxxyy[3, :] = fwhmpeaks
+        ### All the peaks are computed at once (npeaks x npix)
+        x0, y0, amps, sigs = self.peaks(mypars)
+        themap = gaussian_peaks_map(x2d, y2d, x0, y0, amps, sigs)
 
         if return_peaks:
-            return themap, newxxyy
+            newxxyy = np.array([x0, y0, amps, sigs * 2.35])
+            return np.reshape(themap, np.shape(x2d)), newxxyy
         else:
-            return np.ravel(themap)
+            return themap
+
+    def jacobian(self, x, mypars, extra_args=None):
+        """
+        Returns the model map (flattened) and its analytic derivatives with respect to
+        the parameters with shape (npars, npix)
+        """
+        x0, y0, amps, sigs, jac_peaks = self.peaks(mypars, jacobian=True)
+        themap, jac_map = gaussian_peaks_map(x[0], x[1], x0, y0, amps, sigs, jacobian=True)
+        return themap, peaks_jacobian(jac_map, jac_peaks)
 
     def print_start(self):
         print('|---------------------------------------------------------------------|')
@@ -767,7 +873,8 @@ def fit_sb(flatmap_init, az_init, el_init, model, newsize=70, dmax=5., az_center
     if verbose:
         print('Running Minuit with model: {}'.format(model.name))
         model.print_start()
-    mychi2 = ft.MyChi2_nocov(x, np.ravel(flatmap), np.zeros_like(np.ravel(flatmap)) + ss, model)
+    ### Uncorrelated pixels: the chi2 uses the analytic gradient of the model if available
+    mychi2 = ft.MyChi2_diag(x, np.ravel(flatmap), np.zeros_like(np.ravel(flatmap)) + ss, model)
     fit = ft.do_minuit(x, np.ravel(flatmap), np.zeros_like(np.ravel(flatmap)) + ss, parsinit,
                        functname=model, chi2=mychi2, rangepars=ranges, fixpars=fixpars,
                        force_chi2_ndf=False, verbose=False, nohesse=True, precision=precision)
@@ -882,3 +989,137 @@ def fit_sb(flatmap_init, az_init, el_init, model, newsize=70, dmax=5., az_center
         return fit, newxxyy, themap
     else:
         return fit, newxxyy
+
+
+def _fit_sb_one(args):
+    # The map, azimuth and elevation are given, or read by a function in the worker process
+    key, data, model, kwargs = args
+    try:
+        flatmap, az, el = data() if callable(data) else data
+        fit, newxxyy = fit_sb(flatmap, az, el, copy.deepcopy(model), **kwargs)
+    except Exception as e:
+        return key, e
+    return key, (fit[1], fit[2], fit[4], newxxyy)
+
+
+def _fit_sb_iter(args, nprocs):
+    # Yields the (key, result) of the fits of _fit_sb_one as they complete, the result being
+    # the exception raised if the fit failed
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            for result in pool.imap_unordered(_fit_sb_one, args):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for a in args:
+            yield _fit_sb_one(a)
+
+
+def fit_sb_many(flatmaps, az, el, model, nprocs=1, **kwargs):
+    """
+    Fits the synthesized beam model on each of the flat maps (e.g. one per TES) with fit_sb.
+    Each fit starts from a copy of the model, and the fits are distributed over a pool of
+    nprocs processes. The other keywords are passed to fit_sb.
+    Returns a structured array with one record per map and the fields 'pars' and 'errs' (fitted
+    parameters and errors), 'chi2' and 'peaks' (the newxxyy array returned by fit_sb with the
+    positions, amplitudes and FWHM of the peaks).
+    """
+    kwargs['doplot'] = False
+    kwargs['return_fitted'] = False
+    args = [(i, (flatmap, az, el), model, kwargs) for i, flatmap in enumerate(flatmaps)]
+    results = dict(_fit_sb_iter(args, nprocs))
+
+    dtype = [('pars', float, model.npars), ('errs', float, model.npars), ('chi2', float),
+             ('peaks', float, (4, model.npeaks))]
+    table = np.zeros(len(results), dtype=dtype)
+    for i in range(len(results)):
+        if isinstance(results[i], Exception):
+            raise results[i]
+        table[i] = results[i]
+    return table
+
+
+def read_fit_table(filename):
+    """
+    Reads the fits written by fit_all_tes as a structured array with the fields 'TESNum',
+    'pars', 'errs', 'chi2' and 'peaks' (sorted by TES number). A record truncated by an
+    interrupted run is ignored.
+    """
+    records, _ = _read_fit_records(filename)
+    return _make_fit_table(records)
+
+
+def _read_fit_records(filename):
+    # Returns the complete records and the position of the end of the last one
+    records = []
+    end = 0
+    if not os.path.exists(filename):
+        return records, end
+    with open(filename, 'rb') as thefile:
+        while True:
+            try:
+                records.append(pickle.load(thefile))
+            except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                break
+            end = thefile.tell()
+    return records, end
+
+
+def _make_fit_table(records):
+    if len(records) == 0:
+        return None
+    TESNum, pars, errs, chi2, peaks = records[0]
+    dtype = [('TESNum', int), ('pars', float, np.shape(pars)), ('errs', float, np.shape(errs)),
+             ('chi2', float), ('peaks', float, np.shape(peaks))]
+    table = np.zeros(len(records), dtype=dtype)
+    for i, rec in enumerate(records):
+        table[i] = tuple(rec)
+    return table[np.argsort(table['TESNum'], kind='stable')]
+
+
+def fit_all_tes(directory, TESNums, model, filename, nprocs=1, verbose=True,
+                flatmap_kwargs=None, **kwargs):
+    """
+    Fits the synthesized beam model on the flat maps of all the TES in TESNums (read with
+    get_flatmap from directory and its keywords flatmap_kwargs) with fit_sb, which receives the
+    other keywords. The TES are distributed over a pool of nprocs processes.
+
+    Each fit (TES number, fitted parameters, errors, chi2 and peaks returned by fit_sb) is
+    appended to the file filename as soon as it is done, so that an interrupted run restarts
+    where it stopped: the TES already in the file are not fitted again. A TES whose fit fails is
+    reported and not written, it will be fitted again in a next run.
+
+    Returns the fits of all the TES in the file as a structured array (see read_fit_table).
+    """
+    if flatmap_kwargs is None:
+        flatmap_kwargs = {}
+    kwargs['doplot'] = False
+    kwargs['return_fitted'] = False
+
+    # Resume from the fits already done, discarding a truncated last record
+    records, end = _read_fit_records(filename)
+    if os.path.exists(filename) and os.path.getsize(filename) > end:
+        with open(filename, 'r+b') as thefile:
+            thefile.truncate(end)
+    done = set(rec[0] for rec in records)
+    todo = [TESNum for TESNum in TESNums if TESNum not in done]
+    if verbose:
+        print('fit_all_tes: {} TES already fitted, {} to fit'.format(len(TESNums) - len(todo), len(todo)))
+
+    args = [(TESNum, functools.partial(get_flatmap, TESNum, directory, **flatmap_kwargs), model, kwargs)
+            for TESNum in todo]
+    with open(filename, 'ab') as thefile:
+        for TESNum, result in _fit_sb_iter(args, nprocs):
+            if isinstance(result, Exception):
+                print('fit_all_tes: fit of TES #{} failed: {}'.format(TESNum, result))
+                continue
+            pickle.dump((TESNum,) + result, thefile, protocol=pickle.HIGHEST_PROTOCOL)
+            thefile.flush()
+            os.fsync(thefile.fileno())
+            if verbose:
+                print('fit_all_tes: TES #{} done'.format(TESNum))
+
+    return read_fit_table(filename)
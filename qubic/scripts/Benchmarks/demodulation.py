@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Compare the batched demodulation of demodulation_lib.demodulate_JC with
+the former loop over the detectors, each of them being low-passed by an
+FFT convolution.
+
+Usage:
+    python demodulation.py [ndetectors] [duration] [nthreads]
+
+The duration is in seconds, the sampling frequency being that of the TES
+acquisition. The elapsed times and the largest relative difference between
+both methods are printed.
+
+"""
+from __future__ import division, print_function
+import sys
+import time
+import numpy as np
+import scipy.signal as scsig
+import qubic.demodulation_lib as dl
+
+ndetectors = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1000.
+nthreads = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+sampling_frequency = 156.25
+period = 1.
+
+np.random.seed(0)
+t = np.arange(int(duration * sampling_frequency)) / sampling_frequency
+src = np.sin(2 * np.pi * t / period) + 0.3
+data = np.random.randn(ndetectors, len(t)) + \
+       src * np.random.uniform(0, 5, (ndetectors, 1))
+
+
+def demodulate_loop(period, indata, indata_src, quadrature=False):
+    """ The former implementation, one detector at a time. """
+    time, data = indata
+    time_src, data_src = indata_src
+    if quadrature:
+        data_src_shift = np.interp(time_src - period / 2, time_src, data_src,
+                                   period=period)
+    size_period = int(period / (time[1] - time[0])) + 1
+    filter_period = np.ones((size_period,)) / size_period
+    demodulated = np.zeros_like(data)
+    for i in range(data.shape[0]):
+        if quadrature:
+            demod = np.sqrt((data[i] * data_src) ** 2 +
+                            (data[i] * data_src_shift) ** 2) / np.sqrt(2)
+        else:
+            demod = data[i] * data_src
+        demodulated[i] = scsig.fftconvolve(demod, filter_period, mode='same')
+    nsamples = int(4 * period / (time[1] - time[0]))
+    return time[nsamples:-nsamples], demodulated[:, nsamples:-nsamples]
+
+
+print('{} detectors, {} samples'.format(ndetectors, len(t)))
+for quadrature in False, True:
+    t0 = time.time()
+    _, ref = demodulate_loop(period, [t, data], [t, src], quadrature=quadrature)
+    t_loop = time.time() - t0
+    t0 = time.time()
+    _, out, _ = dl.demodulate_JC(period, [t, data], [t, src],
+                                 quadrature=quadrature)
+    t_batch = time.time() - t0
+    t0 = time.time()
+    _, out, _ = dl.demodulate_JC(period, [t, data], [t, src],
+                                 quadrature=quadrature, nthreads=nthreads)
+    t_threads = time.time() - t0
+    print('quadrature={}: loop {:.3f}s, batched {:.3f}s, {} threads {:.3f}s, '
+          'max relative difference {:.1e}'.format(
+              quadrature, t_loop, t_batch, nthreads, t_threads,
+              np.max(np.abs(out - ref)) / np.max(np.abs(ref))))
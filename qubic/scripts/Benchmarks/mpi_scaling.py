@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Strong and weak scaling of the distributed acquisition and map-making.
+
+The pointings and the time-ordered data are partitioned in blocks of
+detectors and samplings over the MPI processes, the maps being reduced by
+the acquisition's distribution operator.
+
+Usage:
+    mpirun -n <nprocs> python mpi_scaling.py <strong|weak> [nprocs_instrument]
+    [npointings]
+
+For the strong scaling, the number of pointings is fixed, so that the times
+should decrease as 1 / nprocs. For the weak scaling, it is proportional to
+the number of processes, so that the times should stay constant. The
+elapsed times of the slowest process are printed by the first one, as a
+line that can be collected for runs with increasing nprocs.
+
+"""
+from __future__ import division, print_function
+import sys
+import time
+import numpy as np
+import qubic
+from pyoperators import MPI
+from qubic import QubicAcquisition, QubicInstrument, QubicScene, get_pointing
+from qubic.mapmaking import tod2map_all
+
+comm = MPI.COMM_WORLD
+mode = sys.argv[1] if len(sys.argv) > 1 else 'strong'
+if mode not in ('strong', 'weak'):
+    raise ValueError("Invalid scaling mode '{}'.".format(mode))
+nprocs_instrument = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+npointings = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+niterations = 20
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['sweeping_pointing'] = False
+d['npointings'] = npointings * comm.size if mode == 'weak' else npointings
+d['seed'] = 0
+d['nside'] = 128
+d['kind'] = 'IQU'
+d['comm'] = comm
+d['nprocs_instrument'] = nprocs_instrument
+d['nprocs_sampling'] = comm.size // nprocs_instrument
+
+
+def timeit(func, *args, **keywords):
+    """ Return the output of a function and the elapsed time of the slowest
+    process. """
+    comm.Barrier()
+    t0 = time.time()
+    out = func(*args, **keywords)
+    return out, comm.allreduce(time.time() - t0, op=MPI.MAX)
+
+
+instrument = QubicInstrument(d)
+sampling = get_pointing(d)
+scene = QubicScene(d)
+acq, t_acquisition = timeit(QubicAcquisition, instrument, sampling, scene, d)
+H, t_operator = timeit(acq.get_operator)
+invntt = acq.get_invntt_operator()
+
+np.random.seed(0)
+sky = np.random.randn(*scene.shape)
+tod, t_tod = timeit(H, sky)
+A = H.T * invntt * H
+_, t_normal = timeit(A, sky)
+_, t_mapmaking = timeit(tod2map_all, acq, tod, disp=False, tol=0,
+                        maxiter=niterations)
+
+if comm.rank == 0:
+    print('# mode nprocs nprocs_instrument nprocs_sampling ndetectors '
+          'npointings acquisition operator tod normal mapmaking/iteration')
+    print('{} {} {} {} {} {} {:.3f} {:.3f} {:.3f} {:.3f} {:.3f}'.format(
+        mode, comm.size, nprocs_instrument, comm.size // nprocs_instrument,
+        len(instrument), d['npointings'], t_acquisition, t_operator, t_tod,
+        t_normal, t_mapmaking / niterations))
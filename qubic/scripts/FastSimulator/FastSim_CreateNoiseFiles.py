@@ -248,7 +248,10 @@ for nfsub in all_nf:
             'clnoise': clth_tosave}
     name = 'DataFastSimulator_' + config + '_nfsub_{}.pkl'.format(nfsub)
     pickle.dump(data, open(global_dir + 'doc/FastSimulator/Data/' + name, "wb"))
+    # Memory-mappable version read in priority by qss.read_fastsim_data
+    qss.save_fastsim_data(data, global_dir + 'doc/FastSimulator/Data/' + name.replace('.pkl', ''))
 
 datacov = {'coverage': coverage}
 name = 'DataFastSimulator_' + config + '_coverage.pkl'
 pickle.dump(datacov, open(global_dir + 'doc/FastSimulator/Data/' + name, "wb"))
+qss.save_fastsim_data(datacov, global_dir + 'doc/FastSimulator/Data/' + name.replace('.pkl', ''))
@@ -1,6 +1,7 @@
 from __future__ import division, print_function
 
 import glob
+import multiprocessing
 import numpy as np
 import pandas as pd
 import healpy as hp
@@ -13,8 +14,12 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from qubicpack.pixel_translation import tes2index, make_id_focalplane
+from qubic.utils import _LRUCache, _get_hash
 
-__all__ = ['Model_Fringes_QubicSoft', 'Model_Fringes_Maynooth']
+__all__ = ['HornResponse', 'Model_Fringes_QubicSoft', 'Model_Fringes_Maynooth']
+
+_RESPONSE_CACHE_SIZE = 16
+_horn_responses = _LRUCache(_RESPONSE_CACHE_SIZE)
 
 
 # ========== Plot functions =============
@@ -594,6 +599,191 @@ def get_response_power(q,
     return x, y, power
 
 
+def _get_beam_key(beam):
+    """
+    Return the class name and the parameters identifying a beam, such as its
+    FWHM and frequency. Derived objects like interpolators are left out.
+
+    """
+    key = [type(beam).__name__]
+    for name, value in sorted(vars(beam).items()):
+        if isinstance(value, (bool, int, float, str, list, tuple, np.number, np.ndarray)):
+            key += [name, np.asarray(value)]
+    return key
+
+
+class HornResponse:
+    """
+    Horn-resolved response of the instrument to a source.
+
+    The complex field on the focal plane E = A.B is linear in the horns, A being
+    the transmission from the horns to the focal plane (#positions, #horns) and B
+    the field from the source through each horn (#horns, #sources). A and B are
+    computed once for all the horns (and cached for the instrument, source position
+    and frequency), and the power for any set of open horns is then derived with a
+    few vector operations, without toggling q.horn.open.
+
+    Horns are numbered from 1 as on the instrument.
+
+    """
+
+    def __init__(self, q, theta, phi, nu, spectral_irradiance,
+                 frame='ONAFP', external_A=None, hwp_position=0):
+        """
+        Parameters
+        ----------
+        q: a qubic monochromatic instrument
+        theta: float or array-like
+            The source zenith angle [rad].
+        phi: float or array-like
+            The source azimuthal angle [rad].
+        nu: float
+            Source frequency in Hz.
+        spectral_irradiance : array-like
+            The source spectral_irradiance [W/m^2/Hz].
+        frame: str
+            Referential frame of the returned coordinates: 'GRF' or 'ONAFP'
+        external_A: list of tables describing the phase and amplitude at
+            each point of the focal plane for all the horns, see make_external_A()
+        hwp_position : int
+            HWP position from 0 to 7.
+
+        """
+        if frame not in ['GRF', 'ONAFP']:
+            raise ValueError('The frame is not valid. It must be GRF or ONAFP.')
+        nhorns = len(q.horn)
+        if external_A is None:
+            position = q.detector.center  # GRF
+        else:
+            if np.shape(external_A[2])[-1] != nhorns:
+                raise ValueError('external_A must describe all the {} horns.'.format(nhorns))
+            x1d = np.asarray(external_A[0])
+            y1d = np.asarray(external_A[1])
+            z1d = x1d * 0 - q.optics.focal_length
+            position = np.array([x1d, y1d, z1d]).T
+        if frame == 'GRF':
+            self.x = position[:, 0]
+            self.y = position[:, 1]
+        else:
+            # Make a pi/2 rotation from GRF -> ONAFP referential frame
+            self.x = - position[:, 1]
+            self.y = position[:, 0]
+        self.nhorns = nhorns
+        self.shape = np.broadcast(theta, phi, spectral_irradiance).shape
+        self.A, self.B = self._get_AB(q, theta, phi, nu, spectral_irradiance, position,
+                                      external_A, hwp_position)
+        self.field_all = np.dot(self.A, self.B)
+
+    @staticmethod
+    def _get_AB(q, theta, phi, nu, spectral_irradiance, position, external_A, hwp_position):
+        args = [theta, phi, spectral_irradiance]
+        if external_A is not None:
+            args += list(external_A)
+        key = _get_hash(position, q.detector.area, q.horn.center, q.horn.radeff, nu, hwp_position,
+                        *(_get_beam_key(q.primary_beam) + _get_beam_key(q.secondary_beam) +
+                          [np.asarray(a, dtype=float) for a in args]))
+        if key in _horn_responses:
+            return _horn_responses[key]
+
+        # All horns are opened to get the contribution of each of them
+        open_horns = q.horn.open.copy()
+        q.horn.open = True
+        try:
+            A = q._get_response_A(position, q.detector.area, nu, q.horn, q.secondary_beam,
+                                  external_A=external_A, hwp_position=hwp_position)
+            B = q._get_response_B(theta, phi, spectral_irradiance, nu, q.horn, q.primary_beam)
+        finally:
+            q.horn.open = open_horns
+        A = np.asarray(A)
+        B = B.reshape((B.shape[0], -1))
+        A.flags.writeable = False
+        B.flags.writeable = False
+        _horn_responses[key] = A, B
+        return A, B
+
+    def _horn_fields(self, horns):
+        # Field of each of the given horns (#horns, #positions, #sources)
+        index = np.asarray(horns, dtype=int) - 1
+        return self.A.T[index][:, :, None] * self.B[index][:, None, :]
+
+    def get_field(self, open_horns=None, closed_horns=None):
+        """
+        Complex field on the focal plane with only the horns open_horns open, or with all
+        the horns open except closed_horns. The horns can also be given as a boolean
+        array like q.horn.open. With no argument, all the horns are open.
+
+        """
+        if open_horns is not None and closed_horns is not None:
+            raise ValueError('Give either the open horns or the closed horns.')
+        if open_horns is not None:
+            open_horns = np.asarray(open_horns)
+            if open_horns.dtype == bool:
+                open_horns = np.where(np.ravel(open_horns))[0] + 1
+            if 2 * len(open_horns) > self.nhorns:
+                closed = np.setdiff1d(np.arange(1, self.nhorns + 1), open_horns)
+                return self.get_field(closed_horns=closed)
+            index = open_horns.astype(int) - 1
+            field = np.dot(self.A[:, index], self.B[index])
+        elif closed_horns is not None:
+            closed_horns = np.asarray(closed_horns)
+            if closed_horns.dtype == bool:
+                closed_horns = np.where(np.ravel(closed_horns))[0] + 1
+            index = closed_horns.astype(int) - 1
+            field = self.field_all - np.dot(self.A[:, index], self.B[index])
+        else:
+            field = self.field_all
+        return field.reshape((-1,) + self.shape)
+
+    def get_power(self, open_horns=None, closed_horns=None):
+        """
+        Power on the focal plane for a set of open horns, see get_field().
+
+        """
+        return np.abs(self.get_field(open_horns=open_horns, closed_horns=closed_horns)) ** 2
+
+    def get_all_combinations_power(self, baseline):
+        """
+        Power on the focal plane for the configurations of the horn array used for the
+        baseline [i, j]: all open, all open except i, except i and j, except j,
+        only i open, only j open, only i and j open.
+
+        Returns
+        -------
+        S, Cminus_i, Sminus_ij, Cminus_j, Ci, Cj, Sij : arrays
+
+        """
+        Ei, Ej = self._horn_fields(baseline)
+        shape = (-1,) + self.shape
+        power = lambda field: (np.abs(field) ** 2).reshape(shape)
+        return (power(self.field_all), power(self.field_all - Ei), power(self.field_all - Ei - Ej),
+                power(self.field_all - Ej), power(Ei), power(Ej), power(Ei + Ej))
+
+    def get_fringes(self, baselines, measured_comb=True):
+        """
+        Fringes on the focal plane for many baselines at once.
+        With measured_comb, they are given by the combination S - C_-i - C_-j + S_-ij
+        which is 2 Re(E_i E_j*), otherwise by S_ij = |E_i + E_j|^2.
+
+        Parameters
+        ----------
+        baselines: array-like of shape (#baselines, 2)
+            Baselines formed with 2 horns, index between 1 and #horns.
+
+        Returns
+        -------
+        fringes: array of shape (#baselines, #positions, ...)
+
+        """
+        baselines = np.atleast_2d(baselines)
+        Ei = self._horn_fields(baselines[:, 0])
+        Ej = self._horn_fields(baselines[:, 1])
+        if measured_comb:
+            fringes = 2 * np.real(Ei * np.conj(Ej))
+        else:
+            fringes = np.abs(Ei + Ej) ** 2
+        return fringes.reshape((len(baselines), -1) + self.shape)
+
+
 def get_power_Maynooth(rep, open_horns, theta, nu, horn_center, hwp_position=0, verbose=True):
     """
     Get power on the focal plane from Maynooth simulations.
@@ -872,50 +1062,146 @@ def get_chi2(params, allInvCov, allData, BLs, q, nu_source=150e9, returnA=False)
         return chi2
 
 
+def get_fringes_geometry(q, BLs):
+    """
+    Geometry of the analytical fringes of Model_Fringes_Ana (ONAFP frame), that does
+    not depend on the focal length nor on the source angle.
+
+    Returns
+    -------
+    xprime: array of shape (#baselines, #TES)
+        TES coordinates along each baseline.
+    lengths: array of shape (#baselines)
+        Baseline lengths.
+    dists: array of shape (#baselines)
+        Distances of the baseline centers to the optical axis.
+    """
+    x, y, _ = get_TEScoordinates_ONAFP(q)
+    xprime = np.empty((len(BLs), len(x)))
+    lengths = np.empty(len(BLs))
+    dists = np.empty(len(BLs))
+    for k, BL in enumerate(BLs):
+        BL_angle, lengths[k], BL_center = give_bs_pars(q, BL, frame='ONAFP')
+        BL_angle = np.deg2rad(BL_angle)
+        xprime[k] = x * np.cos(BL_angle) + y * np.sin(BL_angle)
+        dists[k] = np.sqrt(BL_center[0] ** 2 + BL_center[1] ** 2)
+    return xprime, lengths, dists
+
+
+def get_fringes_grid(xprime, lengths, dists, all_fl, all_th, nu_source=150e9):
+    """
+    Analytical fringes (as Model_Fringes_Ana.get_fringes(times_gaussian=False)) of all the
+    baselines for all the focal lengths all_fl and source off-axis angles all_th at once.
+    See get_fringes_geometry() for the first arguments.
+
+    Returns
+    -------
+    Phi: array of shape (#fl, #th, #baselines, #TES)
+    """
+    all_fl = np.atleast_1d(all_fl)
+    all_th = np.atleast_1d(all_th)
+    lam = 3e8 / nu_source
+    # Spatial frequency of the fringes (#fl, #baselines) and phase (#th, #baselines)
+    freq = 2. * np.pi * lengths / (lam * all_fl[:, None])
+    phase = - 2 * np.pi / 3e8 * nu_source * dists * np.sin(all_th[:, None])
+    return np.cos(freq[:, None, :, None] * xprime + phase[None, :, :, None])
+
+
+def _get_chi2_stack(allPowerPhi, allInvCov, allData):
+    """
+    Chi2 of get_chi2() for a stack of models allPowerPhi with shape (..., #images, #TES):
+    the detector gains are solved in batch for all the models.
+    allInvCov is either the diagonals of the inverse covariance matrices (#images, #TES)
+    or the matrices themselves (#images, #TES, #TES).
+    """
+    if allInvCov.ndim == 2:
+        # Diagonal covariances: the normal equations are independent for each detector
+        InvCov_A = np.sum(allPowerPhi ** 2 * allInvCov, axis=-2)
+        Term = np.sum(allPowerPhi * allInvCov * allData, axis=-2)
+        A = Term / InvCov_A
+        weights = InvCov_A
+    else:
+        InvCov_A = np.einsum('...ki,kij,...kj->...ij', allPowerPhi, allInvCov, allPowerPhi, optimize=True)
+        Term = np.einsum('...ki,kij,kj->...i', allPowerPhi, allInvCov, allData, optimize=True)
+        Cov_A = np.linalg.inv(InvCov_A)
+        A = np.einsum('...ij,...j->...i', Cov_A, Term)
+        weights = 1 / np.diagonal(Cov_A, axis1=-2, axis2=-1)
+
+    # Normalization
+    A /= (np.sum(A * weights, axis=-1) / np.sum(weights, axis=-1))[..., None]
+
+    R = allPowerPhi * A[..., None, :] - allData
+    if allInvCov.ndim == 2:
+        return np.sum(R ** 2 * allInvCov, axis=(-2, -1))
+    return np.einsum('...ki,kij,...kj->...', R, allInvCov, R, optimize=True)
+
+
+def _make_chi2_rows(args):
+    irows, all_fl, all_th, xprime, lengths, dists, nu_source, allInvCov, allData, LogPower, fixPower = args
+    nimages = len(lengths)
+    chi2 = np.zeros((len(irows), len(all_th)))
+    powers = np.zeros((len(irows), len(all_th), nimages))
+    for r, i in enumerate(irows):
+        Phi = get_fringes_grid(xprime, lengths, dists, all_fl[i], all_th, nu_source=nu_source)[0]
+        if fixPower:
+            chi2[r] = _get_chi2_stack(Phi * 10 ** LogPower, allInvCov, allData)
+            continue
+        for j in range(len(all_th)):
+            def chi2_temporary(mypower):
+                return _get_chi2_stack(Phi[j] * 10 ** np.asarray(mypower)[:, None], allInvCov, allData)
+
+            result = sop.minimize(chi2_temporary,
+                                  x0=[LogPower] * nimages,
+                                  method='Nelder-Mead',
+                                  options={'maxiter': 10000})
+            chi2[r, j] = result['fun']
+            powers[r, j, :] = result['x']
+
+            print(f'\n***Step {i * len(all_th) + j + 1}/{len(all_fl) * len(all_th)}')
+            print('Chi2 min:', result['fun'])
+            print('with powers =', result['x'])
+    return chi2, powers
+
+
 def make_chi2_grid(allInvCov, fringes, BLs, q, nval_fl=30, nval_th=30, fl_min=0.25, fl_max=0.35,
-                   th_min=np.deg2rad(-1.), th_max=np.deg2rad(1), LogPower=-1, fixPower=True):
-    """Loop over the parameters (focal length and source off-axis angle) to explore the chi2.
-    Global powers are fixed to Log_10(Power)=-1 or optimized at each step by minimizing a temporary chi2 (longer)."""
+                   th_min=np.deg2rad(-1.), th_max=np.deg2rad(1), LogPower=-1, fixPower=True,
+                   nu_source=150e9, nprocs=1):
+    """Explore the chi2 of get_chi2() on a grid of the parameters (focal length and source off-axis angle).
+    Global powers are fixed to Log_10(Power)=-1 or optimized at each step by minimizing a temporary chi2 (longer).
+    The fringe models are computed for the whole grid at once and the detector gains are solved in batch.
+    The rows of the grid (focal lengths) are distributed over a pool of nprocs processes."""
     nimages = len(BLs)
-    chi2_grid = np.zeros((nval_fl, nval_th))
 
     all_fl = np.linspace(fl_min, fl_max, nval_fl)
     all_th = np.linspace(th_min, th_max, nval_th)
 
-    # Fast method
+    xprime, lengths, dists = get_fringes_geometry(q, BLs)
+    allData = np.array(fringes)
+    allInvCov = np.array(allInvCov)
+    if all(np.count_nonzero(N - np.diag(np.diagonal(N))) == 0 for N in allInvCov):
+        allInvCov = np.diagonal(allInvCov, axis1=-2, axis2=-1)
+
+    chunks = np.array_split(np.arange(nval_fl), max(1, min(nprocs, nval_fl)))
+    args = [(irows, all_fl, all_th, xprime, lengths, dists, nu_source, allInvCov, allData, LogPower, fixPower)
+            for irows in chunks]
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            results = pool.map(_make_chi2_rows, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_make_chi2_rows(a) for a in args]
+    chi2_grid = np.concatenate([r[0] for r in results])
+
+    # Fast method: global powers are fixed to LogPower
     if fixPower:
-        # Global powers are fixed to initPower and we loop on fl and th.
-        for i, fl in enumerate(all_fl):
-            for j, th in enumerate(all_th):
-                params = [fl, th] + [LogPower] * nimages
-                chi2_grid[i, j] = get_chi2(params, allInvCov, fringes, BLs, q)
         return all_fl, all_th, chi2_grid
 
-    # Slow method but more rigorous
-    else:
-        # Loop on fl and th and at each step, minimize the chi2 to find the best global powers.
-        power_optimize = np.zeros((nval_fl, nval_th, nimages))
-        step = 0
-        for i, fl in enumerate(all_fl):
-            for j, th in enumerate(all_th):
-                def chi2_temporary(mypower, allInvCov, fringes, BLs, q):
-                    params = [fl, th] + list(mypower)
-                    chi2_temp = get_chi2(params, allInvCov, fringes, BLs, q)
-                    return chi2_temp
-
-                result = sop.minimize(chi2_temporary,
-                                      x0=[LogPower] * nimages,
-                                      args=(allInvCov, fringes, BLs, q),
-                                      method='Nelder-Mead',
-                                      options={'maxiter': 10000})
-                chi2_grid[i, j] = result['fun']
-                power_optimize[i, j, :] = result['x']
-
-                print(f'\n***Step {step + 1}/{nval_fl * nval_th}')
-                print('Chi2 min:', result['fun'])
-                print('with powers =', result['x'])
-                step += 1
-        return all_fl, all_th, chi2_grid, power_optimize
+    # Slow method but more rigorous: at each step, the chi2 is minimized to find the best global powers.
+    power_optimize = np.concatenate([r[1] for r in results])
+    return all_fl, all_th, chi2_grid, power_optimize
 
 
 # ========== Fringe simulations =============
@@ -1065,63 +1351,29 @@ class Model_Fringes_QubicSoft:
 
         """
 
-        self.q.horn.open = True
-
-        # All open
-        self.x, self.y, S = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                     self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, S, frame=self.frame, title='$S$ - All open', **kwargs)
-
-        # All open except i
-        self.q.horn.open[self.baseline[0] - 1] = False
-        _, _, Cminus_i = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                            self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Cminus_i, frame=self.frame,
-                             title='$C_{-i}$' + f' - Horn {self.baseline[0]} close', **kwargs)
-
-        # All open except baseline [i, j]
-        self.q.horn.open[self.baseline[1] - 1] = False
-        _, _, Sminus_ij = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                             self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Sminus_ij, frame=self.frame,
-                             title='$S_{-ij}$' + f' - Baseline {self.baseline} close', **kwargs)
-
-        # All open except j
-        self.q.horn.open[self.baseline[0] - 1] = True
-        _, _, Cminus_j = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                            self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Cminus_j, frame=self.frame,
-                             title='$C_{-j}$' + f' - Horn {self.baseline[1]} close', **kwargs)
-
-        # Only i open (not a realistic observable)
-        self.q.horn.open = False
-        self.q.horn.open[self.baseline[0] - 1] = True
-        _, _, Ci = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                      self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Ci, frame=self.frame,
-                             title='$C_i$' + f' - Only horn {self.baseline[0]} open', **kwargs)
-
-        # Only j open (not a realistic observable)
-        self.q.horn.open[self.baseline[0] - 1] = False
-        self.q.horn.open[self.baseline[1] - 1] = True
-        _, _, Cj = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                      self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Cj, frame=self.frame,
-                             title='$C_j$' + f' - Only horn {self.baseline[1]} open', **kwargs)
-
-        # Only baseline [i, j] open (not a realistic observable)
-        self.q.horn.open[self.baseline[0] - 1] = True
-        _, _, Sij = get_response_power(self.q, self.theta_source, self.phi_source, self.nu_source,
-                                       self.spec_irrad_source, frame=self.frame, verbose=verbose)
-        if doplot:
-            plot_horn_and_FP(self.q, self.x, self.y, Sij, frame=self.frame,
-                             title='$S_{ij}$' + f' - Only baseline {self.baseline} open', **kwargs)
+        # All the configurations are derived from the response of each horn computed once
+        response = HornResponse(self.q, self.theta_source, self.phi_source, self.nu_source,
+                                self.spec_irrad_source, frame=self.frame)
+        self.x, self.y = response.x, response.y
+        S, Cminus_i, Sminus_ij, Cminus_j, Ci, Cj, Sij = response.get_all_combinations_power(self.baseline)
+        if verbose:
+            print('Detector centers shape:', self.q.detector.center.shape)
+            print('Power shape:', S.shape)
+
+        i, j = self.baseline[0] - 1, self.baseline[1] - 1
+        configurations = [(S, [], True, '$S$ - All open'),
+                          (Cminus_i, [i], True, '$C_{-i}$' + f' - Horn {self.baseline[0]} close'),
+                          (Sminus_ij, [i, j], True, '$S_{-ij}$' + f' - Baseline {self.baseline} close'),
+                          (Cminus_j, [j], True, '$C_{-j}$' + f' - Horn {self.baseline[1]} close'),
+                          (Ci, [i], False, '$C_i$' + f' - Only horn {self.baseline[0]} open'),
+                          (Cj, [j], False, '$C_j$' + f' - Only horn {self.baseline[1]} open'),
+                          (Sij, [i, j], False, '$S_{ij}$' + f' - Only baseline {self.baseline} open')]
+        for power, horns, opened, title in configurations:
+            # Set the horn array in each configuration for the plots (it ends with only the baseline open)
+            self.q.horn.open = opened
+            self.q.horn.open[horns] = not opened
+            if doplot:
+                plot_horn_and_FP(self.q, self.x, self.y, power, frame=self.frame, title=title, **kwargs)
 
         return self.x, self.y, S, Cminus_i, Sminus_ij, Cminus_j, Ci, Cj, Sij
 
@@ -1,8 +1,11 @@
 from __future__ import division, print_function
 
+from collections import OrderedDict
 from progressbar import ProgressBar, Bar, ETA, Percentage
+import hashlib
 import numpy as np
 import signal
+import tempfile
 import traceback
 import os
 import string
@@ -70,6 +73,68 @@ def progress_bar(n, info=''):
                                  ETA()], maxval=n).start()
 
 
+class _LRUCache(OrderedDict):
+    """
+    Dictionary which keeps at most maxsize items, discarding the least
+    recently used ones.
+
+    """
+    def __init__(self, maxsize):
+        OrderedDict.__init__(self)
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def _get_hash(*args):
+    """
+    Return the SHA-1 hash identifying cached data. The arrays are hashed
+    through their shape, dtype and content, the other arguments through
+    their representation.
+
+    """
+    sha = hashlib.sha1()
+    for a in args:
+        if isinstance(a, np.ndarray):
+            sha.update(repr((a.shape, a.dtype.str)).encode())
+            sha.update(np.ascontiguousarray(a).tobytes())
+        else:
+            sha.update(repr(a).encode())
+        sha.update(b'|')
+    return sha.hexdigest()
+
+
+def _save_atomic(filename, write):
+    """
+    Write a file through a temporary file, so that concurrent processes
+    never read it partially written. The function write is called with
+    the name of the temporary file, which has the extension of filename.
+
+    """
+    path = os.path.dirname(filename)
+    if path and not os.path.isdir(path):
+        os.makedirs(path)
+    fd, tmpname = tempfile.mkstemp(dir=path or '.',
+                                   suffix=os.path.splitext(filename)[1])
+    os.close(fd)
+    try:
+        write(tmpname)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
 def _compress_mask(mask):
     mask = mask.ravel()
     if len(mask) == 0:
@@ -1,11 +1,21 @@
 from __future__ import division
 
+import multiprocessing
+from functools import partial
+
 import healpy as hp
 import numpy as np
-import pysimulators._flib as flib
+from . import _flib as flib
+from .utils import _LRUCache, _get_hash
 
 __all__ = ['Xpol']
 
+# mask spectra and unbinned coupling matrix blocks shared by the Xpol
+# instances, the least recently used are dropped
+_MLL_CACHE_SIZE = 8
+_mask_spectra = _LRUCache(_MLL_CACHE_SIZE)
+_mll_blocks = _LRUCache(_MLL_CACHE_SIZE)
+
 
 class Xpol(object):
     """
@@ -18,6 +28,7 @@ class Xpol(object):
     ell_binned = xpol.ell_binned
     biased, unbiased = xpol.get_spectra(map)
     biased, unbiased = xpol.get_spectra(map1, map2)
+    biased, unbiased = xpol.get_spectra_many(maps)
 
     """
     def __init__(self, mask, lmin, lmax, delta_ell):
@@ -43,7 +54,7 @@ class Xpol(object):
         if lmax < lmin:
             raise ValueError('Input lmax is less than lmin.')
         delta_ell = int(delta_ell)
-        wl = hp.anafast(mask)[:lmax+1]
+        wl = _get_mask_spectrum(mask)[:lmax+1]
         self.mask = mask
         self.lmin = lmin
         self.lmax = lmax
@@ -116,6 +127,63 @@ class Xpol(object):
         unbiased /= fact_binned
         return biased, unbiased
 
+    def get_spectra_many(self, maps, pairs=None, nprocs=1):
+        """
+        Return biased and Xpol-debiased estimations of the power spectra and
+        cross-power spectra of several maps, such as the sub-band maps of
+        a realization. The alms of each masked map are computed once and
+        the spectra of all the pairs are debiased by a single matrix product.
+
+        xpol = Xpol(mask, lmin, lmax, delta_ell)
+        biased, unbiased = xpol.get_spectra_many(maps, [pairs])
+
+        Parameters
+        ----------
+        maps : array of shape (nmaps, 3, N) or (nmaps, N, 3)
+            The I, Q, U Healpix maps. With a leading dimension of
+            realizations, of shape (nreal, nmaps, 3, N) or (nreal, nmaps, N, 3),
+            the spectra of each realization are computed.
+        pairs : sequence of (int, int), optional
+            The indices of the maps whose (cross-) power spectra are computed.
+            By default, all the pairs (i, j) with i <= j.
+        nprocs : int, optional
+            Number of processes over which the realizations are distributed.
+
+        Returns
+        -------
+        biased : float array of shape ([nreal,] npairs, 6, lmax+1)
+            The anafast's pseudo (cross-) power spectra for TT, EE, BB, TE, EB,
+            TB of each pair, as returned by get_spectra.
+
+        unbiased : float array of shape ([nreal,] npairs, 6, nbins)
+            The Xpol's (cross-) power spectra for TT, EE, BB, TE, EB, TB of
+            each pair, as returned by get_spectra.
+
+        """
+        maps = np.asarray(maps)
+        if maps.ndim == 4:
+            func = partial(_get_spectra_many, self, pairs)
+            if nprocs == 1:
+                out = [func(m) for m in maps]
+            else:
+                with multiprocessing.Pool(nprocs) as pool:
+                    out = pool.map(func, maps)
+            return np.array([o[0] for o in out]), np.array([o[1] for o in out])
+
+        if maps.shape[-1] == 3:
+            maps = np.swapaxes(maps, 1, 2)
+        if pairs is None:
+            pairs = [(i, j) for i in range(len(maps)) for j in range(i, len(maps))]
+        alms = [hp.map2alm(m * self.mask, pol=True) for m in maps]
+        biased = np.array([[cl[:self.lmax+1] for cl in hp.alm2cl(alms[i], alms[j])]
+                           for i, j in pairs])
+        binned = self.bin_spectra(biased)
+        fact_binned = self.ell_binned * (self.ell_binned + 1) / (2 * np.pi)
+        binned *= fact_binned
+        unbiased = np.dot(binned.reshape(len(pairs), -1), self.mll_binned_inv.T)
+        unbiased = unbiased.reshape(len(pairs), 6, -1) / fact_binned
+        return biased, unbiased
+
     def _bin_ell(self):
         nbins = (self.lmax - self.lmin + 1) // self.delta_ell
         start = self.lmin + np.arange(nbins) * self.delta_ell
@@ -134,6 +202,11 @@ class Xpol(object):
         return ell_binned, p, q
 
     def _get_Mll_blocks(self):
+        # the unbinned blocks only depend on the mask spectrum up to lmax,
+        # so that they are reused by the Xpol instances with another binning
+        key = _get_hash(self.lmax, self.wl)
+        if key in _mll_blocks:
+            return _mll_blocks[key]
         TT_TT, EE_EE, EE_BB, TE_TE, EB_EB, ier = flib.xpol.mll_blocks_pol(
             self.lmax, self.wl)
         if ier > 0:
@@ -143,7 +216,11 @@ class Xpol(object):
                    'L1MAX less than L1MIN.',
                    'NDIM less than L1MAX-L1MIN+1.'][ier-1]
             raise RuntimeError(msg)
-        return TT_TT, EE_EE, EE_BB, TE_TE, EB_EB
+        blocks = TT_TT, EE_EE, EE_BB, TE_TE, EB_EB
+        for block in blocks:
+            block.flags.writeable = False
+        _mll_blocks[key] = blocks
+        return blocks
 
     def _get_Mll(self, binning=True):
         TT_TT, EE_EE, EE_BB, TE_TE, EB_EB = self._get_Mll_blocks()
@@ -168,3 +245,21 @@ class Xpol(object):
         out[4*n:5*n, 4*n:5*n] = TE_TE
         out[5*n:6*n, 5*n:6*n] = EB_EB
         return out
+
+
+def _get_spectra_many(xpol, pairs, maps):
+    return xpol.get_spectra_many(maps, pairs=pairs)
+
+
+def _get_mask_spectrum(mask):
+    """
+    Return the power spectrum of the mask, computed once per mask.
+
+    """
+    key = _get_hash(mask)
+    if key in _mask_spectra:
+        return _mask_spectra[key]
+    wl = hp.anafast(mask)
+    wl.flags.writeable = False
+    _mask_spectra[key] = wl
+    return wl
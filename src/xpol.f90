@@ -41,12 +41,14 @@ contains
     well_PP = thewell
     
     ier = 0
-    !$omp parallel do default(private) &
+    ! The sums are symmetric in (l1, l2): only l2 >= l1 is computed. The cost
+    ! of a row decreasing with l1, the rows are dynamically scheduled.
+    !$omp parallel do default(private) schedule(dynamic) &
     !$omp& shared(ier, lmax, nwell, well_tt, well_tp, well_pp) &
     !$omp& shared(mll_TT_TT, mll_EE_EE, mll_EE_BB, mll_TE_TE, mll_EB_EB)
     do l1=0, lmax
       rl1 = real(l1, real64)
-      do l2=0, lmax
+      do l2=l1, lmax
         rl2 = real(l2, real64)
         ndim = l1 + l2 + 1
         call wig3j(rl1, rl2, 0.d0, 0.d0, rl1min, rl1max, wigner0, ndim, ier_)
@@ -94,6 +96,13 @@ contains
         mll_TE_TE(l1, l2) = coef * sum_TE
         mll_EB_EB(l1, l2) = coef * sum_EB
 
+        coef = (2 * l1 + 1) * one_fourpi
+        mll_TT_TT(l2, l1) = coef * sum_TT
+        mll_EE_EE(l2, l1) = coef * sum_EE_EE
+        mll_EE_BB(l2, l1) = coef * sum_EE_BB
+        mll_TE_TE(l2, l1) = coef * sum_TE
+        mll_EB_EB(l2, l1) = coef * sum_EB
+
       end do
     end do
     !$omp end parallel do
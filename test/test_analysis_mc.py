@@ -0,0 +1,143 @@
+from __future__ import division
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from qubic.AnalysisMC import (
+    RunningStatistics, _cov2corr_stack, _realization_covariance,
+    covariance_IQU_subbands, get_covcorr1pix, get_covcorr_between_pix,
+    get_covcorr_patch, get_rms_covar)
+
+np.random.seed(0)
+nreal, nsub, npix = 30, 3, 25
+mixing = np.random.randn(3 * nsub, 3 * nsub)
+patch = np.einsum('rpi,ij->rpj', np.random.randn(nreal, npix, 3 * nsub),
+                  mixing).reshape(nreal, npix, nsub, 3).transpose(0, 2, 1, 3)
+
+
+def test_realization_covariance():
+    data = patch.reshape(nreal, -1, 3)
+    for ddof in [0, 1]:
+        cov = _realization_covariance(data, ddof=ddof)
+        for ipix in [0, 7, data.shape[1] - 1]:
+            assert_allclose(cov[ipix],
+                            np.cov(data[:, ipix], rowvar=False, ddof=ddof))
+    corr = _cov2corr_stack(_realization_covariance(data))
+    for ipix in [0, 7, data.shape[1] - 1]:
+        assert_allclose(corr[ipix], np.corrcoef(data[:, ipix], rowvar=False),
+                        atol=1e-14)
+
+
+def test_get_covcorr_patch():
+    def func(stokesjoint, chunk_size):
+        cov, corr = get_covcorr_patch(patch, stokesjoint=stokesjoint,
+                                      chunk_size=chunk_size)
+        assert_equal(cov.shape, (3 * nsub, 3 * nsub, npix))
+        for ipix in range(npix):
+            cov1pix, corr1pix = get_covcorr1pix(patch, ipix,
+                                                stokesjoint=stokesjoint)
+            assert_allclose(cov[:, :, ipix], cov1pix, rtol=1e-12)
+            assert_allclose(corr[:, :, ipix], corr1pix, atol=1e-14)
+
+    for stokesjoint in [False, True]:
+        # 7 does not divide the number of pixels
+        for chunk_size in [7, 1000]:
+            yield func, stokesjoint, chunk_size
+
+
+def test_get_covcorr_between_pix():
+    cov, corr = get_covcorr_between_pix(patch)
+    for sub in range(nsub):
+        for s in range(3):
+            assert_allclose(cov[sub, s], np.cov(patch[:, sub, :, s],
+                                                rowvar=False), rtol=1e-12)
+            assert_allclose(corr[sub, s],
+                            np.corrcoef(patch[:, sub, :, s], rowvar=False) -
+                            np.identity(npix), atol=1e-14)
+
+
+def test_covariance_IQU_subbands():
+    # the maps of each element of the list are used, in the ordering
+    # I0,I1,...,Q0,Q1,... for any number of sub-bands with stokesjoint
+    allmaps = [patch[:, :1], patch, np.concatenate([patch, patch[:, :1]], 1)]
+
+    def func(stokesjoint):
+        allmean, allcov = covariance_IQU_subbands(allmaps,
+                                                  stokesjoint=stokesjoint)
+        assert_equal(len(allmean), len(allmaps))
+        for maps, mean, cov in zip(allmaps, allmean, allcov):
+            n = maps.shape[1]
+            if stokesjoint:
+                index = [(band, iqu) for iqu in range(3) for band in range(n)]
+            else:
+                index = [(band, iqu) for band in range(n) for iqu in range(3)]
+            data = np.array([maps[:, band, :, iqu].ravel()
+                             for band, iqu in index])
+            assert_allclose(mean, np.mean(data, axis=1), atol=1e-14)
+            assert_allclose(cov, np.cov(data, bias=True), rtol=1e-12)
+
+    for stokesjoint in [False, True]:
+        yield func, stokesjoint
+
+
+def test_get_rms_covar():
+    nsubvals = [1, nsub]
+    seenmap = np.ones(npix, bool)
+    allmapsout = [patch[:, :1], patch]
+    rms, allmeanmat, allstdmat = get_rms_covar(nsubvals, seenmap, allmapsout)
+    for isub, n in enumerate(nsubvals):
+        maps = allmapsout[isub]
+        mats = np.array([[np.atleast_2d(np.cov(maps[:, :, p, i].T))
+                          for i in range(3)] for p in range(npix)])
+        if n == 1:
+            variance = mats[:, :, 0, 0]
+        else:
+            variance = 1 / np.sum(np.linalg.inv(mats), axis=(-2, -1))
+        assert_allclose(rms[isub], np.sqrt(variance).T, rtol=1e-10)
+        normed = mats / np.mean(mats, axis=(-2, -1), keepdims=True)
+        assert_allclose(allmeanmat[isub],
+                        np.mean(normed, axis=0).transpose(1, 2, 0),
+                        rtol=1e-10)
+        assert_allclose(allstdmat[isub],
+                        np.std(normed, axis=0).transpose(1, 2, 0),
+                        rtol=1e-8, atol=1e-14)
+
+
+def test_running_statistics():
+    def func(sizes):
+        # the realizations are added one at a time or by stacks, and merged
+        stats = [RunningStatistics(), RunningStatistics()]
+        start = 0
+        for i, size in enumerate(sizes):
+            if size == 1:
+                stats[i % 2].add(patch[start])
+            else:
+                stats[i % 2].add(patch[start:start + size])
+            start += size
+        stats = stats[0].merge(stats[1])
+        assert_equal(stats.count, nreal)
+        assert_allclose(stats.mean, np.mean(patch, axis=0), atol=1e-14)
+        for ddof in [0, 1]:
+            assert_allclose(stats.get_variance(ddof=ddof),
+                            np.var(patch, axis=0, ddof=ddof), rtol=1e-12)
+        pixels = np.arange(npix) % 3 == 0
+        assert_allclose(stats.get_std_pixels(pixels),
+                        np.std(patch[:, :, pixels, :], axis=(0, 2)),
+                        rtol=1e-12)
+        for stokesjoint in [False, True]:
+            for a, e in zip(stats.get_covcorr(stokesjoint=stokesjoint),
+                            get_covcorr_patch(patch, stokesjoint=stokesjoint)):
+                assert_allclose(a, e, rtol=1e-10, atol=1e-14)
+
+    for sizes in [[nreal], [1] * nreal, [1, 12, 1, 16], [29, 1]]:
+        yield func, sizes
+
+
+def test_running_statistics_single():
+    stats = RunningStatistics().add(patch[0])
+    stats.merge(RunningStatistics())
+    assert_equal(stats.count, 1)
+    assert_equal(stats.mean, patch[0])
+    assert_equal(stats.get_variance(), 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        assert np.all(np.isnan(stats.get_variance(ddof=1)))
+    assert_equal(RunningStatistics().merge(stats).mean, patch[0])
@@ -0,0 +1,26 @@
+from __future__ import division
+
+import numpy as np
+import scipy.signal as scsig
+from numpy.testing import assert_allclose
+from qubic.demodulation_lib import moving_average
+
+
+def test_moving_average():
+    np.random.seed(0)
+    data = np.random.randn(3, 40)
+
+    def func(size, n):
+        # the former boxcar convolution
+        expected = np.array([scsig.fftconvolve(d, np.ones(size) / size,
+                                               mode='same')
+                             for d in data[:, :n]])
+        actual = moving_average(data[:, :n], size)
+        assert_allclose(actual, expected, atol=1e-14)
+        assert_allclose(moving_average(data[0, :n], size), expected[0],
+                        atol=1e-14)
+
+    # odd and even windows, up to windows larger than the input
+    for size in [1, 2, 3, 4, 7, 10, 39, 40, 41, 55, 80, 81]:
+        for n in [1, 2, 5, 40]:
+            yield func, size, n
@@ -0,0 +1,135 @@
+from __future__ import division
+
+import numpy as np
+import scipy.stats
+from numpy.testing import assert_allclose, assert_equal
+from qubic.fibtools import (
+    filter_data, fold_data, meancut, profile, vec_interp)
+
+
+def profile_loop(x, y, nbins, median=False, mode=False, clip=None,
+                 rebin_as_well=None):
+    # the bin by bin loop of profile(..., dispersion=False, cutbad=False)
+    ok = np.isfinite(x) * np.isfinite(y)
+    x = x[ok]
+    y = y[ok]
+    xx = np.linspace(np.min(x), np.max(x), nbins + 1)
+    xmin = xx[0:nbins]
+    xmax = xx[1:]
+    yval = np.zeros(nbins)
+    xc = np.zeros(nbins)
+    dy = np.zeros(nbins)
+    nn = np.zeros(nbins)
+    others = None
+    if rebin_as_well is not None:
+        others = np.zeros((nbins, len(rebin_as_well)))
+    for i in np.arange(nbins):
+        ok = (x > xmin[i]) & (x < xmax[i])
+        newy = y[ok]
+        if clip is not None:
+            for k in np.arange(3):
+                newy, mini, maxi = scipy.stats.sigmaclip(newy, low=clip,
+                                                         high=clip)
+        nn[i] = len(newy)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if median:
+                yval[i] = np.median(y[ok]) if np.any(ok) else np.nan
+            elif mode:
+                mm, ss = meancut(y[ok], 3)
+                hh = np.histogram(y[ok], bins=int(np.min([len(y[ok]) / 30,
+                                                          100])),
+                                  range=[mm - 5 * ss, mm + 5 * ss])
+                idmax = np.argmax(hh[0])
+                yval[i] = 0.5 * (hh[1][idmax + 1] + hh[1][idmax])
+            else:
+                yval[i] = np.mean(y[ok]) if np.any(ok) else np.nan
+            xc[i] = (xmax[i] + xmin[i]) / 2
+            if rebin_as_well is not None:
+                for o in range(len(rebin_as_well)):
+                    others[i, o] = np.mean(rebin_as_well[o][ok]) \
+                        if np.any(ok) else np.nan
+            dy[i] = np.std(y[ok]) / np.sqrt(len(y[ok])) if np.any(ok) \
+                else np.nan
+    ok = nn != 0
+    yval[~ok] = 0
+    dy[~ok] = 0
+    return xc, yval, dy, others
+
+
+def fold_data_loop(time, dd, period, nbins, **keywords):
+    # the detector by detector loop of fold_data(..., return_error=True)
+    tfold = time % period
+    ndet = len(dd)
+    folded = np.zeros((ndet, nbins))
+    folded_nonorm = np.zeros((ndet, nbins))
+    dfolded = np.zeros((ndet, nbins))
+    dfolded_nonorm = np.zeros((ndet, nbins))
+    newdata = np.zeros((ndet, len(time)))
+    for i in range(ndet):
+        newdata[i] = filter_data(time, dd[i], rebin=None)
+        t, yy, dy, others = profile_loop(tfold, newdata[i], nbins, **keywords)
+        folded[i] = (yy - np.mean(yy)) / np.std(yy)
+        folded_nonorm[i] = yy - np.mean(yy)
+        dfolded[i] = dy / np.std(yy)
+        dfolded_nonorm[i] = dy
+    return folded, t, folded_nonorm, dfolded, dfolded_nonorm, newdata
+
+
+def test_fold_data():
+    period = 1.
+    nbins = 20
+    np.random.seed(0)
+    time = np.sort(np.random.uniform(0, 20 * period, 4000))
+    gap = ((time % period) > 0.3) & ((time % period) < 0.4)
+    dd = np.sin(2 * np.pi * time / period) + np.random.randn(4, len(time))
+    dd[2, ::50] = np.nan
+
+    def func(time, dd, keywords):
+        expected = fold_data_loop(time, dd, period, nbins, **keywords)
+        actual = fold_data(time, dd, period, nbins, return_error=True,
+                           silent=True, **keywords)
+        for a, e in zip(actual, expected):
+            assert_allclose(a, e, rtol=1e-10, atol=1e-12)
+
+    for keywords in [{}, {'median': True}, {'clip': 3}, {'mode': True},
+                     {'median': True, 'mode': True}]:
+        yield func, time, dd, keywords
+        if 'mode' not in keywords:
+            # with empty bins
+            yield func, time[~gap], dd[:, ~gap], keywords
+
+
+def test_profile_rebin_as_well():
+    np.random.seed(0)
+    x = np.random.uniform(0, 1, 1000)
+    y = np.random.randn(1000)
+    z = np.random.randn(1000)
+    z[x < 0.1] = np.nan
+    z[::7] = np.inf
+    xc, yval, dx, dy, others = profile(x, y, nbins=10, plot=False,
+                                       dispersion=False, cutbad=False,
+                                       rebin_as_well=[y, z])
+    xc_, yval_, dy_, others_ = profile_loop(x, y, 10, rebin_as_well=[y, z])
+    assert_allclose(xc, xc_)
+    assert_allclose(yval, yval_, rtol=1e-12)
+    assert_allclose(dy, dy_, rtol=1e-10)
+    assert_equal(np.isnan(others), np.isnan(others_))
+    assert_allclose(others, others_, rtol=1e-12)
+
+
+def test_vec_interp():
+    np.random.seed(0)
+    xin = np.sort(np.random.uniform(0, 10, 50))
+    yin = np.random.randn(4, 50)
+
+    def func(x):
+        # the former row by row np.interp
+        expected = np.array([np.interp(x, xin, y) for y in yin])
+        assert_allclose(vec_interp(x, xin, yin), expected, rtol=1e-14,
+                        atol=1e-14)
+
+    # inside, on the edge samples and knots, and outside the input range
+    yield func, np.sort(np.random.uniform(0, 10, 50))
+    yield func, xin
+    yield func, np.concatenate([[-1, xin[0]], xin[1:-1:7], [xin[-1], 12]])
+    yield func, np.linspace(-5, 15, 50)
@@ -0,0 +1,108 @@
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators import SymmetricBandToeplitzOperator
+from pysimulators.noises import (
+    _fold_psd, _gaussian_psd_1f, _logloginterp_psd, _psd2invntt, _unfold_psd)
+from qubic import QubicAcquisition, QubicInstrument, QubicScene, get_pointing
+from qubic.acquisition import _invntt_operators
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['npointings'] = 100
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['nside'] = 16
+d['synthbeam_kmax'] = 1
+d['detector_fknee'] = 1
+d['seed'] = 0
+sampling = get_pointing(d)
+scene = QubicScene(d)
+
+
+def invntt_loop(acq):
+    # the former construction of the operator, on each call, once
+    # get_invntt_operator has set the white noise level acq.sigma
+    fftsize = 2
+    while fftsize < len(acq.sampling):
+        fftsize *= 2
+    sampling_frequency = 1 / acq.sampling.period
+    new_bandwidth = sampling_frequency / fftsize
+    if acq.bandwidth is not None and acq.psd is not None:
+        psd = _fold_psd(acq.psd) if acq.twosided else acq.psd
+        f = np.arange(fftsize // 2 + 1, dtype=float) * new_bandwidth
+        p = _unfold_psd(_logloginterp_psd(f, acq.bandwidth, psd))
+    else:
+        p = _gaussian_psd_1f(fftsize, sampling_frequency, acq.sigma,
+                             acq.instrument.detector.fknee,
+                             acq.instrument.detector.fslope, twosided=True)
+    p[..., 0] = p[..., 1]
+    invntt = _psd2invntt(p, new_bandwidth, acq.instrument.detector.ncorr)
+    if acq.effective_duration is not None:
+        nsamplings = acq.sampling.comm.allreduce(len(acq.sampling))
+        invntt /= (nsamplings * acq.sampling.period /
+                   (acq.effective_duration * 31557600))
+    return SymmetricBandToeplitzOperator(
+        (len(acq.instrument), len(acq.sampling)), invntt)
+
+
+def get_acquisition(**keywords):
+    d1 = qubic.qubicdict.qubicDict()
+    d1.update(d)
+    d1.update(keywords)
+    return QubicAcquisition(QubicInstrument(d1)[::50], sampling, scene, d1)
+
+
+def test_invntt_operator():
+    np.random.seed(0)
+    tod = np.random.randn(len(QubicInstrument(d)[::50]), len(sampling))
+    f = np.arange(1, 101) * 0.1
+
+    def func(keywords):
+        _invntt_operators.clear()
+        acq = get_acquisition(**keywords)
+        actual = acq.get_invntt_operator()
+        assert_allclose(actual(tod), invntt_loop(acq)(tod), rtol=1e-10)
+        # the same noise model gives the same operator
+        assert get_acquisition(**keywords).get_invntt_operator() is actual
+        # but not another one
+        other = get_acquisition(**dict(keywords, detector_fknee=0.5))
+        assert other.get_invntt_operator() is not actual
+        assert_allclose(other.get_invntt_operator()(tod),
+                        invntt_loop(other)(tod), rtol=1e-10)
+
+    for keywords in [{},
+                     {'effective_duration': None},
+                     {'psd': 1e-32 * (1 + 1 / f), 'bandwidth': 0.1,
+                      'twosided': False}]:
+        yield func, keywords
+
+
+def test_invntt_cache():
+    np.random.seed(0)
+    tod = np.random.randn(len(QubicInstrument(d)[::50]), len(sampling))
+    path = tempfile.mkdtemp()
+    try:
+        _invntt_operators.clear()
+        acq = get_acquisition(invntt_cache=path)
+        actual = acq.get_invntt_operator()(tod)
+        expected = invntt_loop(acq)(tod)
+        assert_allclose(actual, expected, rtol=1e-10)
+        files = sorted(os.listdir(path))
+        assert_equal(len(files), 2)
+        assert_equal(files[0], 'fftw_wisdom.pickle')
+        assert files[1].startswith('invntt_')
+
+        # the coefficients are loaded from the disk by a new process
+        _invntt_operators.clear()
+        acq = get_acquisition(invntt_cache=path)
+        assert_allclose(acq.get_invntt_operator()(tod), expected, rtol=1e-10)
+        assert_equal(sorted(os.listdir(path)), files)
+    finally:
+        shutil.rmtree(path)
@@ -0,0 +1,44 @@
+from __future__ import division
+
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicScene, get_pointing)
+from qubic.mapmaking import tod2map_all, tod2map_batch
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['npointings'] = 100
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['nside'] = 32
+d['synthbeam_kmax'] = 1
+d['detector_fknee'] = 0
+d['seed'] = 0
+
+
+def test_tod2map_batch():
+    def func(kind):
+        d['kind'] = kind
+        scene = QubicScene(d)
+        acq = QubicAcquisition(QubicInstrument(d)[::4], get_pointing(d),
+                               scene, d)
+        H = acq.get_operator()
+        np.random.seed(0)
+        sky = 100 * np.random.randn(*scene.shape)
+        tod = H(sky)
+        tods = [tod + np.random.randn(*tod.shape) * 0.1 * np.std(tod)
+                for i in range(3)]
+        maps, coverage = tod2map_batch(acq, tods, disp=False, tol=1e-8)
+        assert_equal(len(maps), len(tods))
+        for tod_, map_ in zip(tods, maps):
+            expected, coverage_ = tod2map_all(acq, tod_, disp=False,
+                                              tol=1e-8)
+            assert_allclose(coverage, coverage_)
+            assert_allclose(map_, expected,
+                            atol=1e-5 * np.nanmax(np.abs(expected)))
+        assert_raises(ValueError, tod2map_batch, acq, [tod[:-1]])
+
+    for kind in 'I', 'IQU':
+        yield func, kind
@@ -1,10 +1,13 @@
 from __future__ import division
 import numpy as np
+import qubic
 from pyoperators import MPI
 from numpy.testing import assert_equal
 from pyoperators.utils.testing import assert_same
-from qubic import QubicAcquisition, QubicInstrument, create_random_pointings
-from qubic.mapmaking import tod2map_all, tod2map_each
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicScene, create_random_pointings,
+    get_pointing)
+from qubic.mapmaking import tod2map_all, tod2map_batch, tod2map_each
 
 rank = MPI.COMM_WORLD.rank
 size = MPI.COMM_WORLD.size
@@ -52,3 +55,64 @@ def test():
         ref3, ref4 = tod2map_all(acq, tod, disp=False, maxiter=2)
         ref5, ref6 = None, None #tod2map_each(acq, tod, disp=False)
         yield (func, sampling, kind, sky, ref1, ref2, ref3, ref4, ref5, ref6)
+
+
+def test_distributed():
+    d = qubic.qubicdict.qubicDict()
+    d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+    d['npointings'] = 40
+    d['random_pointing'] = True
+    d['repeat_pointing'] = False
+    d['nside'] = 64
+    d['synthbeam_kmax'] = 1
+    d['detector_fknee'] = 0
+    d['seed'] = 0
+
+    def func(kind, nprocs_instrument, sky, ref1, ref2):
+        d['comm'] = MPI.COMM_WORLD
+        d['nprocs_instrument'] = nprocs_instrument
+        d['nprocs_sampling'] = size // nprocs_instrument
+        acq = QubicAcquisition(QubicInstrument(d)[::8], get_pointing(d),
+                               QubicScene(d), d)
+        H = acq.get_operator()
+        invntt = acq.get_invntt_operator()
+        actual1 = (H.T * invntt * H)(sky)
+        assert_same(actual1, ref1, atol=20)
+        actual2, coverage = tod2map_batch(acq, [H(sky)], disp=False,
+                                          maxiter=2)
+        assert_same(actual2[0], ref2, atol=1000)
+
+    for kind in 'I', 'IQU':
+        d['kind'] = kind
+        d['comm'] = MPI.COMM_SELF
+        d['nprocs_instrument'] = None
+        d['nprocs_sampling'] = None
+        scene = QubicScene(d)
+        acq = QubicAcquisition(QubicInstrument(d)[::8], get_pointing(d),
+                               scene, d)
+        np.random.seed(0)
+        sky = np.random.randn(*scene.shape)
+        H = acq.get_operator()
+        invntt = acq.get_invntt_operator()
+        ref1 = (H.T * invntt * H)(sky)
+        ref2, coverage = tod2map_batch(acq, [H(sky)], disp=False, maxiter=2)
+        for nprocs_instrument in sorted(set([1, max(size // 2, 1), size])):
+            yield func, kind, nprocs_instrument, sky, ref1, ref2[0]
+
+
+def test_pointing_seed():
+    d = qubic.qubicdict.qubicDict()
+    d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+    d['npointings'] = 20
+    d['random_pointing'] = True
+    d['repeat_pointing'] = False
+    d['seed'] = None
+
+    # with the default distribution, all the ranks draw the same pointings
+    np.random.seed(rank)
+    p = get_pointing(d)
+    pointings = MPI.COMM_WORLD.allgather(
+        np.array([p.azimuth, p.elevation, p.pitch, p.angle_hwp]))
+    assert_equal(len(pointings), size)
+    for pointing in pointings[1:]:
+        assert_equal(pointing, pointings[0])
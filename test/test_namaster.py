@@ -0,0 +1,51 @@
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+from unittest import SkipTest
+
+import healpy as hp
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+try:
+    from qubic import NamasterLib
+except ImportError:
+    NamasterLib = None
+
+
+def test_workspace_cache():
+    if NamasterLib is None:
+        raise SkipTest('pymaster is not installed.')
+    nside = 16
+    theta, phi = hp.pix2ang(nside, np.arange(12 * nside**2))
+    mask = (theta < np.radians(60)).astype(float)
+    np.random.seed(0)
+    maps = np.random.randn(3, 12 * nside**2)
+    path = tempfile.mkdtemp()
+    try:
+        namaster = NamasterLib.Namaster(mask, lmin=2, lmax=3 * nside - 1,
+                                        delta_ell=5, aposize=5,
+                                        workspace_cache=path)
+        mask_apo = namaster.get_apodized_mask()
+        b = namaster.get_binning(nside)[1]
+        f0, f2 = namaster.get_fields(maps.copy(), mask_apo=mask_apo)
+
+        NamasterLib._workspaces.clear()
+        computed = namaster.get_workspaces(f0, f2, b, mask_apo)
+        assert_equal(len(os.listdir(path)), 3)
+        cached = namaster.get_workspaces(f0, f2, b, mask_apo)
+        for w, w_ in zip(computed, cached):
+            assert w is w_
+
+        # the workspaces are read back from the files by a new process
+        NamasterLib._workspaces.clear()
+        read = namaster.get_workspaces(f0, f2, b, mask_apo)
+        for w, w_ in zip(computed, read):
+            assert w is not w_
+            assert_allclose(w_.get_coupling_matrix(),
+                            w.get_coupling_matrix())
+    finally:
+        NamasterLib._workspaces.clear()
+        shutil.rmtree(path)
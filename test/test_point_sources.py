@@ -0,0 +1,116 @@
+from __future__ import division
+
+import os
+import pickle
+import tempfile
+
+import healpy as hp
+import numpy as np
+import qubic.compact_sources_sed
+from numpy.testing import assert_allclose
+from qubic.insert_point_sources_in_sky import (
+    add_sources_to_sky_map, center_ang, gaussian2D, gaussian2D_grid,
+    insert_source)
+
+catalog = {'143': {'SRC1': {'GLON': 30., 'GLAT': 20., 'ANGLE_P': 25.},
+                   'SRC2': {'GLON': 200., 'GLAT': -40., 'ANGLE_P': -60.}}}
+seds = {'SRC1': {'i_fit': [0.01, 2., 300.], 'p_fit': [0.1, 20.]},
+        # no polarized flux at low frequency
+        'SRC2': {'i_fit': [-1., 500.], 'p_fit': [0.5, -70.]}}
+
+
+def insert_source_loop(source_center_deg, fwhm_deg, flux_Jy, nside):
+    # the former point by point insertion, in Jy/sr
+    internal_nside = 1024
+    theta_deg, phi_deg = gaussian2D_grid(source_center_deg, fwhm_deg)
+    pixels = list(set(hp.ang2pix(internal_nside, th, ph, lonlat=True)
+                      for th in theta_deg for ph in phi_deg))
+    angles_deg = [center_ang(hp.pix2ang(internal_nside, px, lonlat=True))
+                  for px in pixels]
+    source_center_rad = np.radians(source_center_deg)
+    fwhm_rad = np.radians(fwhm_deg)
+    values = np.array([gaussian2D(np.radians(th), source_center_rad[0],
+                                  np.radians(ph), source_center_rad[1],
+                                  fwhm_rad) for th, ph in angles_deg])
+    sigma = fwhm_rad / (2 * np.sqrt(2 * np.log(2)))
+    output_map = np.zeros(12 * internal_nside**2)
+    output_map[pixels] = values * flux_Jy / (2 * np.pi * sigma**2)
+    return hp.ud_grade(output_map, nside)
+
+
+def test_insert_source():
+    nside = 64
+
+    def func(center, fwhm):
+        expected = insert_source_loop(center, fwhm, 2., nside)
+        actual = insert_source(center, fwhm, 2., nside, units='Flux')
+        assert_allclose(actual, expected, rtol=1e-10,
+                        atol=1e-12 * np.max(expected))
+
+    for center in [(0, 0), (10, 30), (300, -50)]:
+        for fwhm in [0.5, 1]:
+            yield func, center, fwhm
+
+
+def test_insert_source_angular_distance():
+    nside = 64
+    pixarea = hp.nside2pixarea(nside)
+
+    def func(center):
+        # the flux is preserved away from the equator
+        m = insert_source(center, 2, 2., nside, units='Flux',
+                          angular_distance=True)
+        assert_allclose(np.sum(m) * pixarea, 2., rtol=1e-3)
+        # the source is kept when the beam is narrower than the pixels
+        m = insert_source(center, 0.01, 2., nside, units='Flux',
+                          angular_distance=True)
+        assert m[hp.ang2pix(nside, center[0], center[1], lonlat=True)] > 0
+
+    for center in [(0, 0), (10, 30), (300, -50), (45, 80)]:
+        yield func, center
+
+
+def add_sources_loop(input_map, frequencies, sources, fwhm):
+    # the former source by source, frequency by frequency insertion
+    output_map = input_map.copy()
+    nside = hp.get_nside(input_map[0, :, 0])
+    for source in sources:
+        center = (catalog['143'][source]['GLON'],
+                  catalog['143'][source]['GLAT'])
+        fi = np.poly1d(seds[source]['i_fit'])
+        fp = np.poly1d(seds[source]['p_fit'])
+        angle = np.radians(catalog['143'][source]['ANGLE_P'])
+        for ifreq, fq in enumerate(frequencies):
+            i_flux = fi(fq / 1e9) / 1e3
+            p_flux = max(fp(fq / 1e9) / 1e3, 0)
+            flux = [i_flux, p_flux * np.cos(2 * angle),
+                    p_flux * np.sin(2 * angle)]
+            for index in range(3):
+                output_map[ifreq, :, index] = insert_source(
+                    center, fwhm, flux[index], nside, units='uK_CMB',
+                    input_map=output_map[ifreq, :, index], frequency=fq)
+    return output_map
+
+
+def test_add_sources_to_sky_map():
+    nside = 32
+    frequencies = [100e9, 150e9, 220e9]
+    np.random.seed(0)
+    input_map = np.random.randn(len(frequencies), 12 * nside**2, 3)
+    build_sed = qubic.compact_sources_sed.build_sed
+    fd, filename = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(catalog, f)
+        qubic.compact_sources_sed.build_sed = \
+            lambda source, catalog, plot=False: {source: seds[source]}
+        expected = add_sources_loop(input_map, frequencies, ['SRC1', 'SRC2'],
+                                    3.)
+        actual = add_sources_to_sky_map(input_map, frequencies,
+                                        ['SRC1', 'SRC2'], fwhm_deg=('Man', 3.),
+                                        catalog_file=filename)
+    finally:
+        qubic.compact_sources_sed.build_sed = build_sed
+        os.remove(filename)
+    assert_allclose(actual, expected, rtol=1e-12,
+                    atol=1e-12 * np.max(np.abs(expected)))
@@ -0,0 +1,38 @@
+from __future__ import division
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose
+from qubic import QubicMultibandInstrument, QubicScene, get_pointing
+from qubic.polyacquisition import QubicPolyAcquisition
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['npointings'] = 50
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['nside'] = 64
+d['synthbeam_kmax'] = 1
+d['MultiBand'] = True
+d['nf_sub'] = 3
+np.random.seed(0)
+
+
+def test_fused_operator():
+    def func(kind):
+        d['kind'] = kind
+        instrument = QubicMultibandInstrument(d)
+        sampling = get_pointing(d)
+        scene = QubicScene(d)
+        acq = QubicPolyAcquisition(instrument, sampling, scene, d)
+        H = acq.get_operator()
+        ref = np.sum(np.array(acq._get_array_of_operators()), axis=0)
+        x = np.random.randn(*H.shapein)
+        y = np.random.randn(*H.shapeout)
+        actual = H(x)
+        expected = ref(x)
+        assert_allclose(actual, expected, atol=1e-6 * np.max(abs(expected)))
+        actual = H.T(y)
+        expected = ref.T(y)
+        assert_allclose(actual, expected, atol=1e-6 * np.max(abs(expected)))
+    for kind in 'I', 'IQU':
+        yield func, kind
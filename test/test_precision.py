@@ -0,0 +1,42 @@
+from __future__ import division
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicScene, get_pointing)
+from qubic.mapmaking import tod2map_all
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['npointings'] = 100
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['nside'] = 64
+d['synthbeam_kmax'] = 1
+d['detector_fknee'] = 0
+np.random.seed(0)
+
+
+def test():
+    def func(kind):
+        d['kind'] = kind
+        instrument = QubicInstrument(d)[::4]
+        sampling = get_pointing(d)
+        scene = QubicScene(d)
+        acq = QubicAcquisition(instrument, sampling, scene, d)
+
+        x = np.random.randn(*((len(scene),) + scene.shape[1:]))
+        ref = acq.get_normal_operator(precision='double')(x)
+        actual = acq.get_normal_operator(precision='single')(x)
+        assert actual.dtype == np.float64
+        assert_allclose(actual, ref, atol=1e-5 * np.max(np.abs(ref)))
+
+        tod = acq.get_operator()(100 * np.random.randn(*scene.shape))
+        ref, coverage = tod2map_all(acq, tod, disp=False, tol=1e-6)
+        actual, coverage = tod2map_all(acq, tod, disp=False, tol=1e-6,
+                                       precision='single')
+        observed = coverage > 0
+        assert_allclose(actual[observed], ref[observed],
+                        atol=1e-3 * np.nanmax(np.abs(ref)))
+    for kind in 'I', 'IQU':
+        yield func, kind
@@ -0,0 +1,126 @@
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal
+from pyoperators import BlockColumnOperator
+from pyoperators.utils import split
+from qubic import (
+    QubicAcquisition, QubicInstrument, QubicMultibandInstrument, QubicScene,
+    get_pointing)
+from qubic.acquisition import ProjectionOnTheFlyOperator
+from qubic.mapmaking import (
+    _get_acquisition_on_the_fly, map2tod, tod2map_all)
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['npointings'] = 20
+d['random_pointing'] = True
+d['repeat_pointing'] = False
+d['nside'] = 16
+d['synthbeam_kmax'] = 1
+d['seed'] = 0
+sampling = get_pointing(d)
+
+
+def test_projection_cache():
+    path = tempfile.mkdtemp()
+    try:
+        for kind in 'I', 'IQU':
+            d1 = qubic.qubicdict.qubicDict()
+            d1.update(d)
+            d1['kind'] = kind
+            scene = QubicScene(d1)
+            d1['projection_cache'] = None
+            expected = QubicInstrument(d1)[::20].get_projection_operator(
+                sampling, scene, verbose=False).matrix.data
+
+            # plain dictionaries without the projection_cache entry
+            d2 = dict(d1)
+            d2.pop('projection_cache', None)
+            q = QubicInstrument(d2)[::20]
+            assert q.projection_cache is None
+            assert_equal(q.get_projection_operator(
+                sampling, scene, verbose=False).matrix.data, expected)
+
+            # the matrix is stored on the first call and loaded afterwards
+            d1['projection_cache'] = os.path.join(path, 'cache_' + kind)
+            q = QubicInstrument(d1)[::20]
+            for i in range(2):
+                actual = q.get_projection_operator(sampling, scene,
+                                                   verbose=False).matrix.data
+                assert_equal(isinstance(actual.base, np.memmap), i == 1)
+                assert_equal(actual, expected)
+            assert_equal(len(os.listdir(d1['projection_cache'])), 1)
+
+            # the multiband instruments use a matrix per sub-band
+            d1['nf_sub'] = 2
+            qs = QubicMultibandInstrument(d1)
+            qs.subinstruments = [q_[::20] for q_ in qs.subinstruments]
+            expected = [q_.get_projection_operator(
+                sampling, scene, verbose=False).matrix.data.copy()
+                for q_ in qs]
+            for q_ in qs:
+                q_.projection_cache = None
+            expected_ = qs.get_projection_operators(sampling, scene,
+                                                    verbose=False)
+            for e_, e in zip(expected_, expected):
+                assert_equal(e_.matrix.data, e)
+            for q_ in qs:
+                q_.projection_cache = d1['projection_cache']
+            for i in range(2):
+                actual = qs.get_projection_operators(sampling, scene,
+                                                     verbose=False)
+                for a, e in zip(actual, expected):
+                    assert_equal(a.matrix.data, e)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_projection_on_the_fly():
+    def func(kind):
+        d1 = qubic.qubicdict.qubicDict()
+        d1.update(d)
+        d1['kind'] = kind
+        scene = QubicScene(d1)
+        acq = QubicAcquisition(QubicInstrument(d1)[::20], sampling, scene, d1)
+        # the stored matrices of the blocks, as built before
+        block = tuple(split(len(sampling), 3))
+        expected = BlockColumnOperator(
+            [acq.instrument.get_projection_operator(
+                sampling[b], scene, verbose=False) for b in block], axisout=1)
+        P = ProjectionOnTheFlyOperator(acq.instrument, sampling, scene, block)
+        np.random.seed(0)
+        sky = np.random.randn(*scene.shape)
+        tod = np.random.randn(len(acq.instrument), len(sampling),
+                              *scene.shape[1:])
+        assert_allclose(P(sky), expected(sky), rtol=1e-12)
+        assert_allclose(P.T(tod), expected.T(tod), rtol=1e-10, atol=1e-12)
+
+        # the acquisition operator, with blocks of different lengths
+        max_nbytes = acq.get_operator_nbytes() // 3 + 1
+        acq_ = _get_acquisition_on_the_fly(acq, max_nbytes)
+        assert_equal(len(acq_.block), 3)
+        H = acq.get_operator()
+        H_ = acq_.get_operator()
+        assert_allclose(H_(sky), H(sky), rtol=1e-12)
+        tod = H(sky)
+        assert_allclose(H_.T(tod), H.T(tod), rtol=1e-10, atol=1e-12)
+        assert_allclose(map2tod(acq, sky, max_nbytes=max_nbytes), tod,
+                        rtol=1e-12)
+        if kind != 'I':
+            # some Q and U pixels are observed with a single angle, so
+            # that the maps are not unique
+            return
+        maps, coverage = tod2map_all(acq, tod, disp=False, tol=1e-8)
+        maps_, coverage_ = tod2map_all(acq, tod, max_nbytes=max_nbytes,
+                                       disp=False, tol=1e-8)
+        assert_allclose(coverage_, coverage, rtol=1e-12)
+        assert_allclose(maps_, maps, atol=1e-6 * np.nanmax(np.abs(maps)))
+
+    for kind in 'I', 'IQU':
+        yield func, kind
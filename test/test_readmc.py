@@ -0,0 +1,84 @@
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import healpy as hp
+import numpy as np
+from numpy.testing import assert_equal
+from qubic.ReadMC import (
+    get_maps, get_patch, get_patch_many_files, get_seenmap,
+    iter_patch_many_files, save_patch_many_files, save_simu_fits)
+
+nside = 8
+nsub = 2
+nfiles = 5
+
+
+def get_patch_eager(file, seenmap):
+    # the former get_patch, reading the full maps
+    maps_recon, maps_convo, diff = get_maps(file)
+    return (maps_recon[:, seenmap, :], maps_convo[:, seenmap, :],
+            diff[:, seenmap, :])
+
+
+def write_files(path):
+    np.random.seed(0)
+    npix = 12 * nside**2
+    theta = hp.pix2ang(nside, np.arange(npix))[0]
+    seen = theta < np.radians(60)
+    for i in range(nfiles):
+        maps_recon = np.random.randn(nsub, npix, 3)
+        maps_convo = np.random.randn(nsub, npix, 3)
+        maps_recon[:, ~seen, :] = hp.UNSEEN
+        maps_convo[:, ~seen, :] = hp.UNSEEN
+        save_simu_fits(maps_recon, seen.astype(float), np.arange(nsub),
+                       np.arange(nsub + 1), maps_convo, path,
+                       'simu_{}.fits'.format(i))
+    return seen
+
+
+def test_patch_many_files():
+    path = tempfile.mkdtemp()
+    try:
+        seen = write_files(path)
+        files = sorted(os.listdir(path))
+        files = [os.path.join(path, f) for f in files]
+        seenmap = get_seenmap(files[0])
+        assert_equal(seenmap, seen)
+        expected = [get_patch_eager(f, seenmap) for f in files]
+        for f, e in zip(files, expected):
+            for a, e_ in zip(get_patch(f, seenmap), e):
+                assert_equal(a, e_)
+
+        # the files are iterated in order, with one or several threads
+        for nthreads in [1, 2]:
+            actual = list(iter_patch_many_files(files, seenmap,
+                                                nthreads=nthreads))
+            assert_equal([a[0] for a in actual], files)
+            for a, e in zip(actual, expected):
+                for a_, e_ in zip(a[1:], e):
+                    assert_equal(a_, e_)
+
+        # the patches written in the .npy file
+        filename = os.path.join(path, 'patches.npy')
+        for nthreads in [1, 3]:
+            all_fits, store = save_patch_many_files(
+                path + '/', 'simu_*.fits', filename, nthreads=nthreads,
+                verbose=False)
+            assert isinstance(store, np.memmap)
+            assert_equal(store.shape, (3, nfiles, nsub, np.sum(seen), 3))
+            all_fits_, recon, convo, diff = get_patch_many_files(
+                path + '/', 'simu_*.fits', verbose=False)
+            assert_equal(all_fits, all_fits_)
+            for i, f in enumerate(all_fits):
+                e = expected[files.index(f)]
+                for k in range(3):
+                    assert_equal(store[k, i], e[k])
+            assert_equal(store[0], recon)
+            assert_equal(store[1], convo)
+            assert_equal(store[2], diff)
+            del store
+    finally:
+        shutil.rmtree(path)
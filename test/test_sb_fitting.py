@@ -0,0 +1,148 @@
+from __future__ import division
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+from qubic.sb_fitting import (
+    SbModelIndepPeaks, SbModelIndepPeaksAmpFWHM, SimpleSbModel,
+    _read_fit_records, fit_all_tes, read_fit_table)
+
+
+def model_loop(model, x, pars):
+    # the former peak by peak evaluation of the synthesized beam models
+    x2d, y2d = x
+    xc, yc, dist, angle, distx, distpowerX, disty, distpowerY = pars[:8]
+    cosang = np.cos(np.radians(angle))
+    sinang = np.sin(np.radians(angle))
+    rotmat = np.array([[cosang, -sinang], [sinang, cosang]])
+    newxxyy = np.zeros((2, model.npeaks))
+    for i in range(model.npeaks):
+        newxxyy[:, i] = np.dot(rotmat, model.xxyy[:, i])
+    newxxyy *= dist
+    undistxxyy = newxxyy.copy()
+    if isinstance(model, SimpleSbModel):
+        yok = xok = np.ones(model.npeaks, bool)
+    else:
+        yok = undistxxyy[1, :] != 0
+        xok = undistxxyy[0, :] != 0
+    newxxyy[0, yok] += distx * np.abs(undistxxyy[1, yok]) ** distpowerX
+    newxxyy[1, xok] += disty * np.abs(undistxxyy[0, xok]) ** distpowerY
+    newxxyy[0, :] += xc
+    newxxyy[1, :] += yc
+    if isinstance(model, SimpleSbModel):
+        ampgauss, xcgauss, ycgauss, fwhmgauss = pars[9:13]
+        amps = ampgauss * np.exp(
+            -0.5 * ((xcgauss - newxxyy[0]) ** 2 +
+                    (ycgauss - newxxyy[1]) ** 2) / (fwhmgauss / 2.35) ** 2)
+        fwhmpeaks = np.zeros(model.npeaks) + pars[8]
+    elif isinstance(model, SbModelIndepPeaksAmpFWHM):
+        amps = pars[9::2]
+        fwhmpeaks = pars[8] + pars[10::2]
+    else:
+        amps = pars[9::4]
+        fwhmpeaks = pars[8] + pars[10::4]
+        newxxyy[0, :] += pars[11::4]
+        newxxyy[1, :] += pars[12::4]
+    themap = np.zeros(x2d.shape)
+    for i in range(model.npeaks):
+        sig = fwhmpeaks[i] / 2.35
+        themap += amps[i] * np.exp(-0.5 * ((x2d - newxxyy[0, i]) ** 2 +
+                                           (y2d - newxxyy[1, i]) ** 2) / sig**2)
+    return np.ravel(themap)
+
+
+def get_models_and_pars(angle):
+    np.random.seed(0)
+    models = [SimpleSbModel(), SbModelIndepPeaksAmpFWHM(),
+              SbModelIndepPeaks()]
+    geometry = [0.3, 50.2, 8., angle, 0.05, 1.5, 0.03, 1.7, 0.9]
+    pars = [np.array(geometry + [1e5, 0.5, 49., 13.]),
+            np.array(geometry + list(np.ravel(
+                [np.random.uniform(1e4, 1e5, 9),
+                 np.random.uniform(-0.2, 0.2, 9)], order='F'))),
+            np.array(geometry + list(np.ravel(
+                [np.random.uniform(1e4, 1e5, 9),
+                 np.random.uniform(-0.2, 0.2, 9),
+                 np.random.uniform(-0.5, 0.5, 9),
+                 np.random.uniform(-0.5, 0.5, 9)], order='F')))]
+    return models, pars
+
+
+def get_pixels(grid):
+    az = np.linspace(-15, 15, 40)
+    el = np.linspace(35, 65, 35)
+    if grid:
+        return np.meshgrid(az, el)
+    np.random.seed(1)
+    return [np.random.uniform(-15, 15, 300), np.random.uniform(35, 65, 300)]
+
+
+def test_call():
+    def func(model, pars, grid):
+        x = get_pixels(grid)
+        expected = model_loop(model, x, pars)
+        assert_allclose(model(x, pars), expected, rtol=1e-10,
+                        atol=1e-10 * np.max(expected))
+
+    # for an angle of 0, the grid of peaks has zero coordinates
+    for angle in [0, 30]:
+        for model, pars in zip(*get_models_and_pars(angle)):
+            for grid in [True, False]:
+                yield func, model, pars, grid
+
+
+def test_jacobian():
+    def func(model, pars, grid):
+        x = get_pixels(grid)
+        themap, jac = model.jacobian(x, pars)
+        assert_allclose(themap, model(x, pars), rtol=1e-12)
+        expected = np.empty_like(jac)
+        for i in range(model.npars):
+            h = 1e-6 * max(1, abs(pars[i]))
+            p1 = pars.copy()
+            p1[i] += h
+            p2 = pars.copy()
+            p2[i] -= h
+            expected[i] = (model(x, p1) - model(x, p2)) / (2 * h)
+        assert_allclose(jac, expected, rtol=1e-4,
+                        atol=1e-5 * np.max(np.abs(expected)))
+
+    for angle in [0, 30]:
+        for model, pars in zip(*get_models_and_pars(angle)):
+            for grid in [True, False]:
+                yield func, model, pars, grid
+
+
+def test_fit_all_tes_resume():
+    records = [(3, np.arange(13.), np.ones(13), 1.5, np.zeros((4, 9))),
+               (1, np.arange(13.) + 1, np.ones(13), 2.5, np.ones((4, 9)))]
+    truncated = pickle.dumps((2,) + records[0][1:])
+    fd, filename = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for record in records:
+                pickle.dump(record, f)
+            size = f.tell()
+            # the last record of an interrupted run
+            f.write(truncated[:len(truncated) // 2])
+        actual, end = _read_fit_records(filename)
+        assert_equal(end, size)
+        assert_equal(len(actual), 2)
+
+        # the TES in the file are not fitted again, the truncated record is removed
+        table = fit_all_tes(None, [1, 3], None, filename, verbose=False)
+        assert_equal(os.path.getsize(filename), size)
+        assert_equal(table['TESNum'], [1, 3])
+        assert_equal(table['pars'], [records[1][1], records[0][1]])
+        assert_equal(table['chi2'], [2.5, 1.5])
+        assert_equal(table['peaks'][1], records[0][4])
+
+        # the next records are appended after the complete ones
+        with open(filename, 'ab') as f:
+            f.write(truncated)
+        assert_equal(read_fit_table(filename)['TESNum'], [1, 2, 3])
+    finally:
+        os.remove(filename)
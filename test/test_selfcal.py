@@ -0,0 +1,116 @@
+from __future__ import division
+
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal
+from qubic import QubicInstrument
+from qubic.beams import BeamGaussian
+from qubic.selfcal_lib import (
+    HornResponse, Model_Fringes_Ana, _get_beam_key, _horn_responses,
+    get_chi2, get_response_power, make_chi2_grid)
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+theta = np.radians(0.8)
+phi = np.radians(30)
+nu = 150e9
+
+
+def power_toggle(q, open_horns):
+    # the power given by get_response_power, toggling q.horn.open
+    open_ = q.horn.open.copy()
+    try:
+        q.horn.open = False
+        q.horn.open[np.asarray(open_horns) - 1] = True
+        return get_response_power(q, theta, phi, nu, 1.)[2]
+    finally:
+        q.horn.open = open_
+
+
+def test_horn_response():
+    q = QubicInstrument(d)
+    nhorns = len(q.horn)
+    response = HornResponse(q, theta, phi, nu, 1.)
+    x, y, power = get_response_power(q, theta, phi, nu, 1.)
+    assert_allclose(response.x, x)
+    assert_allclose(response.y, y)
+
+    def func(open_horns):
+        expected = power_toggle(q, open_horns)
+        actual = response.get_power(open_horns=open_horns)
+        assert_allclose(actual, expected, rtol=1e-10,
+                        atol=1e-10 * np.max(expected))
+
+    yield func, np.arange(1, nhorns + 1)
+    yield func, [1, 25]
+    yield func, [25, 57, 120]
+    yield func, np.setdiff1d(np.arange(1, nhorns + 1), [3, 100])
+
+
+def test_horn_response_beams():
+    q = QubicInstrument(d)
+    _horn_responses.clear()
+    response = HornResponse(q, theta, phi, nu, 1.)
+    assert_equal(len(_horn_responses), 1)
+
+    # an identical beam does not recompute the response
+    q.primary_beam = BeamGaussian(q.primary_beam.fwhm, nu=q.primary_beam.nu)
+    assert_equal(_get_beam_key(q.primary_beam)[0], 'BeamGaussian')
+    assert HornResponse(q, theta, phi, nu, 1.).A is response.A
+    assert_equal(len(_horn_responses), 1)
+
+    # another beam does
+    fwhm = np.radians(8)
+    q.primary_beam = BeamGaussian(fwhm, nu=150)
+    response = HornResponse(q, theta, phi, nu, 1.)
+    assert_equal(len(_horn_responses), 2)
+    expected = get_response_power(q, theta, phi, nu, 1.)[2]
+    assert_allclose(response.get_power(), expected, rtol=1e-10,
+                    atol=1e-10 * np.max(expected))
+
+
+def test_make_chi2_grid():
+    dtd = d.copy()
+    dtd['config'] = 'TD'
+    q = QubicInstrument(dtd)
+    BLs = [[25, 57], [25, 58], [1, 10]]
+    ndet = len(q.detector)
+    np.random.seed(0)
+    gains = np.random.uniform(0.5, 1.5, ndet)
+    sigma = 0.01
+    fringes = []
+    for k, BL in enumerate(BLs):
+        model = Model_Fringes_Ana(q, BL, theta_source=np.radians(0.3))
+        Phi = model.get_fringes(times_gaussian=False)[2]
+        fringes.append(Phi * 10 ** -(k + 1) * gains +
+                       np.random.normal(scale=sigma, size=ndet))
+    errors = np.full(ndet, sigma)
+    errors[::7] *= 1e20
+    diagonal = [np.diag(1 / errors ** 2)] * len(BLs)
+    # with correlated noise, the gain equations are solved as a whole
+    cov = np.diag(errors ** 2) + 0.2 * sigma ** 2 * np.exp(
+        -np.subtract.outer(np.arange(ndet), np.arange(ndet)) ** 2 / 8)
+    dense = [np.linalg.inv(cov)] * len(BLs)
+    grid = {'nval_fl': 4, 'nval_th': 3, 'fl_min': 0.28, 'fl_max': 0.32,
+            'th_min': np.radians(-0.5), 'th_max': np.radians(0.5)}
+
+    def func(allInvCov):
+        focal = q.optics.focal_length
+        all_fl, all_th, chi2 = make_chi2_grid(allInvCov, fringes, BLs, q,
+                                              **grid)
+        assert_equal(chi2.shape, (len(all_fl), len(all_th)))
+        assert_equal(q.optics.focal_length, focal)
+        _, _, chi2_2 = make_chi2_grid(allInvCov, fringes, BLs, q, nprocs=2,
+                                      **grid)
+        assert_allclose(chi2_2, chi2, rtol=1e-14)
+        try:
+            # the per-point computation
+            expected = [[get_chi2([fl, th] + [-1] * len(BLs), allInvCov,
+                                  fringes, BLs, q) for th in all_th]
+                        for fl in all_fl]
+        finally:
+            q.optics.focal_length = focal
+        assert_allclose(chi2, expected, rtol=1e-10)
+
+    yield func, diagonal
+    yield func, dense
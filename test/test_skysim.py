@@ -0,0 +1,156 @@
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+
+import healpy as hp
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from qubic.QubicSkySim import (
+    Qubic_sky, _load_npy_directory, ctheta_parts, map_corr_harmonic,
+    map_corr_neighbtheta, save_fastsim_data)
+
+nside = 16
+np.random.seed(0)
+themap = hp.synfast(1 / (np.arange(3 * nside) + 1.) ** 2, nside)
+theta = hp.pix2ang(nside, np.arange(12 * nside**2))[0]
+ipok = np.where(theta < np.radians(70))[0]
+
+
+def map_corr_loop(themap, ipok, thetamin, thetamax, nbins):
+    # the former pixel by pixel pair counting of map_corr_neighbtheta
+    thvals = np.radians(np.linspace(thetamin, thetamax, nbins + 1))
+    ns = hp.npix2nside(len(themap))
+    thesum = np.zeros(nbins)
+    thesum2 = np.zeros(nbins)
+    thecount = np.zeros(nbins)
+    for ip in ipok:
+        valthis = themap[ip]
+        v = hp.pix2vec(ns, ip)
+        inner = list(hp.query_disc(ns, v, np.radians(thetamin)))
+        for k in range(nbins):
+            outer = list(hp.query_disc(ns, v, thvals[k + 1]))
+            ipneighb = [i for i in outer if i not in inner]
+            valneighb = themap[ipneighb]
+            thesum[k] += np.sum(valthis * valneighb)
+            thesum2[k] += np.sum((valthis * valneighb) ** 2)
+            thecount[k] += len(valneighb)
+            inner = outer
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mm = thesum / thecount
+        errs = np.sqrt(thesum2 / thecount - mm ** 2) / thecount ** 0.25
+    return np.degrees(thvals[:-1] + thvals[1:]) / 2, mm, errs
+
+
+def test_map_corr_neighbtheta():
+    def func(thetamin, thetamax, nbins, degrade):
+        if degrade is None:
+            themap_, ipok_ = themap, ipok
+        else:
+            themap_ = hp.ud_grade(themap, degrade)
+            seen = np.zeros(len(themap), bool)
+            seen[ipok] = True
+            ipok_ = np.where(hp.ud_grade(seen, degrade))[0]
+        expected = map_corr_loop(themap_, ipok_, thetamin, thetamax, nbins)
+        actual = map_corr_neighbtheta(themap, ipok, thetamin, thetamax, nbins,
+                                      degrade=degrade, verbose=False)
+        for a, e in zip(actual, expected):
+            assert_allclose(a, e, rtol=1e-10, atol=1e-14)
+
+    for thetamin, thetamax, nbins in [(0, 29, 10), (2.5, 40, 6)]:
+        for degrade in [None, 8]:
+            yield func, thetamin, thetamax, nbins, degrade
+
+
+def test_map_corr_harmonic():
+    # approximation of the pair counts for bins a few pixels wide
+    c0 = np.mean(themap[ipok] ** 2)
+    expected = map_corr_neighbtheta(themap, ipok, 0, 60, 4, verbose=False)[1]
+    actual = map_corr_harmonic(themap, ipok, 0, 60, 4)[1]
+    assert_allclose(actual, expected, atol=0.01 * c0)
+
+
+def test_ctheta_parts():
+    expected = ctheta_parts(themap, ipok, 0, 40, 8, nsplit=2, verbose=False)
+    actual = ctheta_parts(themap, ipok, 0, 40, 8, nsplit=2, verbose=False,
+                          method='pairs')
+    for a, e in zip(actual, expected):
+        assert_allclose(a, e)
+    for k, (thmin, thmax) in enumerate([(0, 20), (20, 40)]):
+        _, ctheta, errors = map_corr_neighbtheta(
+            themap, ipok, thmin, thmax, 4, degrade=nside // 2 ** k,
+            verbose=False)
+        assert_allclose(expected[1][4 * k:4 * k + 4], ctheta)
+        assert_allclose(expected[2][4 * k:4 * k + 4], errors)
+    assert_raises(ValueError, ctheta_parts, themap, ipok, 0, 40, 8,
+                  verbose=False, method='exact')
+
+
+def test_save_fastsim_data():
+    np.random.seed(0)
+    data = {'signoise': 3.5,
+            'years': 4,
+            'effective_variance_invcov': [np.random.randn(2, 5),
+                                          np.random.randn(2, 5)],
+            'clnoise': np.random.randn(3, 10),
+            'coverage': np.random.rand(12 * 16**2).astype(np.float32)}
+    path = tempfile.mkdtemp()
+    try:
+        dirname = os.path.join(path, 'DataFastSimulator_FI150_nfsub_2')
+        save_fastsim_data(data, dirname)
+        # no temporary file is left
+        assert_equal(sorted(os.listdir(dirname)),
+                     sorted(['_lists.npy'] + [k + '.npy' for k in data]))
+
+        for mmap_mode in [None, 'r']:
+            actual = _load_npy_directory(dirname, mmap_mode=mmap_mode)
+            assert_equal(sorted(actual), sorted(data))
+            for k, v in data.items():
+                assert isinstance(actual[k], type(v))
+                assert_equal(actual[k], v)
+                if isinstance(v, np.ndarray):
+                    assert_equal(actual[k].dtype, v.dtype)
+                    assert not actual[k].flags.writeable
+            assert isinstance(actual['clnoise'], np.memmap) == \
+                (mmap_mode is not None)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_create_noise_maps_seed():
+    d = qubic.qubicdict.qubicDict()
+    d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+    d['nside'] = nside
+    d['nf_sub'] = 2
+    d['nf_recon'] = 2
+    sky = Qubic_sky({'cmb': {'IQUMaps': np.zeros((3, 12 * nside**2))}}, d)
+    coverage = np.zeros(12 * nside**2)
+    coverage[ipok] = 1 + np.cos(theta[ipok])
+    clnoise = 1 / (np.arange(3 * nside) + 1.)
+
+    def func(clnoise):
+        def noise(nsub=2, **keywords):
+            return sky.create_noise_maps(1., coverage, nsub=nsub,
+                                         clnoise=clnoise, **keywords)
+
+        expected = noise(seed=1)
+        assert_equal(expected.shape, (2, len(coverage), 3))
+        assert np.all(expected[:, coverage == 0] == 0)
+        assert_equal(noise(seed=1), expected)
+        for keywords in [{'seed': 2}, {'seed': 1, 'realization': 1}]:
+            actual = noise(**keywords)
+            seen = coverage > 0
+            assert np.all(actual[:, seen] != expected[:, seen])
+        # the random stream of a sub-band does not depend on the others
+        assert_equal(noise(nsub=1, seed=1), expected[0])
+        # without seed, the realization follows the global generator
+        np.random.seed(3)
+        expected = noise()
+        np.random.seed(3)
+        assert_equal(noise(), expected)
+        assert np.any(noise() != expected)
+
+    for clnoise_ in [None, clnoise]:
+        yield func, clnoise_
@@ -0,0 +1,107 @@
+from __future__ import division
+
+import healpy as hp
+import numpy as np
+import qubic
+from numpy.testing import assert_allclose, assert_equal, assert_raises
+from pyoperators.utils import split
+from pyoperators.utils.ufuncs import abs2
+from qubic import QubicInstrument, QubicMultibandInstrument, QubicScene
+
+d = qubic.qubicdict.qubicDict()
+d.read_from_file(qubic.data.PATH + '../dicts/pipeline_demo.dict')
+d['nside'] = 32
+d['center_detector'] = False
+scene = QubicScene(d)
+q = QubicInstrument(d)[::50]
+
+
+def synthbeam_loop(q, scene, theta_max=45):
+    # the former computation with QubicInstrument._get_response
+    theta, phi = hp.pix2ang(scene.nside, scene.index)
+    index = np.where(theta <= np.radians(theta_max))[0]
+    out = np.zeros((len(q), len(scene)), dtype=q.synthbeam.dtype)
+    for s in split(len(index), 3):
+        index_ = index[s]
+        sb = QubicInstrument._get_response(
+            theta[index_], phi[index_], q.filter.bandwidth, q.detector.center,
+            q.detector.area, q.filter.nu, q.horn, q.primary_beam,
+            q.secondary_beam)
+        out[..., index_] = abs2(sb)
+    return out
+
+
+expected = synthbeam_loop(q, scene)
+
+
+def test_precision():
+    assert_equal(q.get_synthbeam(scene), expected)
+    actual = q.get_synthbeam(scene, precision='single')
+    assert_equal(actual.dtype, expected.dtype)
+    assert_allclose(actual, expected, rtol=1e-4,
+                    atol=1e-6 * np.max(expected))
+    assert_raises(ValueError, q.get_synthbeam, scene, precision='half')
+
+
+def test_chunks():
+    def func(max_memory, nthreads):
+        actual = q.get_synthbeam(scene, max_memory=max_memory,
+                                 nthreads=nthreads)
+        assert_equal(actual, expected)
+
+    for max_memory in [1e5, 1e9]:
+        for nthreads in [1, 3]:
+            yield func, max_memory, nthreads
+
+
+def test_primary_beam_min():
+    theta, phi = hp.pix2ang(scene.nside, scene.index)
+    beam = q.primary_beam(theta, phi)
+    beam[theta > np.radians(45)] = 0
+
+    def func(fraction):
+        actual = q.get_synthbeam(scene, primary_beam_min=fraction)
+        inside = beam >= fraction * np.max(beam)
+        assert_equal(actual[:, inside], expected[:, inside])
+        assert_equal(actual[:, ~inside], 0)
+
+    for fraction in [0, 0.01, 0.5]:
+        yield func, fraction
+
+
+def test_out():
+    out = np.full(expected.shape, np.nan, dtype=expected.dtype)
+    actual = q.get_synthbeam(scene, out=out)
+    assert actual is out
+    assert_equal(out, expected)
+    # the pixels which are not computed are zeroed
+    out[...] = np.nan
+    q.get_synthbeam(scene, theta_max=10, out=out)
+    assert_equal(out, synthbeam_loop(q, scene, theta_max=10))
+
+    for bad in [np.zeros(expected.shape, np.float64),
+                np.zeros((len(q) + 1, len(scene)), expected.dtype),
+                np.zeros(expected.shape[::-1], expected.dtype).T]:
+        assert_raises(ValueError, q.get_synthbeam, scene, out=bad)
+
+    # the output of a single detector or of the integration over the
+    # detectors cannot be preallocated
+    out = np.zeros(expected.shape, expected.dtype)
+    assert_raises(ValueError, q.get_synthbeam, scene, idet=0, out=out)
+    assert_raises(ValueError, q.get_synthbeam, scene, detector_integrate=2,
+                  out=out)
+    assert_equal(out, 0)
+
+
+def test_multiband():
+    d1 = d.copy()
+    d1['nf_sub'] = 2
+    qs = QubicMultibandInstrument(d1)
+    qs.subinstruments = [q_[::50] for q_ in qs.subinstruments]
+    bw = np.array([q_.filter.bandwidth for q_ in qs])
+    sb = [synthbeam_loop(q_, scene) for q_ in qs]
+    expected = np.sum([b * s for b, s in zip(bw, sb)], axis=0) / np.sum(bw)
+    assert_allclose(qs.get_synthbeam(scene, nthreads=2), expected,
+                    rtol=1e-6)
+    out = np.zeros_like(expected)
+    assert_raises(ValueError, qs.get_synthbeam, scene, out=out)
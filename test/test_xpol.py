@@ -1,6 +1,7 @@
 from __future__ import division
 
 import numpy as np
+from numpy.testing import assert_allclose
 from pyoperators.utils.testing import assert_same
 from pysimulators import FitsArray
 from qubic import Xpol
@@ -19,3 +20,27 @@ def test_xpol():
     for lmax in [0, 1, 2, 10]:
         for n in [lmax-1, lmax, lmax+1]:
             yield func, lmax, n
+
+
+def test_spectra_many():
+    class XpolDummy(Xpol):
+        def __init__(self):
+            self.mask = np.random.random(12 * 8**2) > 0.5
+            self.lmin, self.lmax, self.delta_ell = 2, 20, 3
+            self.ell_binned, self._p, self._q = self._bin_ell()
+            n = 6 * len(self.ell_binned)
+            self.mll_binned_inv = np.eye(n) + np.random.random((n, n)) / n
+    xpol = XpolDummy()
+    maps = np.random.random((2, 3, 3, 12 * 8**2))
+    pairs = [(0, 0), (0, 2), (2, 1)]
+    biased, unbiased = xpol.get_spectra_many(maps, pairs=pairs)
+    assert biased.shape == (2, 3, 6, 21)
+    for r in range(2):
+        for p, (i, j) in enumerate(pairs):
+            if i == j:
+                expected = xpol.get_spectra(maps[r, i])
+            else:
+                expected = xpol.get_spectra(maps[r, i], maps[r, j])
+            assert_same(biased[r, p], expected[0])
+            assert_allclose(unbiased[r, p], expected[1],
+                            atol=1e-12 * np.max(np.abs(expected[1])))